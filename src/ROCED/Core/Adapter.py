@@ -23,11 +23,15 @@ from __future__ import print_function, unicode_literals, absolute_import
 import abc
 import json
 import logging
+import time
 
+from .Isolation import AdapterProcess
 from .MachineRegistry import MachineRegistry
 
 import xmlrpc.server
 
+from Util.Concurrency import WorkerPool
+from Util.Logging import CycleTimingLog, JsonLog
 from . import Config
 
 
@@ -36,6 +40,11 @@ class NoDefaultSet(object):
         pass
 
 
+class PrefetchPending(Exception):
+    """A prefetch query is still running and there is no earlier result (see AdapterBase.getPrefetched)."""
+    pass
+
+
 class AdapterBase(object):
     """
     Contains a list of ConfigKeys which must not be published outside
@@ -100,6 +109,16 @@ class AdapterBase(object):
         # config keys whose values CAN be set before staring
         self.configKeysToLoadOptional = []
         self.privateConfig = []
+        # results of prefetchQueries in the current management cycle
+        self.prefetched = dict()
+        # prefetch queries still running without an earlier result, manage is skipped meanwhile
+        self.prefetchPending = set()
+        # remote calls outside of the prefetch queries, summed up by the core for its remote call budget
+        self.remoteCalls = 0
+        # manage() may run in a worker process (see AdapterBoxBase.isolated)
+        self.isolatable = True
+        # seconds to wait for manage when managed concurrently, None: the box' adapterTimeout
+        self.manageTimeout = None
 
     def init(self):
         """Delayed __Init__(). Code which depends on configuration being imported."""
@@ -108,6 +127,29 @@ class AdapterBase(object):
     def terminate(self):
         pass
 
+    @property
+    def prefetchQueries(self):
+        # type: () -> dict
+        """Remote (read only) queries {name: callable}, run in parallel by the core before manage."""
+        return {}
+
+    def getPrefetched(self, name, query):
+        """Result of a query prefetched in this management cycle. If missing, the query is run now.
+
+        A query still running in the background is not run twice: PrefetchPending is raised instead.
+        """
+        try:
+            return self.prefetched[name]
+        except KeyError:
+            if name in self.prefetchPending:
+                raise PrefetchPending("Query %s of %s is still running." % (name, self.description))
+            return self.remoteCall(query)
+
+    def remoteCall(self, function, *args):
+        """Run a remote call (e.g. a batch system query) and count it for the core's remote call budget."""
+        self.remoteCalls += 1
+        return function(*args)
+
     @property
     @abc.abstractmethod
     def description(self):
@@ -173,6 +215,17 @@ class AdapterBoxBase(object):
         self._adapterList = []
         self._rpcServer = None
         # self.rpcServer = "https://localhost:8000"
+        # manage adapters concurrently, waiting at most adapterTimeout seconds (None: until done),
+        # unless an adapter sets its own manageTimeout
+        self.concurrent = False
+        self.adapterTimeout = None
+        # manage adapters in worker processes, killed after isolationDeadline seconds
+        self.isolated = False
+        self.isolationDeadline = 300
+        self.__processes = {}
+        self.__workers = None
+        # adapter -> manage task still to be committed
+        self.__tasks = {}
 
     def addAdapter(self, a):
         # type: (AdapterBase) -> None
@@ -183,4 +236,123 @@ class AdapterBoxBase(object):
         self._adapterList += alist
 
     def manage(self):
-        [adapter.manage() for adapter in self._adapterList]
+        if self.isolated is True:
+            self.manageIsolated()
+        elif self.concurrent is True and len(self._adapterList) > 1:
+            self.manageConcurrently()
+        else:
+            for adapter in self._adapterList:
+                if not self.isReady(adapter):
+                    continue
+                with CycleTimingLog.measure("manage %s" % adapter.description):
+                    adapter.manage()
+
+    @staticmethod
+    def isReady(adapter):
+        # type: (AdapterBase) -> bool
+        """False if the adapter waits for a prefetch query, its manage is skipped in this cycle then."""
+        if adapter.prefetchPending:
+            logging.warning("%s waits for query %s, skipping manage."
+                            % (adapter.description, ", ".join(sorted(adapter.prefetchPending))))
+            return False
+        return True
+
+    def getManageTimeout(self, adapter):
+        # type: (AdapterBase) -> float
+        """Seconds to wait for manage of an adapter managed concurrently, None: until done."""
+        return self.adapterTimeout if adapter.manageTimeout is None else adapter.manageTimeout
+
+    def manageConcurrently(self):
+        """Run manage of all adapters at once, one thread each.
+
+        Each adapter runs in a deferred registry batch. Registry entries change right away, in the order
+        the threads run. The batches (events and status statistics) are committed in adapter order, so
+        listeners and the statistics see the same order in every cycle. Adapters not done after their
+        manage timeout (see getManageTimeout) are committed in a later cycle and not started again
+        until then.
+        """
+        mr = MachineRegistry()
+        if self.__workers is None:
+            self.__workers = WorkerPool(len(self._adapterList))
+        start = time.time()
+        for adapter in self._adapterList:
+            if adapter in self.__tasks:
+                logging.warning("%s is still busy, skipping manage." % adapter.description)
+                continue
+            if not self.isReady(adapter):
+                continue
+            self.__tasks[adapter] = self.__workers.submit(self.__manageAdapter, (mr, adapter),
+                                                          group=adapter.description)
+
+        for adapter in self._adapterList:
+            task = self.__tasks.get(adapter)
+            if task is None:
+                continue
+            timeout = self.getManageTimeout(adapter)
+            if not self.__workers.waitFor(task, None if timeout is None else start + timeout - time.time()):
+                logging.warning("%s did not finish manage within %ss." % (adapter.description, timeout))
+                continue
+            del self.__tasks[adapter]
+            mr.commitBatch(task.result)
+        self.__workers.completed()
+
+    def startWorkers(self):
+        """Start the worker processes of isolated adapters now, e.g. before other threads are started."""
+        if self.isolated is not True:
+            return
+        for adapter in self._adapterList:
+            if adapter.isolatable is True and adapter not in self.__processes:
+                self.__processes[adapter] = AdapterProcess(adapter)
+                self.__processes[adapter].start()
+
+    def manageIsolated(self):
+        """Run manage of each adapter in its own worker process (see AdapterProcess), all at once.
+
+        Workers get the machines of their site and return their registry changes, which are applied
+        in adapter order. A worker missing the deadline is killed and restarted, its changes of this
+        cycle are lost. Adapters which are not isolatable are managed in the core process.
+        """
+        mr = MachineRegistry()
+        start = time.time()
+        snapshot = mr.snapshot()
+        for adapter in self._adapterList:
+            if adapter.isolatable is not True or not self.isReady(adapter):
+                continue
+            if adapter not in self.__processes:
+                self.__processes[adapter] = AdapterProcess(adapter)
+            site = getattr(adapter, "siteName", None)
+            self.__processes[adapter].request({mid: machine for mid, machine in snapshot.items()
+                                               if site is None or machine.get(mr.regSite) == site}, start)
+
+        for adapter in self._adapterList:
+            if adapter.isolatable is not True:
+                if self.isReady(adapter):
+                    with CycleTimingLog.measure("manage %s" % adapter.description):
+                        adapter.manage()
+                continue
+            if adapter.prefetchPending:
+                continue
+            process = self.__processes[adapter]
+            if not process.poll(max(0.0, start + self.isolationDeadline - time.time())):
+                logging.error("%s missed the deadline of %ss, restarting its worker."
+                              % (adapter.description, self.isolationDeadline))
+                process.restart()
+                continue
+            changes, items, error, remoteCalls = process.receive()
+            adapter.remoteCalls += remoteCalls
+            CycleTimingLog.add("manage %s" % adapter.description, time.time() - process.started)
+            if error is not None:
+                logging.error("Managing %s failed:\n%s" % (adapter.description, error))
+            with mr.batch():
+                mr.applyChanges(changes)
+            JsonLog.addItems(items)
+
+    @staticmethod
+    def __manageAdapter(mr, adapter):
+        events = []
+        try:
+            with CycleTimingLog.measure("manage %s" % adapter.description), mr.deferredBatch(events):
+                adapter.manage()
+        except Exception:
+            logging.exception("Managing %s failed." % adapter.description)
+        return events
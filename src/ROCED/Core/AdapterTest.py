@@ -21,14 +21,19 @@
 from __future__ import unicode_literals, absolute_import
 
 import logging
+import os
+import threading
+import time
 
 import configparser
 
 from IntegrationAdapter import Integration
 from SiteAdapter.Site import SiteAdapterBase
+from Util.Logging import CsvStats, JsonLog, MachineHistoryLogger
 from . import Config
 from . import ScaleTest
 from .Adapter import AdapterBase, AdapterBoxBase
+from .MachineRegistry import MachineRegistry, StatusChangedEvent
 
 
 class AdapterBaseTestClass(AdapterBase):
@@ -49,6 +54,42 @@ class IntegrationAdapterTest(Integration.IntegrationAdapterBase):
         return super(IntegrationAdapterTest, self).description
 
 
+class SlowAdapterTest(IntegrationAdapterTest):
+    def __init__(self, mid, delay):
+        super(SlowAdapterTest, self).__init__()
+        self.mid = mid
+        self.delay = delay
+        self.release = threading.Event()
+        self.release.set()
+        # manage waits for the other adapters' manage, if set
+        self.rendezvous = None
+
+    def manage(self):
+        if self.rendezvous is not None:
+            self.rendezvous.wait()
+        time.sleep(self.delay)
+        self.release.wait()
+        MachineRegistry().updateMachineStatus(self.mid, MachineRegistry.statusUp)
+
+
+class IsolatedAdapterTest(IntegrationAdapterTest):
+    def __init__(self, delay=0.0):
+        super(IsolatedAdapterTest, self).__init__()
+        self.delay = delay
+
+    def manage(self):
+        mr = MachineRegistry()
+        # rows and history entries left from previous requests (recorded by the core)
+        JsonLog.addItem("isolated", "buffered", CsvStats.pending() + MachineHistoryLogger.pending())
+        if not mr.machines:
+            time.sleep(self.delay)
+        for mid in list(mr.machines):
+            mr.updateMachineStatus(mid, mr.statusWorking)
+        mid = mr.newMachine("%d-%d" % (os.getpid(), len(mr.machines)))
+        mr.machines[mid][mr.regSite] = "isolated"
+        JsonLog.addItem("isolated", "pid", os.getpid())
+
+
 class AdapterBoxTest(ScaleTest.ScaleTestBase):
     def test_getBoxContent(self):
         logging.debug("=======Testing AdapterBox=======")
@@ -62,6 +103,107 @@ class AdapterBoxTest(ScaleTest.ScaleTestBase):
         self.assertEqual(len(con), 2)
 
 
+    def test_manageConcurrently(self):
+        mr = MachineRegistry()
+        mr.clear()
+        order = []
+        mr.subscribe(lambda evt: order.append(evt.id), StatusChangedEvent)
+
+        box = AdapterBoxBase()
+        box.concurrent = True
+        box.adapterTimeout = 5
+        adapters = [SlowAdapterTest(mr.newMachine(), delay) for delay in (0.02, 0.01, 0.0, 0.02)]
+        box.addAdapterList(adapters)
+
+        rows = []
+        addItem = CsvStats.__dict__["add_item"]
+        CsvStats.add_item = lambda **row: rows.append(row["mid"])
+        # adapters run at once, otherwise they couldn't wait for each other
+        rendezvous = ScaleTest.Rendezvous(len(adapters))
+        for adapter in adapters:
+            adapter.rendezvous = rendezvous
+        try:
+            box.manage()
+        finally:
+            CsvStats.add_item = addItem
+        for adapter in adapters:
+            adapter.rendezvous = None
+        # events and statistics are committed in adapter order
+        self.assertEqual(order, [adapter.mid for adapter in adapters])
+        self.assertEqual(rows, [adapter.mid for adapter in adapters])
+
+        # adapters exceeding the timeout are committed later and not started twice
+        box.adapterTimeout = 0.5
+        adapters[1].release.clear()
+        for adapter in adapters:
+            mr.updateMachineStatus(adapter.mid, mr.statusBooting)
+        del order[:]
+        box.manage()
+        self.assertEqual(order, [adapters[0].mid, adapters[2].mid, adapters[3].mid])
+        adapters[1].release.set()
+        del order[:]
+        box.manage()
+        self.assertEqual(order, [adapter.mid for adapter in adapters])
+
+        # an adapter's own timeout overrides the box' timeout
+        box.adapterTimeout = None
+        adapters[2].manageTimeout = 0.1
+        adapters[2].release.clear()
+        for adapter in adapters:
+            mr.updateMachineStatus(adapter.mid, mr.statusBooting)
+        del order[:]
+        box.manage()
+        self.assertEqual(order, [adapters[0].mid, adapters[1].mid, adapters[3].mid])
+        adapters[2].release.set()
+        box.manage()
+        mr.clear()
+
+    def test_manageIsolated(self):
+        mr = MachineRegistry()
+        mr.clear()
+        events = []
+        mr.subscribe(lambda evt: events.append((evt.id, evt.newStatus)), StatusChangedEvent)
+
+        box = AdapterBoxBase()
+        box.isolated = True
+        box.isolationDeadline = 2
+        healthy, hanging = IsolatedAdapterTest(), IsolatedAdapterTest(delay=10)
+        box.addAdapterList([hanging, healthy])
+
+        start = time.time()
+        box.manage()
+        self.assertLess(time.time() - start, 5)
+        # changes made in the worker are applied and published in the core process
+        (mid,) = mr.machines
+        self.assertNotEqual(mid.split("-")[0], str(os.getpid()))
+        self.assertEqual(mr.machines[mid][mr.regSite], "isolated")
+
+        # the restarted worker does not hang with machines present
+        box.isolationDeadline = 5
+        box.manage()
+        self.assertEqual(mr.machines[mid][mr.regStatus], mr.statusWorking)
+        self.assertIn((mid, mr.statusWorking), events)
+        self.assertEqual(len(mr.machines), 3)
+        mr.clear()
+
+    def test_isolatedBuffers(self):
+        mr = MachineRegistry()
+        mr.clear()
+        mr.historyLength = 1
+        box = AdapterBoxBase()
+        box.isolated = True
+        box.isolationDeadline = 5
+        box.addAdapter(IsolatedAdapterTest())
+        box.startWorkers()
+        try:
+            for _ in range(4):
+                box.manage()
+                self.assertEqual(JsonLog.takeItems()["isolated"]["buffered"], 0)
+        finally:
+            mr.historyLength = MachineRegistry.historyLength
+            mr.clear()
+
+
 class AdapterBaseTest(ScaleTest.ScaleTestBase):
     def test_addOptionalConfigKeys(self):
         logging.debug("=======Testing AdapterBase=======")
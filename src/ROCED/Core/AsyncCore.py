@@ -0,0 +1,298 @@
+# ===============================================================================
+#
+# Copyright (c) 2010, 2011 by Thomas Hauth and Stephan Riedel
+# 
+# This file is part of ROCED.
+# 
+# ROCED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ROCED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ROCED.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+from __future__ import unicode_literals, absolute_import
+
+"""
+asyncio variant of the ScaleCore (Python 3.5+, imported on demand, see ScaleCoreFactory).
+
+A single event loop runs the management cycles and multiplexes the remote calls of a cycle.
+Adapters may implement coroutines, which run on the loop:
+- "manageAsync()", used instead of "manage"
+- "spawnAsync(machineType, count)" (site adapters), used instead of "spawnMachines"
+- prefetch queries (see AdapterBase.prefetchQueries)
+Synchronous adapters and queries run in the loop's thread pool executor.
+"""
+
+import asyncio
+import logging
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from .Core import ScaleCore
+from SiteAdapter.Site import SiteApplyResult, SiteBox
+from Util.Concurrency import FixedRateTicks
+from Util.Logging import CycleTimingLog
+
+logger = logging.getLogger("Core")
+
+
+def isNative(adapter, hook):
+    # type: (AdapterBase, str) -> bool
+    """Does the adapter implement the hook as a coroutine?"""
+    return asyncio.iscoroutinefunction(getattr(adapter, hook, None))
+
+
+class AsyncScaleCore(ScaleCore):
+    def __init__(self, *args, **kwargs):
+        """Scale core running its management cycles on an asyncio event loop.
+
+        The adapters of a box are managed at once, as are the queries and the decisions of all sites.
+        Registry changes of synchronous adapters are committed in adapter order, those of native adapters
+        (coroutines sharing the loop's thread) before.
+        """
+        super(AsyncScaleCore, self).__init__(*args, **kwargs)
+        # threads running synchronous adapters and queries
+        self.executorWorkers = 32
+        self.loop = None
+        self._ticks = None
+        # set to re-read the next tick, e.g. after a wake-up
+        self._wakeUp = None
+        # adapter -> manage future not yet committed
+        self._manageFutures = dict()
+        # (adapter, query name) -> prefetch future not yet handed to its adapter
+        self._prefetchFutures = dict()
+        # site -> apply future not yet committed
+        self._applyFutures = dict()
+
+    def startManage(self):
+        """Run management cycles at a fixed rate until the last iteration (blocking)."""
+        self.loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(self.executorWorkers)
+        self.loop.set_default_executor(executor)
+        try:
+            self.loop.run_until_complete(self.run())
+        finally:
+            self.loop.close()
+            executor.shutdown(wait=False)
+
+    @property
+    def ticks(self):
+        # type: () -> FixedRateTicks
+        return self._ticks
+
+    async def run(self):
+        """Fixed-rate loop of management cycles, see FixedRateTicks (as FixedRateScheduler, on the loop)."""
+        self._wakeUp = asyncio.Event()
+        self._ticks = FixedRateTicks(self.manageInterval, "ManagementLoop")
+        self._ticks.start(time.time())
+        while True:
+            tick = self._ticks.begin()
+            try:
+                lastIteration = await self.manageAsync()
+            except Exception:
+                # as FixedRateScheduler, the next cycle runs anyway
+                logger.exception("Management cycle failed.")
+                lastIteration = False
+            if self.autoRun is not True or lastIteration is True:
+                break
+            self._ticks.finish(tick)
+            while self._ticks.nextTick > time.time():
+                try:
+                    await asyncio.wait_for(self._wakeUp.wait(), self._ticks.nextTick - time.time())
+                except asyncio.TimeoutError:
+                    pass
+                # re-read the next tick, a wake-up may have changed it
+                self._wakeUp.clear()
+
+    def wakeUp(self):
+        # type: () -> bool
+        """Start a management cycle early (RPC API, called from the RPC server's thread), see ScaleCore.wakeUp."""
+        if self.loop is None or self.loop.is_closed() or self._ticks is None or not self._wakeUpAllowed():
+            return False
+        logger.debug("Wake-up, next cycle in %ss." % self.wakeUpDebounce)
+        self._ticks.trigger(self.wakeUpDebounce)
+        self.loop.call_soon_threadsafe(self._wakeUp.set)
+        return True
+
+    async def manageAsync(self):
+        # type: () -> bool
+        """One management cycle, see ScaleCore.startManage. Return True if it was the last iteration."""
+        self.beginCycle()
+
+        with CycleTimingLog.measure("prefetch"):
+            await self.prefetchAsync()
+
+        # regular management
+        # requirement adapters are queried by the box, not managed
+        with CycleTimingLog.measure("manage_requirement"):
+            self.reqBox.manage()
+        with CycleTimingLog.measure("manage_site"):
+            for site in self.siteBox.adapterList:
+                site.checkSpawnOperations()
+            await self.manageBoxAsync(self.siteBox)
+        with CycleTimingLog.measure("manage_integration"):
+            await self.manageBoxAsync(self.intBox)
+
+        # requirement adapters may query their batch system (e.g. qstat via SSH)
+        requirement, decision, aggregate = await self.loop.run_in_executor(None, self.decide)
+        with CycleTimingLog.measure("apply_decision"):
+            results = await self.applyDecisionAsync(decision, aggregate)
+        return self.finishCycle(requirement, results)
+
+    async def prefetchAsync(self):
+        """Run the prefetch queries of all adapters at once, see ScaleCore.prefetch."""
+        queries = [(adapter, name, query) for adapter in self.adapters
+                   for name, query in adapter.prefetchQueries.items()]
+        for adapter, name, query in queries:
+            if (adapter, name) not in self._prefetchFutures:
+                self._remoteCalls += 1
+                self._prefetchFutures[(adapter, name)] = asyncio.ensure_future(self._query(query))
+        if not self._prefetchFutures:
+            return
+        await asyncio.wait(list(self._prefetchFutures.values()), timeout=self.prefetchTimeout)
+
+        for (adapter, name), future in list(self._prefetchFutures.items()):
+            if not future.done():
+                self.prefetchPending(adapter, name)
+                continue
+            del self._prefetchFutures[(adapter, name)]
+            if future.exception() is not None:
+                logger.error("Query %s %s failed: %s" % (adapter.description, name, future.exception()))
+                continue
+            result, duration = future.result()
+            self.prefetchDone(adapter, name, result)
+            CycleTimingLog.add("prefetch %s %s" % (adapter.description, name), duration)
+
+    async def _query(self, query):
+        start = time.time()
+        if asyncio.iscoroutinefunction(query):
+            result = await query()
+        else:
+            result = await self.loop.run_in_executor(None, query)
+        return result, time.time() - start
+
+    async def manageBoxAsync(self, box):
+        # type: (AdapterBoxBase) -> None
+        """Manage all adapters of a box at once.
+
+        Adapters not done after their manage timeout (see AdapterBoxBase.getManageTimeout) continue in the
+        background and are not started again until done. Boxes with isolated adapters are managed as usual, in the executor.
+        """
+        if box.isolated is True:
+            await self.loop.run_in_executor(None, box.manage)
+            return
+
+        start = time.time()
+        nativeEvents = []
+        with self.mr.deferredBatch(nativeEvents):
+            for adapter in box.adapterList:
+                if adapter in self._manageFutures:
+                    logger.warning("%s is still busy, skipping manage." % adapter.description)
+                elif isNative(adapter, "manageAsync"):
+                    self._manageFutures[adapter] = asyncio.ensure_future(self._manageNative(adapter))
+                else:
+                    self._manageFutures[adapter] = self.loop.run_in_executor(None, self._manageWrapped, adapter)
+            for adapter in box.adapterList:
+                timeout = box.getManageTimeout(adapter)
+                if adapter in self._manageFutures:
+                    await asyncio.wait([self._manageFutures[adapter]],
+                                       timeout=None if timeout is None else max(0.0, start + timeout - time.time()))
+        self.mr.commitBatch(nativeEvents)
+
+        for adapter in box.adapterList:
+            future = self._manageFutures.get(adapter)
+            if future is None:
+                continue
+            if not future.done():
+                logger.warning("%s did not finish manage within %ss." % (adapter.description,
+                                                                        box.getManageTimeout(adapter)))
+                continue
+            del self._manageFutures[adapter]
+            self.mr.commitBatch(future.result())
+
+    @staticmethod
+    async def _manageNative(adapter):
+        # changes are batched by manageBoxAsync, the coroutines share the loop's thread
+        try:
+            with CycleTimingLog.measure("manage %s" % adapter.description):
+                await adapter.manageAsync()
+        except Exception:
+            logger.exception("Managing %s failed." % adapter.description)
+        return []
+
+    def _manageWrapped(self, adapter):
+        events = []
+        try:
+            with CycleTimingLog.measure("manage %s" % adapter.description), self.mr.deferredBatch(events):
+                adapter.manage()
+        except Exception:
+            logger.exception("Managing %s failed." % adapter.description)
+        return events
+
+    async def applyDecisionAsync(self, decision, aggregate=None):
+        # type: (dict, MachineAggregate) -> dict
+        """Apply the decision on all sites at once, see SiteBox.applyMachineDecision.
+
+        Sites not done after the site box' adapterTimeout count as failed and continue in the background,
+        they get no new decision until done.
+        """
+        sites = self.siteBox.adapterList
+        timeout = self.siteBox.adapterTimeout
+        nativeEvents = []
+        with self.mr.deferredBatch(nativeEvents):
+            for site in sites:
+                siteDecision = decision.get(site.siteName, dict())
+                if site in self._applyFutures:
+                    logger.warning("%s is still applying a previous decision." % site.siteName)
+                elif isNative(site, "spawnAsync"):
+                    self._applyFutures[site] = asyncio.ensure_future(self._applyNative(site, siteDecision, aggregate))
+                else:
+                    self._applyFutures[site] = self.loop.run_in_executor(None, SiteBox.applySiteDecision, self.mr,
+                                                                         site, siteDecision, aggregate)
+            if self._applyFutures:
+                await asyncio.wait(list(self._applyFutures.values()), timeout=timeout)
+        self.mr.commitBatch(nativeEvents)
+
+        results = dict()
+        for site in sites:
+            future = self._applyFutures[site]
+            if not future.done():
+                results[site.siteName] = SiteApplyResult.failure("Not done within %ss." % timeout)
+                continue
+            del self._applyFutures[site]
+            if future.exception() is not None:
+                results[site.siteName] = SiteApplyResult.failure(str(future.exception()))
+                continue
+            results[site.siteName], events = future.result()
+            self.mr.commitBatch(events)
+        self.siteBox.recordApplyResults(results)
+        return results
+
+    async def _applyNative(self, site, decision, aggregate):
+        before = SiteApplyResult.countSite(self.mr, site.siteName)
+        requested, error = dict(), None
+        try:
+            requested = site.planMachineDecision(decision, aggregate)
+            for machineType, count in requested.items():
+                if count > 0:
+                    await site.spawnAsync(machineType, count)
+                else:
+                    site.terminateMachines(machineType, abs(count))
+        except Exception:
+            error = traceback.format_exc()
+            logger.error("Applying decision on %s failed:\n%s" % (site.siteName, error))
+        after = SiteApplyResult.countSite(self.mr, site.siteName)
+        return SiteApplyResult.fromCounts(requested, before, after, error), []
+
+    @property
+    def description(self):
+        return "Scale Core 0.7 (asyncio)"
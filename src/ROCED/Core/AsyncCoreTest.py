@@ -0,0 +1,128 @@
+# ===============================================================================
+#
+# Copyright (c) 2010, 2011 by Thomas Hauth and Stephan Riedel
+# 
+# This file is part of ROCED.
+# 
+# ROCED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ROCED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ROCED.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+import logging
+import threading
+import time
+
+from . import ScaleTest
+from .AsyncCore import AsyncScaleCore
+from .CoreTest import SiteBrokerTest, SlowSiteAdapterTest, SpawningSiteAdapterTest
+
+
+async def meet(rendezvous):
+    """Rendezvous.wait for coroutines, without blocking the loop."""
+    rendezvous.arrive()
+    deadline = time.time() + rendezvous.timeout
+    while not rendezvous.complete.is_set():
+        if time.time() > deadline:
+            raise RuntimeError("Only %d of %d calls ran at once." % (rendezvous.arrived, rendezvous.parties))
+        await asyncio.sleep(0.01)
+
+
+class NativeSiteAdapterTest(SpawningSiteAdapterTest):
+    async def manageAsync(self):
+        await meet(self.rendezvous)
+        self.managed = True
+
+    async def spawnAsync(self, machineType, count):
+        await meet(self.rendezvous)
+        for _ in range(min(count, self.capacity)):
+            mid = self.mr.newMachine()
+            self.mr.update(mid, {self.mr.regSite: self.siteName, self.mr.regMachineType: machineType})
+
+
+class AsyncScaleCoreTest(ScaleTest.ScaleTestBase):
+    @staticmethod
+    def setRendezvous(sites):
+        rendezvous = ScaleTest.Rendezvous(len(sites))
+        for site in sites:
+            site.rendezvous = rendezvous
+
+    def test_concurrency(self):
+        logging.debug("=======Testing asyncio Core=======")
+        sites = [NativeSiteAdapterTest("site1", 5), NativeSiteAdapterTest("site2", 5),
+                 SlowSiteAdapterTest("site3", 5)]
+        sc = AsyncScaleCore(SiteBrokerTest(), None, [], sites, [], False)
+        sc.mr.clear()
+        sc.loop = asyncio.new_event_loop()
+        try:
+            # native and wrapped adapters are managed at once, otherwise they couldn't wait for each other
+            self.setRendezvous(sites)
+            sc.loop.run_until_complete(sc.manageBoxAsync(sc.siteBox))
+            self.assertTrue(all(site.managed for site in sites))
+
+            self.setRendezvous(sites)
+            results = sc.loop.run_until_complete(sc.applyDecisionAsync(
+                {"site1": {"machine1": 2}, "site2": {"machine1": 1}, "site3": {"machine1": 3}}))
+            self.assertEqual({siteName: result.launched for siteName, result in results.items()},
+                             {"site1": {"machine1": 2}, "site2": {"machine1": 1}, "site3": {"machine1": 3}})
+            self.assertEqual(sc.mr.countMachines(), 6)
+
+            # a hanging site fails the cycle and continues in the background
+            sc.siteBox.adapterTimeout = 0.1
+            release = threading.Event()
+            spawnMachines = sites[2].spawnMachines
+            sites[2].spawnMachines = lambda machineType, count: (release.wait(5), spawnMachines(machineType, count))
+            results = sc.loop.run_until_complete(sc.applyDecisionAsync({"site3": {"machine1": 1}}))
+            self.assertTrue(results["site3"].failed)
+            self.assertFalse(results["site1"].failed)
+            release.set()
+            results = sc.loop.run_until_complete(sc.applyDecisionAsync({}))
+            self.assertEqual(results["site3"].launched, {"machine1": 1})
+        finally:
+            sc.loop.close()
+            sc.mr.clear()
+
+    def test_run(self):
+        logging.debug("=======Testing asyncio Management Loop=======")
+        broker = SiteBrokerTest()
+        broker.decide = lambda machineTypes, siteInfo, aggregate=None: {"site1": {}}
+        sc = AsyncScaleCore(broker, None, [], [SpawningSiteAdapterTest("site1", 1)], [], True,
+                            maximumManageIterations=1)
+        sc.mr.clear()
+        sc.mr.registerConsumer(sc.consumerPersistence)
+        sc.manageInterval = 0.05
+        cycles, decisions = [], []
+        beginCycle, decide = sc.beginCycle, sc.decide
+
+        def failingBeginCycle():
+            cycles.append(time.time())
+            if len(cycles) == 1:
+                raise RuntimeError("Cycle failed.")
+            if len(cycles) == 5:
+                sc.autoRun = False
+            beginCycle()
+
+        def recordingDecide():
+            decisions.append(threading.current_thread())
+            return decide()
+
+        sc.beginCycle, sc.decide = failingBeginCycle, recordingDecide
+        sc.startManage()
+        # a failed cycle doesn't end the loop, decide doesn't block it
+        self.assertEqual(len(cycles), 2)
+        self.assertEqual(sc.manageIterations, 1)
+        self.assertEqual(len(decisions), 1)
+        self.assertNotEqual(decisions[0], threading.current_thread())
+        sc.mr.clear()
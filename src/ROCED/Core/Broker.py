@@ -35,8 +35,8 @@ class SiteBrokerBase(object):
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def decide(self, machineTypes, siteInfo):
-        # (dict, list) ->dict
+    def decide(self, machineTypes, siteInfo, aggregate=None):
+        # (dict, list, MachineAggregate) ->dict
         """
         Main SiteBroker method with the intended behaviour.
 
@@ -44,6 +44,7 @@ class SiteBrokerBase(object):
                                        MachineStatus object    value
         :type siteInfo     dictionary  site name (string)      key
                                        SiteInformation object  value
+        :type aggregate    MachineAggregate  machine counts of this cycle (MachineRegistry.aggregate)
 
         :returns: dictionary: { siteName:[machineName] }
                   Delta of machines on siteName
@@ -90,7 +91,7 @@ class StupidBroker(SiteBrokerBase):
 
         dict_[siteName][machineName] += mod
 
-    def decide(self, machineTypes, siteInfo):
+    def decide(self, machineTypes, siteInfo, aggregate=None):
         """Redistribute cloud usage."""
         # TODO: report if not all req can be met
         # TODO: Input not yet complete. Broker has to know where each machine is running. FIX!!!
@@ -114,8 +115,8 @@ class StupidBroker(SiteBrokerBase):
                 machinesToSpawn[mName] = delta
 
         # machinesToSpawn contains a wishlist of machines. Distribute this to the cloud.
-        # Spawn cheap sites first.
-        cheapFirst = sorted(siteInfo, key=attrgetter("cost"), reverse=False)
+        # Spawn cheap sites first, sites which recently failed to spawn last.
+        cheapFirst = sorted(siteInfo, key=attrgetter("spawnFailures", "cost"), reverse=False)
         # Shutdown expensive sites first.
         expensiveFirst = sorted(siteInfo, key=attrgetter("cost"), reverse=True)
 
@@ -25,6 +25,20 @@ GeneralSection = "general"
 
 GeneralLogFolder = "logfolder"
 GeneralManagementInterval = "management_interval"
+GeneralAdaptiveInterval = "adaptive_interval"
+GeneralMinManagementInterval = "min_management_interval"
+GeneralMaxManagementInterval = "max_management_interval"
+GeneralRemoteCallBudget = "remote_call_budget"
+GeneralRpcPort = "rpc_port"
+GeneralWakeUpDebounce = "wakeup_debounce"
+GeneralSnapshotInterval = "snapshot_interval"
+GeneralConcurrentManage = "concurrent_manage"
+GeneralConcurrentApply = "concurrent_apply"
+GeneralAdapterTimeout = "adapter_timeout"
+GeneralPrefetchTimeout = "prefetch_timeout"
+GeneralIsolateSiteAdapters = "isolate_site_adapters"
+GeneralIsolationDeadline = "isolation_deadline"
+GeneralAsyncCore = "async_core"
 
 GeneralBroker = "broker"
 
@@ -33,6 +47,8 @@ GeneralReqAdapters = "req_adapters"
 GeneralIntAdapters = "int_adapters"
 
 ConfigObjectType = "type"
+# optional in every adapter section: seconds to wait for its manage, if managed concurrently
+ConfigManageTimeout = "manage_timeout"
 
 ConfigTypeString = "string"
 ConfigTypeInt = "int"
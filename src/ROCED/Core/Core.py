@@ -26,19 +26,22 @@ all module objects and runs the SiteBroker to handle
 Cloud utilization.
 """
 
+import collections
 import importlib
 import logging
+import time
 
 from datetime import datetime
-from threading import Timer
 
 from . import Broker
 from . import Config
 from . import MachineRegistry
+from .RpcServer import LocalRpcServer
 from IntegrationAdapter.Integration import IntegrationBox
 from RequirementAdapter.Requirement import RequirementBox
 from SiteAdapter.Site import SiteBox
-from Util.Logging import JsonLog, MachineRegistryLogger
+from Util.Concurrency import FixedRateScheduler, FixedRateTicks, WorkerPool
+from Util.Logging import CycleTimingLog, JsonLog, MachineHistoryLogger, MachineRegistryLogger
 from Util.PythonTools import summarize_dicts
 
 logger = logging.getLogger("Core")
@@ -52,6 +55,8 @@ class MachineStatus(object):
 
 class ScaleCore(object):
     _rpcServer = None
+    # change tracking consumer name (machine registry)
+    consumerPersistence = "persistence"
 
     def exportMethod(self, meth, name):
         if self._rpcServer is not None:
@@ -76,10 +81,38 @@ class ScaleCore(object):
         self.broker = broker
         self.autoRun = autoRun
         self.manageInterval = 30
+        # calls startManage every manageInterval seconds, counted from the start of the first cycle
+        self.scheduler = None
+        self._cycleStart = None
+        # adaptive mode: shorten the interval while demand changes or machines are in transition, back off
+        # when steady. remoteCallBudget limits the remote queries per hour (None: unlimited).
+        self.adaptiveInterval = False
+        self.minManageInterval = 10
+        self.maxManageInterval = 300
+        self.remoteCallBudget = None
+        # relative requirement change considered volatile
+        self.volatilityThreshold = 0.1
+        self._lastRequirement = None
+        # remote calls of the current cycle, and (time, calls) of the cycles within the last hour
+        self._remoteCalls = 0
+        self._remoteCallLog = collections.deque()
+        # seconds a wake-up waits for more wake-ups before a cycle starts
+        self.wakeUpDebounce = 2
+        # management cycles between registry snapshots, all changes are journaled in between
+        self.snapshotInterval = 10
+        # seconds to wait for prefetch queries (None: until done)
+        self.prefetchTimeout = None
+        self._prefetchPool = None
+        # (adapter, query name) -> prefetch task not yet handed to its adapter
+        self._prefetchTasks = dict()
+        # (adapter, query name) -> last result, used while the query is still running
+        self._lastPrefetched = dict()
         # will count the number of iterations that have been executed
         self.manageIterations = 0
         self.maximumManageIterations = maximumManageIterations
         self.mr = MachineRegistry.MachineRegistry()
+        # only save the machine registry if it changed
+        self.mr.registerConsumer(self.consumerPersistence)
         self._rpcServer = rpcServer
         # self._rpcServer.register_function(self.getDescription,"ScaleCore_getDescription" )
 
@@ -88,6 +121,7 @@ class ScaleCore(object):
 
         for a in reqAdapterList:
             a._rpcServer = self._rpcServer
+            a.onRequirementPushed = self.wakeUp
             a.init()
 
         self.reqBox.addAdapterList(reqAdapterList)
@@ -112,28 +146,205 @@ class ScaleCore(object):
 
     def init(self):
         # self.exportMethod(self.setMachineTypeMaxInstances, "setMachineTypeMaxInstances")
+        self.exportMethod(self.wakeUp, "wakeUp")
         self.mr.machines = MachineRegistryLogger.load()
+        self.mr.checkpoint(self.consumerPersistence)
+        self.mr.journal = MachineRegistryLogger
+        MachineRegistryLogger.dump(*self.mr.journaledSnapshot())
+
+    @property
+    def adapters(self):
+        return self.reqBox.adapterList + self.siteBox.adapterList + self.intBox.adapterList
+
+    def prefetch(self):
+        """Run the remote queries of all adapters at once, adapters use the results during the cycle.
+
+        A cycle thus waits for the slowest query instead of the sum of all. Queries still running
+        after prefetchTimeout are used by the next cycle (and not started twice), see prefetchPending.
+        """
+        queries = [(adapter, name, query) for adapter in self.adapters
+                   for name, query in adapter.prefetchQueries.items()]
+        if not queries:
+            return
+        if self._prefetchPool is None:
+            self._prefetchPool = WorkerPool(len(queries))
+
+        start = time.time()
+        for adapter, name, query in queries:
+            if (adapter, name) not in self._prefetchTasks:
+                self._remoteCalls += 1
+                self._prefetchTasks[(adapter, name)] = self._prefetchPool.submit(
+                    query, group="%s %s" % (adapter.description, name))
+        self._prefetchPool.wait(self.prefetchTimeout)
+        self._prefetchPool.completed()
+
+        for (adapter, name), task in list(self._prefetchTasks.items()):
+            if not task.done:
+                self.prefetchPending(adapter, name)
+                continue
+            del self._prefetchTasks[(adapter, name)]
+            CycleTimingLog.add("prefetch %s" % task.group, task.duration)
+            if task.error is None:
+                self.prefetchDone(adapter, name, task.result)
+        logger.debug("Prefetched %d queries in %.2fs." % (len(queries), time.time() - start))
+
+    def prefetchDone(self, adapter, name, result):
+        """Hand the result of a prefetch query to its adapter."""
+        adapter.prefetched[name] = result
+        self._lastPrefetched[(adapter, name)] = result
+
+    def prefetchPending(self, adapter, name):
+        """A prefetch query is still running: the adapter gets the result of an earlier cycle, if any.
+
+        Otherwise the adapter's manage is skipped in this cycle (see AdapterBase.getPrefetched), instead
+        of running the query again.
+        """
+        if (adapter, name) in self._lastPrefetched:
+            logger.warning("Query %s %s is still running, using its previous result." % (adapter.description, name))
+            adapter.prefetched[name] = self._lastPrefetched[(adapter, name)]
+        else:
+            logger.warning("Query %s %s is still running." % (adapter.description, name))
+            adapter.prefetchPending.add(name)
+
+    def adaptInterval(self, requirement):
+        # type: (dict) -> float
+        """Adapt manageInterval to the demand of the last cycle.
+
+        The interval is halved while the total requirement changes by more than volatilityThreshold or
+        machines are in a transient state, else it grows by half. It stays within the minimum and maximum,
+        but never drops below what the remote call budget allows.
+        """
+        transient = sum(self.mr.countMachines(status=status) for status in
+                        (self.mr.statusBooting, self.mr.statusUp, self.mr.statusIntegrating,
+                         self.mr.statusPendingDisintegration, self.mr.statusDisintegrating))
+        total = sum(value for value in requirement.values() if value is not None)
+        previous, self._lastRequirement = self._lastRequirement, total
+        change = 0.0 if previous is None else abs(total - previous) / float(max(previous, 1))
+
+        if transient > 0 or change > self.volatilityThreshold:
+            interval = self.manageInterval / 2.0
+        else:
+            interval = self.manageInterval * 1.5
+        interval = min(max(interval, self.minManageInterval), self.maxManageInterval)
+        # the remote calls of the last cycle, i.e. prefetch queries and inline queries (see AdapterBase.remoteCall)
+        if self.remoteCallBudget:
+            interval = max(interval, self._remoteCalls * 3600.0 / self.remoteCallBudget)
+
+        if interval != self.manageInterval:
+            logger.debug("Management interval %.1fs (requirement change %.0f%%, %d machines in transition)."
+                         % (interval, change * 100, transient))
+        self.manageInterval = interval
+        if self.ticks is not None:
+            self.ticks.interval = interval
+        return interval
+
+    def recordRemoteCalls(self):
+        # type: () -> int
+        """Add the inline remote calls of the adapters to the calls of this cycle, return their number."""
+        for adapter in self.adapters:
+            self._remoteCalls += adapter.remoteCalls
+            adapter.remoteCalls = 0
+        now = time.time()
+        self._remoteCallLog.append((now, self._remoteCalls))
+        while self._remoteCallLog and self._remoteCallLog[0][0] < now - 3600:
+            self._remoteCallLog.popleft()
+        return self._remoteCalls
+
+    def _wakeUpAllowed(self):
+        # type: () -> bool
+        """False if an early cycle, with the remote calls of the last one, would exceed the budget of the last hour."""
+        if not self.remoteCallBudget:
+            return True
+        log = list(self._remoteCallLog)
+        calls = sum(calls for _, calls in log)
+        if not log or calls + log[-1][1] <= self.remoteCallBudget:
+            return True
+        logger.warning("Wake-up ignored, %d remote calls within the last hour (budget %d)."
+                       % (calls, self.remoteCallBudget))
+        return False
+
+    @property
+    def ticks(self):
+        # type: () -> FixedRateTicks
+        """Ticks of the management cycles and their statistics, None if not scheduled."""
+        return self.scheduler.ticks if self.scheduler is not None else None
 
     def startManagementTimer(self):
-        t = Timer(self.manageInterval, self.startManage)
-        t.start()
+        """Schedule the following cycles at a fixed rate, aligned to the start of the current one."""
+        if self.scheduler is None:
+            self.scheduler = FixedRateScheduler(self.manageInterval, self.startManage, "ManagementScheduler")
+        if not self.scheduler.running:
+            self.scheduler.interval = self.manageInterval
+            self.scheduler.start((self._cycleStart or time.time()) + self.manageInterval)
+
+    def wakeUp(self):
+        # type: () -> bool
+        """Start a management cycle early (RPC API), e.g. on job submission or a pushed requirement.
+
+        Wake-ups within wakeUpDebounce seconds lead to a single cycle. Wake-ups are ignored while
+        another cycle would exceed remoteCallBudget.
+        """
+        if self.scheduler is None or not self.scheduler.running or not self._wakeUpAllowed():
+            return False
+        logger.debug("Wake-up, next cycle in %ss." % self.wakeUpDebounce)
+        self.scheduler.trigger(self.wakeUpDebounce)
+        return True
+
+    def stopManagementTimer(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
 
     def startManage(self):
+        self.beginCycle()
+
+        with CycleTimingLog.measure("prefetch"):
+            self.prefetch()
+
+        # regular management
+        with CycleTimingLog.measure("manage_requirement"):
+            self.reqBox.manage()
+        with CycleTimingLog.measure("manage_site"):
+            self.siteBox.manage()
+        with CycleTimingLog.measure("manage_integration"):
+            self.intBox.manage()
+
+        requirement, decision, aggregate = self.decide()
+        with CycleTimingLog.measure("apply_decision"):
+            results = self.siteBox.applyMachineDecision(decision, aggregate)
+        lastIteration = self.finishCycle(requirement, results)
+
+        if self.autoRun is True and lastIteration is False:
+            self.startManagementTimer()
+        else:
+            self.stopManagementTimer()
+
+    def beginCycle(self):
+        """Start a management cycle: apply the results of asynchronous event handlers and tasks."""
+        self._cycleStart = time.time()
+        self._remoteCalls = 0
         logger.info("----------------------------------")
         logger.info("Management cycle triggered")
         logger.info("Time: %s" % datetime.today().strftime("%Y-%m-%d %H:%M:%S"))
 
-        # regular management
-        self.reqBox.manage()
-        self.siteBox.manage()
-        self.intBox.manage()
+        # results of asynchronous event handlers (e.g. finished integrations)
+        with CycleTimingLog.measure("async_results"), self.mr.batch():
+            self.mr.processAsyncResults()
 
+    def decide(self):
+        # type: () -> tuple
+        """Let the broker decide on the machines per site, after the adapters were managed.
+
+        :return: (requirement, absolute decision {siteName: {machine_type: count}}, registry aggregate)
+        """
         # scaling
-        mReq = self.reqBox.getMachineTypeRequirement()
+        with CycleTimingLog.measure("get_requirement"):
+            mReq = self.reqBox.getMachineTypeRequirement()
         logger.info("Current requirement: %s" % mReq)
 
         siteInfo = self.siteBox.siteInformation
-        runningBySite = self.siteBox.runningMachinesCount
+        # machine counts of this cycle, shared by broker and sites
+        aggregate = self.mr.aggregate()
+        runningBySite = self.siteBox.getRunningMachinesCount(aggregate)
 
         # contains a list of all machine types merged
         runningOverall = summarize_dicts(list(runningBySite.values()))
@@ -146,10 +357,12 @@ class ScaleCore(object):
             if not key_ in machStat:
                 machStat[key_] = MachineStatus(mReq.get(key_, 0), 0)
 
-        decision = self.broker.decide(machStat, siteInfo.values())
+        with CycleTimingLog.measure("broker_decide"):
+            decision = self.broker.decide(machStat, siteInfo.values(), aggregate=aggregate)
 
         # Service machines may modify site decision(s).
-        decision = self.siteBox.modServiceMachineDecision(decision)
+        with CycleTimingLog.measure("service_machine_decision"):
+            decision = self.siteBox.modServiceMachineDecision(decision)
 
         logger.info("Decision: %s" % decision)
 
@@ -158,24 +371,66 @@ class ScaleCore(object):
             for kmach in vmach:
                 decision[ksite][kmach] += runningBySite[ksite].get(kmach, [])
         logger.info("Absolute Decision: %s" % decision)
+        return mReq, decision, aggregate
 
-        self.siteBox.applyMachineDecision(decision)
+    def finishCycle(self, requirement, results):
+        # type: (dict, dict) -> bool
+        """Log and persist the outcome of a cycle. Return True if it was the last iteration.
 
-        logger.info(self.mr.getMachineOverview())
+        :param results: {siteName: SiteApplyResult} of applying the decision
+        """
+        for siteName, result in results.items():
+            JsonLog.addItem(siteName, "machines_launched", sum(result.launched.values()))
 
-        MachineRegistryLogger.dump(self.mr.machines)
+        logger.info(self.mr.getMachineOverview())
 
-        log = JsonLog()
-        log.writeLog()
+        eventStats = self.mr.eventStatistics(reset=True)
+        if eventStats["events"]:
+            slowest = sorted(eventStats["handlers"].items(), key=lambda item: item[1][1], reverse=True)[:3]
+            logger.debug("Events: %s (max. cascade depth %d, %d dropped), slowest handlers: %s" %
+                         (eventStats["events"], eventStats["max_depth"], eventStats["dropped"],
+                          ", ".join("%s (%d calls, %.3fs)" % (name, calls, duration)
+                                    for name, (calls, duration) in slowest)))
+
+        if self.manageIterations % self.snapshotInterval == 0:
+            changes = self.mr.checkpoint(self.consumerPersistence)
+            if changes.changed:
+                logger.debug("Machine registry changes: %d created, %d modified, %d removed."
+                             % (len(changes.created), len(changes.modified), len(changes.removed)))
+                with CycleTimingLog.measure("registry_dump"):
+                    MachineRegistryLogger.dump(*self.mr.journaledSnapshot())
+        MachineHistoryLogger.write()
+
+        self.recordRemoteCalls()
+        if self.adaptiveInterval is True:
+            self.adaptInterval(requirement)
+            JsonLog.addItem("timing", "management_interval", self.manageInterval)
+
+        # writing the JSON log is reported with the next cycle
+        CycleTimingLog.add("cycle", time.time() - self._cycleStart)
+        CycleTimingLog.writeLog()
+        with CycleTimingLog.measure("json_log"):
+            log = JsonLog()
+            log.writeLog()
+
+        # prefetched results are only valid during a cycle
+        for adapter in self.adapters:
+            adapter.prefetched.clear()
+            adapter.prefetchPending.clear()
 
         self.manageIterations += 1
 
+        ticks = self.ticks
+        if ticks is not None:
+            jitter = ticks.jitterStatistics()
+            logger.debug("Cycle took %.2fs, jitter %.3fs (max. %.3fs), %d overrun(s), %d tick(s) skipped."
+                         % (time.time() - self._cycleStart, jitter["mean"], jitter["max"],
+                            ticks.overruns, ticks.skippedTicks))
+
         lastIteration = False
         if self.maximumManageIterations is not None:
             lastIteration = self.maximumManageIterations <= self.manageIterations
-
-        if self.autoRun is True and lastIteration is False:
-            self.startManagementTimer()
+        return lastIteration
 
     @property
     def description(self):
@@ -220,8 +475,20 @@ class ScaleCoreFactory(object):
         if configuration.has_option(Config.GeneralSection, Config.GeneralManagementInterval):
             interval = configuration.getint(Config.GeneralSection, Config.GeneralManagementInterval)
 
-        sc = ScaleCore(cls._getBroker(configuration),
-                       None,
+        # local XML-RPC server to push requirements and wake up the core
+        rpcServer = None
+        if configuration.has_option(Config.GeneralSection, Config.GeneralRpcPort):
+            rpcServer = LocalRpcServer(configuration.getint(Config.GeneralSection, Config.GeneralRpcPort))
+
+        coreClass = ScaleCore
+        if configuration.has_option(Config.GeneralSection, Config.GeneralAsyncCore) and \
+                configuration.getboolean(Config.GeneralSection, Config.GeneralAsyncCore):
+            # asyncio variant, requires Python 3.5+
+            from .AsyncCore import AsyncScaleCore
+            coreClass = AsyncScaleCore
+
+        sc = coreClass(cls._getBroker(configuration),
+                       rpcServer,
                        cls._getReqAdapterList(configuration),
                        cls._getSiteAdapterList(configuration),
                        cls._getIntAdapterList(configuration),
@@ -229,6 +496,57 @@ class ScaleCoreFactory(object):
                        maximumManageIterations=maximumInterval)
 
         sc.manageInterval = interval
+        if configuration.has_option(Config.GeneralSection, Config.GeneralAdaptiveInterval):
+            sc.adaptiveInterval = configuration.getboolean(Config.GeneralSection, Config.GeneralAdaptiveInterval)
+        # default bounds: a quarter to four times the configured interval
+        sc.minManageInterval = interval / 4.0
+        sc.maxManageInterval = interval * 4.0
+        if configuration.has_option(Config.GeneralSection, Config.GeneralMinManagementInterval):
+            sc.minManageInterval = configuration.getfloat(Config.GeneralSection, Config.GeneralMinManagementInterval)
+        if configuration.has_option(Config.GeneralSection, Config.GeneralMaxManagementInterval):
+            sc.maxManageInterval = configuration.getfloat(Config.GeneralSection, Config.GeneralMaxManagementInterval)
+        if configuration.has_option(Config.GeneralSection, Config.GeneralRemoteCallBudget):
+            sc.remoteCallBudget = configuration.getint(Config.GeneralSection, Config.GeneralRemoteCallBudget)
+        if configuration.has_option(Config.GeneralSection, Config.GeneralWakeUpDebounce):
+            sc.wakeUpDebounce = configuration.getfloat(Config.GeneralSection, Config.GeneralWakeUpDebounce)
+        if configuration.has_option(Config.GeneralSection, Config.GeneralSnapshotInterval):
+            sc.snapshotInterval = configuration.getint(Config.GeneralSection, Config.GeneralSnapshotInterval)
+
+        timeout = None
+        if configuration.has_option(Config.GeneralSection, Config.GeneralAdapterTimeout):
+            timeout = configuration.getfloat(Config.GeneralSection, Config.GeneralAdapterTimeout)
+        # queries still running are used by a later cycle, so a cycle waits at most an interval by default
+        sc.prefetchTimeout = interval
+        if configuration.has_option(Config.GeneralSection, Config.GeneralPrefetchTimeout):
+            sc.prefetchTimeout = configuration.getfloat(Config.GeneralSection, Config.GeneralPrefetchTimeout)
+
+        # opt-in: spawn/terminate on all sites at once
+        if configuration.has_option(Config.GeneralSection, Config.GeneralConcurrentApply):
+            sc.siteBox.concurrentApply = configuration.getboolean(Config.GeneralSection,
+                                                                 Config.GeneralConcurrentApply)
+
+        # opt-in: manage site adapters in worker processes
+        if configuration.has_option(Config.GeneralSection, Config.GeneralIsolateSiteAdapters):
+            sc.siteBox.isolated = configuration.getboolean(Config.GeneralSection,
+                                                          Config.GeneralIsolateSiteAdapters)
+        if configuration.has_option(Config.GeneralSection, Config.GeneralIsolationDeadline):
+            sc.siteBox.isolationDeadline = configuration.getfloat(Config.GeneralSection,
+                                                                 Config.GeneralIsolationDeadline)
+
+        # bounds concurrent manage and apply
+        for box in (sc.reqBox, sc.siteBox, sc.intBox):
+            box.adapterTimeout = timeout
+
+        # opt-in: manage adapters of a box concurrently
+        if configuration.has_option(Config.GeneralSection, Config.GeneralConcurrentManage):
+            concurrent = configuration.getboolean(Config.GeneralSection, Config.GeneralConcurrentManage)
+            for box in (sc.reqBox, sc.siteBox, sc.intBox):
+                box.concurrent = concurrent
+
+        # fork worker processes before any other thread runs
+        sc.siteBox.startWorkers()
+        if rpcServer is not None:
+            rpcServer.start()
 
         return sc
 
@@ -274,6 +592,8 @@ class ScaleCoreFactory(object):
             obj.loadConfigValue(obj.compulsoryConfigKeys, configuration, False, adapter, obj)
             # transfer optional config
             obj.loadConfigValue(obj.optionalConfigKeys, configuration, True, adapter, obj)
+            if configuration.has_option(adapter, Config.ConfigManageTimeout):
+                obj.manageTimeout = configuration.getfloat(adapter, Config.ConfigManageTimeout)
 
             adapters.append(obj)
 
@@ -21,19 +21,26 @@
 from __future__ import unicode_literals, absolute_import
 
 import logging
+import threading
+import time
 
 import configparser
+import xmlrpc.client
 
 from RequirementAdapter.RequirementTest import RequirementAdapterTest
-from SiteAdapter.Site import SiteAdapterBase, SiteInformation
+from SiteAdapter.Site import SiteAdapterBase, SiteBox, SiteInformation
+from Util.Concurrency import FixedRateScheduler, FixedRateTicks
+from Util.Logging import CycleTimingLog
 from . import Config
 from . import ScaleTest
+from .Adapter import PrefetchPending
 from .Broker import StupidBroker, SiteBrokerBase
 from .Core import MachineStatus, ScaleCore, ScaleCoreFactory
+from .RpcServer import LocalRpcServer
 
 
 class SiteBrokerTest(SiteBrokerBase):
-    def decide(self, machineTypes, siteInfo):
+    def decide(self, machineTypes, siteInfo, aggregate=None):
         pass
 
 
@@ -59,6 +66,68 @@ class SiteAdapterTest(SiteAdapterBase):
         self.setConfig(self.ConfigSiteName, value_)
 
 
+class PrefetchSiteAdapterTest(SiteAdapterTest):
+    def __init__(self):
+        super(PrefetchSiteAdapterTest, self).__init__()
+        # queries wait for the other sites' queries (if set) and for release
+        self.rendezvous = None
+        self.release = threading.Event()
+        self.release.set()
+
+    @property
+    def prefetchQueries(self):
+        return {"machines": self.queryMachines}
+
+    def queryMachines(self):
+        if self.rendezvous is not None:
+            self.rendezvous.wait()
+        self.release.wait(5)
+        return [self.siteName]
+
+
+class SpawningSiteAdapterTest(SiteAdapterTest):
+    def __init__(self, siteName, capacity):
+        super(SpawningSiteAdapterTest, self).__init__()
+        self.siteName = siteName
+        self.setConfig(self.ConfigMachines, {"machine1": {}})
+        self.capacity = capacity
+        # spawns and manage calls wait for those of the other sites, if set
+        self.rendezvous = None
+
+    def spawnMachines(self, machineType, count):
+        if self.rendezvous is not None:
+            self.rendezvous.wait()
+        for _ in range(min(count, self.capacity)):
+            mid = self.mr.newMachine()
+            self.mr.update(mid, {self.mr.regSite: self.siteName, self.mr.regMachineType: machineType})
+
+
+class RequestingSiteAdapterTest(SiteAdapterTest):
+    def __init__(self, siteName):
+        super(RequestingSiteAdapterTest, self).__init__()
+        self.siteName = siteName
+        self.setConfig(self.ConfigMachines, {"machine1": {}, "broken": {}})
+        self.setConfig(self.ConfigAsyncSpawn, True)
+        # requests wait for this, to check the state while they are running
+        self.release = threading.Event()
+
+    def spawnMachines(self, machineType, count):
+        self.requestMachines(machineType, count)
+
+    def requestMachine(self, machineType, mid):
+        self.release.wait(5)
+        if machineType == "broken":
+            raise ValueError("quota exceeded")
+        return {"vm_id": "vm-" + mid}
+
+
+class SlowSiteAdapterTest(SpawningSiteAdapterTest):
+    def manage(self):
+        if self.rendezvous is not None:
+            self.rendezvous.wait()
+        self.managed = True
+
+
 class ScaleCoreTestBase(ScaleTest.ScaleTestBase):
     def getDefaultSiteInfo(self):
         sinfo = [SiteInformation(), SiteInformation()]
@@ -130,7 +199,7 @@ class ScaleCoreTest(ScaleCoreTestBase):
     def test_manage(self):
         logging.debug("=======Testing Management=======")
         broker = SiteBrokerTest()
-        broker.decide = lambda machineTypes, siteInfo: dict({"site1": dict({"machine1": 1})})
+        broker.decide = lambda machineTypes, siteInfo, aggregate=None: dict({"site1": dict({"machine1": 1})})
 
         req = RequirementAdapterTest()
         req.requirement = 1
@@ -147,6 +216,291 @@ class ScaleCoreTest(ScaleCoreTestBase):
 
         sc = ScaleCore(broker, None, [req, req], [site1, site2], [], False)
 
+    def test_prefetch(self):
+        logging.debug("=======Testing Prefetch=======")
+        sites = [PrefetchSiteAdapterTest() for _ in range(3)]
+        for i, site in enumerate(sites):
+            site.siteName = "site%d" % i
+        sc = ScaleCore(SiteBrokerTest(), None, [], sites, [], False)
+
+        # queries run in parallel, otherwise they couldn't wait for each other
+        rendezvous = ScaleTest.Rendezvous(len(sites))
+        for site in sites:
+            site.rendezvous = rendezvous
+        sc.prefetch()
+        for site in sites:
+            site.rendezvous = None
+            self.assertEqual(site.getPrefetched("machines", lambda: None), [site.siteName])
+
+        # without prefetched result, the query is run directly
+        sites[0].prefetched.clear()
+        self.assertEqual(sites[0].getPrefetched("machines", sites[0].queryMachines), ["site0"])
+
+        # queries exceeding the timeout are not started again in the next cycle, nor run by the adapter:
+        # it gets the previous result, or its manage is skipped without one
+        sc.prefetchTimeout = 0.05
+        fresh = PrefetchSiteAdapterTest()
+        fresh.siteName = "site3"
+        fresh.manage = lambda: self.fail("manage while its query is running")
+        sc.siteBox.addAdapter(fresh)
+        [site.prefetched.clear() for site in sites]
+        [site.release.clear() for site in sites + [fresh]]
+        sc.prefetch()
+        self.assertEqual(len(sc._prefetchTasks), 4)
+        self.assertEqual(sites[0].prefetched, {"machines": ["site0"]})
+        self.assertEqual(fresh.prefetchPending, {"machines"})
+        self.assertRaises(PrefetchPending, fresh.getPrefetched, "machines", fresh.queryMachines)
+        sc.siteBox.manage()
+        [site.release.set() for site in sites + [fresh]]
+        self.assertTrue(ScaleTest.waitUntil(lambda: all(task.done for task in sc._prefetchTasks.values())))
+        fresh.prefetchPending.clear()
+        sc.prefetch()
+        self.assertEqual(sc._prefetchTasks, {})
+        self.assertEqual(sites[1].prefetched["machines"], ["site1"])
+        self.assertEqual(fresh.prefetched["machines"], ["site3"])
+
+    def test_scheduler(self):
+        logging.debug("=======Testing Scheduler=======")
+        calls = []
+        done = threading.Event()
+        # margins are half an interval, so a loaded machine doesn't fail the test
+        interval = 0.4
+
+        def cycle():
+            calls.append(time.time())
+            if len(calls) == 2:
+                # overrun by 2.5 intervals: the two ticks passing meanwhile are skipped
+                time.sleep(2.5 * interval)
+            if len(calls) == 4:
+                scheduler.stop()
+                done.set()
+
+        start = time.time()
+        scheduler = FixedRateScheduler(interval, cycle)
+        scheduler.start(start + interval)
+        self.assertTrue(done.wait(10))
+        self.assertFalse(scheduler.running)
+
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(scheduler.overruns, 1)
+        self.assertEqual(scheduler.skippedTicks, 2)
+        # calls stay on the ticks start + n * interval, never early
+        for call, tick in zip(calls, (1, 2, 5, 6)):
+            self.assertGreaterEqual(call, start + tick * interval)
+            self.assertLess(call, start + (tick + 0.5) * interval)
+        self.assertLess(scheduler.jitterStatistics()["max"], interval / 2)
+
+    def test_ticks(self):
+        logging.debug("=======Testing Fixed-Rate Ticks=======")
+        ticks = FixedRateTicks(10)
+        start = time.time() - 25
+        ticks.start(start)
+        self.assertEqual(ticks.nextTick, start)
+        # the call of the first tick ends 25s after it: the 2 ticks passed meanwhile are skipped
+        self.assertEqual(ticks.begin(), start)
+        ticks.finish(start)
+        self.assertEqual((ticks.overruns, ticks.skippedTicks), (1, 2))
+        self.assertEqual(ticks.nextTick, start + 3 * 10)
+        self.assertGreaterEqual(ticks.jitterStatistics()["max"], 25)
+
+        # debounced trigger: the earliest one wins, the ticks continue from it
+        ticks.start(time.time() + 100)
+        ticks.trigger(5)
+        ticks.trigger(1)
+        ticks.trigger(5)
+        triggered = ticks.nextTick
+        self.assertLess(triggered - time.time(), 2)
+        self.assertEqual(ticks.begin(), triggered)
+        ticks.finish(triggered)
+        self.assertAlmostEqual(ticks.nextTick, triggered + 10)
+
+    def test_timing(self):
+        logging.debug("=======Testing Cycle Timing=======")
+        CycleTimingLog.clear()
+        for duration in range(1, 101):
+            CycleTimingLog.add("phase", duration / 2.0)
+            CycleTimingLog.add("phase", duration / 2.0)
+            CycleTimingLog.writeLog()
+        self.assertEqual(CycleTimingLog.percentiles("phase"), {"p50": 50, "p90": 90, "p99": 99, "max": 100})
+
+        # rolling window
+        CycleTimingLog.add("phase", 1000)
+        CycleTimingLog.writeLog()
+        self.assertEqual(CycleTimingLog.percentiles("phase")["p50"], 51)
+
+        with CycleTimingLog.measure("sleep"):
+            time.sleep(0.05)
+        CycleTimingLog.writeLog()
+        self.assertGreaterEqual(CycleTimingLog.percentiles("sleep")["max"], 0.05)
+        CycleTimingLog.clear()
+
+    def test_adaptInterval(self):
+        logging.debug("=======Testing Adaptive Interval=======")
+        sc = ScaleCore(SiteBrokerTest(), None, [], [], [], False)
+        sc.mr.clear()
+        sc.manageInterval, sc.minManageInterval, sc.maxManageInterval = 40, 10, 100
+
+        # steady: back off up to the maximum
+        self.assertEqual(sc.adaptInterval({"machine1": 10}), 60)
+        self.assertEqual(sc.adaptInterval({"machine1": 10}), 90)
+        self.assertEqual(sc.adaptInterval({"machine1": 10}), 100)
+        # jump in demand: tighten down to the minimum
+        self.assertEqual(sc.adaptInterval({"machine1": 100}), 50)
+        # machines in transition
+        sc.mr.newMachine("1")
+        sc.mr.updateMachineStatus("1", sc.mr.statusBooting)
+        self.assertEqual(sc.adaptInterval({"machine1": 100}), 25)
+        self.assertEqual(sc.adaptInterval({"machine1": 100}), 12.5)
+        self.assertEqual(sc.adaptInterval({"machine1": 100}), 10)
+        # 10 remote calls per cycle, at most 1800 per hour
+        sc._remoteCalls, sc.remoteCallBudget = 10, 1800
+        self.assertEqual(sc.adaptInterval({"machine1": 100}), 20)
+        sc.mr.clear()
+
+    def test_remoteCallBudget(self):
+        logging.debug("=======Testing Remote Call Budget=======")
+        req = RequirementAdapterTest()
+        sc = ScaleCore(SiteBrokerTest(), None, [req], [], [], False)
+        sc.remoteCallBudget = 10
+        sc.scheduler = FixedRateScheduler(100, lambda: None)
+        sc.scheduler.start()
+        try:
+            # inline queries count as well as prefetched ones
+            sc.beginCycle()
+            sc._remoteCalls += 2
+            self.assertEqual(req.getPrefetched("query", lambda: 1), 1)
+            req.prefetched["query"] = 1
+            self.assertEqual(req.getPrefetched("query", lambda: 2), 1)
+            self.assertEqual(sc.recordRemoteCalls(), 3)
+            self.assertEqual(req.remoteCalls, 0)
+            self.assertTrue(sc.wakeUp())
+            # a further cycle would exceed the budget
+            sc.beginCycle()
+            sc._remoteCalls += 4
+            self.assertEqual(sc.recordRemoteCalls(), 4)
+            self.assertFalse(sc.wakeUp())
+            # cycles older than an hour don't count
+            sc._remoteCallLog[0] = (time.time() - 3601, 3)
+            sc.beginCycle()
+            sc.recordRemoteCalls()
+            self.assertEqual(list(calls for _, calls in sc._remoteCallLog), [4, 0])
+            self.assertTrue(sc.wakeUp())
+        finally:
+            sc.scheduler.stop()
+
+    def test_wakeUp(self):
+        logging.debug("=======Testing Wake-Up=======")
+        server = LocalRpcServer(0)
+        server.start()
+        req = RequirementAdapterTest()
+        sc = ScaleCore(SiteBrokerTest(), server, [req], [], [], False)
+        sc.exportMethod(sc.wakeUp, "wakeUp")
+        sc.wakeUpDebounce = 0.1
+        calls = []
+        sc.scheduler = FixedRateScheduler(100, lambda: calls.append(req.requirement))
+
+        client = xmlrpc.client.ServerProxy("http://localhost:%d" % server.server_address[1])
+        self.assertFalse(client.wakeUp())
+        sc.scheduler.start()
+        try:
+            # pushing a requirement wakes the core up, debounced: a single early cycle
+            [self.assertTrue(client.RequirementAdapterTest_setRequirement(7)) for _ in range(3)]
+            self.assertTrue(ScaleTest.waitUntil(lambda: calls))
+            self.assertEqual(calls, [7])
+            self.assertGreater(sc.scheduler.nextTick - time.time(), 90)
+        finally:
+            sc.scheduler.stop()
+            server.stop()
+
+    def test_applyConcurrently(self):
+        logging.debug("=======Testing Concurrent Decision Application=======")
+        box = SiteBox()
+        SiteAdapterBase.mr.clear()
+        box.concurrentApply = True
+        sites = [SpawningSiteAdapterTest("site1", 0), SpawningSiteAdapterTest("site2", 5)]
+        box.addAdapterList(sites)
+
+        # sites spawn at once, otherwise they couldn't wait for each other
+        rendezvous = ScaleTest.Rendezvous(len(sites))
+        for site in sites:
+            site.rendezvous = rendezvous
+        results = box.applyMachineDecision({"site1": {"machine1": 2}, "site2": {"machine1": 3}})
+        for site in sites:
+            site.rendezvous = None
+        self.assertEqual(results["site1"].requested, {"machine1": 2})
+        self.assertEqual(results["site1"].launched, {})
+        self.assertTrue(results["site1"].failed)
+        self.assertEqual(results["site2"].launched, {"machine1": 3})
+        self.assertFalse(results["site2"].failed)
+
+        # the failing site is tried last, until it recovers
+        siteInfo = box.siteInformation
+        self.assertEqual((siteInfo["site1"].spawnFailures, siteInfo["site2"].spawnFailures), (1, 0))
+        siteInfo["site1"].cost, siteInfo["site2"].cost = 0, 1
+        broker = StupidBroker()
+        orders = broker.decide({"machine1": MachineStatus(4, 3)}, siteInfo.values())
+        self.assertEqual(orders, {"site2": {"machine1": 1}})
+        box.applyMachineDecision({})
+        self.assertEqual(box.siteInformation["site1"].spawnFailures, 0)
+
+        # a hanging site fails the cycle, its changes are committed in a later one
+        box.adapterTimeout = 0.1
+        release = threading.Event()
+        spawnMachines = sites[1].spawnMachines
+        sites[1].spawnMachines = lambda machineType, count: (release.wait(5), spawnMachines(machineType, count))
+        results = box.applyMachineDecision({"site2": {"machine1": 1}})
+        self.assertFalse(results["site1"].failed)
+        self.assertTrue(results["site2"].failed)
+        self.assertEqual(box.siteInformation["site2"].spawnFailures, 1)
+        release.set()
+        self.assertTrue(ScaleTest.waitUntil(lambda: SiteAdapterBase.mr.countMachines(site="site2") == 4))
+        results = box.applyMachineDecision({})
+        self.assertEqual(results["site2"].launched, {"machine1": 1})
+        self.assertEqual(box.siteInformation["site2"].spawnFailures, 0)
+        SiteAdapterBase.mr.clear()
+
+    def test_requestMachines(self):
+        logging.debug("=======Testing Asynchronous Spawns=======")
+        site = RequestingSiteAdapterTest("site1")
+        box = SiteBox()
+        box.addAdapterList([site])
+        mr = site.mr
+        mr.clear()
+
+        results = box.applyMachineDecision({"site1": {"machine1": 2}})
+        results.update(box.applyMachineDecision({"site1": {"machine1": 2, "broken": 1}}))
+        # running requests count as running machines, but nothing is in the registry yet
+        self.assertEqual(site.countRunningMachines(), {"machine1": 2, "broken": 1})
+        self.assertEqual(site.countRunningMachines(mr.aggregate()), {"machine1": 2, "broken": 1})
+        self.assertEqual(mr.machines, {})
+        self.assertEqual(results["site1"].requested, {"broken": 1})
+        self.assertEqual((results["site1"].launched, results["site1"].pending), ({}, {"broken": 1}))
+        self.assertFalse(results["site1"].failed)
+        self.assertEqual(box.siteInformation["site1"].spawnFailures, 0)
+
+        site.release.set()
+        self.assertTrue(mr.waitForAsyncTasks(5))
+        mr.processAsyncResults()
+        self.assertEqual(site.spawnOperations, {})
+        self.assertEqual(mr.countRequests(), {})
+        machines = site.getSiteMachines()
+        self.assertEqual(len(machines), 2)
+        for mid, machine in machines.items():
+            self.assertEqual(machine["vm_id"], "vm-" + mid)
+            self.assertEqual(machine[mr.regMachineType], "machine1")
+            self.assertEqual(machine[mr.regStatus], mr.statusBooting)
+        # the failed request is seen in the next cycle
+        box.applyMachineDecision({"site1": {"machine1": 2}})
+        self.assertEqual(box.siteInformation["site1"].spawnFailures, 1)
+
+        # synchronous requests complete right away and stop at the first failure
+        site.setConfig(site.ConfigAsyncSpawn, False)
+        self.assertEqual(len(site.requestMachines("broken", 2)), 1)
+        operations = site.requestMachines("machine1", 1)
+        self.assertTrue(operations[0].done)
+        self.assertEqual(len(site.getSiteMachines()), 3)
+        mr.clear()
+
 
 class StupidBrokerTest(ScaleCoreTestBase):
     def test_decide(self):
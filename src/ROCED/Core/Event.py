@@ -21,7 +21,13 @@
 from __future__ import unicode_literals
 
 import abc
+import itertools
 import logging
+import threading
+import time
+from collections import Counter, deque
+
+from Util.Concurrency import WorkerPool
 
 
 class EventBase(object):
@@ -36,25 +42,211 @@ class EventBase(object):
 class EventPublisher(object):
     __metaclass__ = abc.ABCMeta
 
+    # Events published by handlers are queued and dispatched after the current one (breadth-first).
+    # Events further down a cascade than this are dropped.
+    maxCascadeDepth = 32
+    # threads running asynchronous handlers
+    workerThreads = 8
+
     def __init__(self):
         """(Abstract) Event manager. Registers listeners and publishes events."""
         pass
 
     def init(self):
-        self.__listener = []
+        # (event type, site, new status) -> [(registration number, handler, name, async options)],
+        # None matches everything
+        self.__subscriptions = {}
+        # (event type, site, new status) of published events -> handlers, rebuilt after (un)subscribing
+        self.__dispatch = {}
+        self.__registrations = itertools.count()
+        # event queue of the cascade being dispatched by this thread
+        self.__local = threading.local()
+        self.__statsLock = threading.Lock()
+        self.__stats = self.__newStatistics()
+        # runs asynchronous handlers, threads are started on demand
+        self.__workers = WorkerPool(self.workerThreads)
 
     def publishEvent(self, evt):
         # type: (EventBase) -> None
-        [listener.onEvent(evt) for listener in self.__listener]
+        """Dispatch an event to the subscribed handlers.
+
+        If called by a handler, the event is queued and dispatched once all handlers of the current
+        event ran. An event re-occurring within the same cascade (same type, machine and status) is
+        considered a loop and dropped.
+        """
+        queue = getattr(self.__local, "queue", None)
+        if queue is not None:
+            queue.append((evt, self.__local.depth + 1))
+            return
+
+        self.__local.queue = queue = deque(((evt, 0),))
+        seen = set()
+        try:
+            while queue:
+                evt, depth = queue.popleft()
+                if depth > self.maxCascadeDepth:
+                    logging.error("Dropping event %s: event cascade deeper than %d." % (type(evt).__name__,
+                                                                                        self.maxCascadeDepth))
+                    self.__count(dropped=1)
+                    continue
+                key = self.__loopKey(evt)
+                if key is not None:
+                    if key in seen:
+                        logging.warning("Dropping event %s for %s: event loop detected." % (type(evt).__name__,
+                                                                                          key[1]))
+                        self.__count(dropped=1)
+                        continue
+                    seen.add(key)
+                self.__local.depth = depth
+                self.__count(evt=evt, depth=depth)
+                for handler, name, options in self.__handlers(evt):
+                    if options is not None:
+                        self.submitTask(handler, (evt,), name, *options)
+                        continue
+                    start = time.time()
+                    try:
+                        handler(evt)
+                    finally:
+                        self.__count(handler=name, duration=time.time() - start)
+        finally:
+            if queue:
+                logging.warning("Discarding %d queued event(s) after failed event handler." % len(queue))
+            self.__local.queue = None
+
+    @staticmethod
+    def __loopKey(evt):
+        mid = getattr(evt, "id", None)
+        if mid is None:
+            return None
+        return type(evt), mid, getattr(evt, "newStatus", None)
+
+    def __count(self, evt=None, depth=0, dropped=0, handler=None, duration=0.0):
+        with self.__statsLock:
+            stats = self.__stats
+            if evt is not None:
+                stats["events"][type(evt).__name__] += 1
+                stats["max_depth"] = max(stats["max_depth"], depth)
+            stats["dropped"] += dropped
+            if handler is not None:
+                calls, total = stats["handlers"].get(handler, (0, 0.0))
+                stats["handlers"][handler] = (calls + 1, total + duration)
+
+    def eventStatistics(self, reset=False):
+        # type: (bool) -> dict
+        """Return events published per type, handler calls and time spent per handler (calls, seconds),
+        the deepest cascade and the number of dropped events since the last reset."""
+        with self.__statsLock:
+            stats = self.__stats
+            if reset:
+                self.__stats = self.__newStatistics()
+            return {"events": dict(stats["events"]), "handlers": dict(stats["handlers"]),
+                    "max_depth": stats["max_depth"], "dropped": stats["dropped"]}
+
+    @staticmethod
+    def __newStatistics():
+        return {"events": Counter(), "handlers": {}, "max_depth": 0, "dropped": 0}
+
+    def __handlers(self, evt):
+        site = getattr(evt, "site", None)
+        newStatus = getattr(evt, "newStatus", None)
+        key = (type(evt), site, newStatus)
+        try:
+            return self.__dispatch[key]
+        except KeyError:
+            pass
+        matches = []
+        for eventType in type(evt).__mro__:
+            for site_ in {site, None}:
+                for newStatus_ in {newStatus, None}:
+                    matches.extend(self.__subscriptions.get((eventType, site_, newStatus_), ()))
+        handlers = [entry[1:] for entry in sorted(matches, key=lambda match: match[0])]
+        self.__dispatch[key] = handlers
+        return handlers
+
+    def subscribe(self, listener, eventType=None, site=None, newStatus=None,
+                  asynchronous=False, maxConcurrent=None, timeout=None, onTimeout=None, onError=None):
+        """Subscribe to events of a type (including subclasses), optionally of one site and new status only.
+
+        The listener is either a callable or an object with an "onEvent" method. Criteria left at None
+        match every event. Handlers are called in the order they subscribed.
+
+        Asynchronous handlers (for slow remote calls) run on a worker thread, at most "maxConcurrent" at
+        once. They may return a callable, which is called by "processAsyncResults" on the publishing
+        thread, e.g. to apply a status change. Results arriving after "timeout" seconds are discarded,
+        "onTimeout(event)" is called instead. If the handler raises, "onError(event, exception)" is called.
+        Both are called by "processAsyncResults" as well, e.g. to retry or give up the machine.
+        """
+        handler = getattr(listener, "onEvent", listener)
+        if not callable(handler):
+            logging.error("Can't subscribe listener %s. Method \"onEvent\" is missing."
+                          % type(listener).__name__)
+            return
+        key = (eventType or object, site, newStatus)
+        handlers = self.__subscriptions.setdefault(key, [])
+        if any(entry[1] == handler for entry in handlers):
+            return
+        logging.info("Subscribing event listener %s to %s events (site %s, status %s)."
+                     % (type(listener).__name__, key[0].__name__, site, newStatus))
+        owner = getattr(handler, "__self__", None)
+        name = getattr(handler, "__name__", type(handler).__name__)
+        if owner is not None:
+            name = "%s.%s" % (type(owner).__name__, name)
+        options = (maxConcurrent, timeout, onTimeout, onError) if asynchronous else None
+        handlers.append((next(self.__registrations), handler, name, options))
+        self.__dispatch = {}
+
+    def unsubscribe(self, listener):
+        """Remove all subscriptions of a listener."""
+        handler = getattr(listener, "onEvent", listener)
+        for handlers in self.__subscriptions.values():
+            handlers[:] = [entry for entry in handlers if entry[1] != handler]
+        self.__dispatch = {}
+
+    def submitTask(self, function, args=(), name=None, maxConcurrent=None, timeout=None, onTimeout=None,
+                   onError=None):
+        """Run a slow call on a worker thread, the result is handled like that of an asynchronous handler."""
+        return self.__workers.submit(function, args, group=name, limit=maxConcurrent, timeout=timeout,
+                                     context=(onTimeout, onError))
+
+    def processAsyncResults(self):
+        # type: () -> int
+        """Apply the results of finished asynchronous handlers and tasks. Return the number of tasks done."""
+        tasks = self.__workers.completed()
+        for task in tasks:
+            onTimeout, onError = task.context or (None, None)
+            if task.timedOut:
+                logging.warning("%s timed out after %ss." % (task.group, task.timeout))
+                if onTimeout is not None:
+                    self.__apply(task, lambda: onTimeout(*task.args))
+                continue
+            self.__count(handler=task.group, duration=task.duration)
+            if task.error is not None:
+                if onError is not None:
+                    self.__apply(task, lambda: onError(*(tuple(task.args) + (task.error,))))
+            elif callable(task.result):
+                self.__apply(task, task.result)
+        return len(tasks)
+
+    @staticmethod
+    def __apply(task, function):
+        try:
+            function()
+        except Exception:
+            logging.exception("Applying result of %s failed." % task.group)
+
+    def waitForAsyncTasks(self, timeout=None):
+        # type: (float) -> bool
+        """Block until all asynchronous handlers and tasks are done (e.g. for shutdown and tests)."""
+        return self.__workers.wait(timeout)
 
     def registerListener(self, new_listener):
-        """Register a class as event listener. This class' method "onEvent" may get triggered."""
-        if new_listener not in self.__listener:
-            if not hasattr(new_listener, "onEvent"):
-                logging.error("Can't register listener %s. Method \"onEvent\" is missing."
-                              % type(new_listener).__name__)
-            logging.info("Registering new event listener: %s" % type(new_listener).__name__)
-            self.__listener.append(new_listener)
+        """Register a class as event listener. This class' method "onEvent" gets triggered by every event."""
+        if not hasattr(new_listener, "onEvent"):
+            logging.error("Can't register listener %s. Method \"onEvent\" is missing."
+                          % type(new_listener).__name__)
+            return
+        self.subscribe(new_listener)
 
     def clearListeners(self):
-        self.__listener = []
+        self.__subscriptions = {}
+        self.__dispatch = {}
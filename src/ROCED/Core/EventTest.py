@@ -21,7 +21,10 @@
 from __future__ import unicode_literals, absolute_import
 
 import logging
+import threading
+import time
 
+from Util.Concurrency import WorkerPool
 from Util.PythonTools import Singleton
 from . import Event
 from . import ScaleTest
@@ -49,3 +52,145 @@ class EventManagerTest(ScaleTest.ScaleTestBase):
         emgr.publishEvent("eventstring")
 
         self.assertTrue(self.wasCalled)
+
+    def test_subscribe(self):
+        emgr = EventPublisherTest()
+        emgr.init()
+
+        class StatusEvent(Event.EventBase):
+            def __init__(self, site, newStatus):
+                super(StatusEvent, self).__init__()
+                self.site = site
+                self.newStatus = newStatus
+
+        calls = []
+        emgr.subscribe(lambda evt: calls.append("all"))
+        emgr.subscribe(lambda evt: calls.append("status"), StatusEvent)
+        emgr.subscribe(lambda evt: calls.append("site"), StatusEvent, site="site1")
+        emgr.subscribe(lambda evt: calls.append("up"), StatusEvent, site="site1", newStatus="up")
+
+        emgr.publishEvent(StatusEvent("site1", "up"))
+        self.assertEqual(calls, ["all", "status", "site", "up"])
+        del calls[:]
+        emgr.publishEvent(StatusEvent("site2", "up"))
+        self.assertEqual(calls, ["all", "status"])
+        del calls[:]
+        emgr.publishEvent("eventstring")
+        self.assertEqual(calls, ["all"])
+
+        # subscribing after dispatching the same kind of event before
+        emgr.subscribe(lambda evt: calls.append("down"), StatusEvent, newStatus="down")
+        del calls[:]
+        emgr.publishEvent(StatusEvent("site1", "down"))
+        self.assertEqual(calls, ["all", "status", "site", "down"])
+
+    def test_cascade(self):
+        emgr = EventPublisherTest()
+        emgr.init()
+
+        class StatusEvent(Event.EventBase):
+            def __init__(self, mid, newStatus):
+                super(StatusEvent, self).__init__()
+                self.id = mid
+                self.newStatus = newStatus
+
+        calls = []
+
+        def advance(evt):
+            calls.append(("advance", evt.id, evt.newStatus))
+            if evt.newStatus < 3:
+                emgr.publishEvent(StatusEvent(evt.id, evt.newStatus + 1))
+
+        emgr.subscribe(advance, StatusEvent)
+        emgr.subscribe(lambda evt: calls.append(("record", evt.id, evt.newStatus)), StatusEvent)
+
+        # handlers of an event run before the events they published (breadth-first)
+        emgr.publishEvent(StatusEvent("a", 2))
+        self.assertEqual(calls, [("advance", "a", 2), ("record", "a", 2), ("advance", "a", 3), ("record", "a", 3)])
+        stats = emgr.eventStatistics(reset=True)
+        self.assertEqual(stats["events"], {"StatusEvent": 2})
+        self.assertEqual(stats["max_depth"], 1)
+        self.assertEqual(stats["handlers"]["advance"][0], 2)
+        self.assertEqual(emgr.eventStatistics()["events"], {})
+
+        # loops are cut off
+        emgr.subscribe(lambda evt: emgr.publishEvent(StatusEvent(evt.id, 0)), StatusEvent, newStatus=3)
+        del calls[:]
+        emgr.publishEvent(StatusEvent("b", 0))
+        self.assertEqual([status for name, _, status in calls if name == "record"], [0, 1, 2, 3])
+        self.assertEqual(emgr.eventStatistics(reset=True)["dropped"], 1)
+
+        # as well as too deep cascades
+        emgr.maxCascadeDepth = 1
+        del calls[:]
+        emgr.publishEvent(StatusEvent("c", 0))
+        self.assertEqual([status for name, _, status in calls if name == "record"], [0, 1])
+        self.assertEqual(emgr.eventStatistics(reset=True)["dropped"], 1)
+        del emgr.maxCascadeDepth
+
+    def test_asynchronous(self):
+        emgr = EventPublisherTest()
+        emgr.init()
+
+        lock = threading.Lock()
+        running = []
+        applied = []
+
+        def slowHandler(evt):
+            with lock:
+                running.append(evt)
+                concurrent = len(running)
+            time.sleep(0.02)
+            with lock:
+                running.remove(evt)
+            return lambda: applied.append((evt, concurrent, threading.current_thread().name))
+
+        emgr.subscribe(slowHandler, asynchronous=True, maxConcurrent=1)
+        [emgr.publishEvent(i) for i in range(3)]
+        self.assertTrue(emgr.waitForAsyncTasks(5))
+        self.assertEqual(applied, [])
+        self.assertEqual(emgr.processAsyncResults(), 3)
+        # results are applied in order by the processing thread, at most one handler ran at once
+        self.assertEqual(applied, [(i, 1, threading.current_thread().name) for i in range(3)])
+        self.assertEqual(emgr.eventStatistics(reset=True)["handlers"]["slowHandler"][0], 3)
+
+        # timed out results are discarded
+        emgr.clearListeners()
+        del applied[:]
+        failures = []
+        emgr.subscribe(slowHandler, asynchronous=True, timeout=0.001, onTimeout=failures.append)
+        emgr.publishEvent(3)
+        time.sleep(0.01)
+        self.assertEqual(emgr.processAsyncResults(), 1)
+        self.assertTrue(emgr.waitForAsyncTasks(5))
+        self.assertEqual(emgr.processAsyncResults(), 0)
+        self.assertEqual(applied, [])
+        # ... and reported on the processing thread, as are failures
+        self.assertEqual(failures, [3])
+
+        def failingHandler(evt):
+            raise ValueError(evt)
+
+        emgr.clearListeners()
+        emgr.subscribe(failingHandler, asynchronous=True, onError=lambda evt, error: failures.append((evt, error)))
+        emgr.publishEvent(4)
+        self.assertTrue(emgr.waitForAsyncTasks(5))
+        self.assertEqual(emgr.processAsyncResults(), 1)
+        self.assertEqual(failures[1][0], 4)
+        self.assertIsInstance(failures[1][1], ValueError)
+
+    def test_stuckWorker(self):
+        pool = WorkerPool(1)
+        hanging = threading.Event()
+        stuck = pool.submit(hanging.wait, (10,), timeout=0.05)
+        while not stuck.running:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual(pool.completed(), [stuck])
+        self.assertTrue(stuck.timedOut)
+
+        # a replacement thread runs further tasks
+        task = pool.submit(lambda: 42)
+        self.assertTrue(pool.wait(5))
+        self.assertEqual(task.result, 42)
+        hanging.set()
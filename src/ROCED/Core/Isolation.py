@@ -0,0 +1,155 @@
+# ===============================================================================
+#
+# Copyright (c) 2010, 2011 by Thomas Hauth and Stephan Riedel
+# 
+# This file is part of ROCED.
+# 
+# ROCED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ROCED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ROCED.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+from __future__ import unicode_literals, absolute_import
+
+import logging
+import multiprocessing
+import traceback
+
+from Util.Logging import CsvStats, JsonLog, MachineHistoryLogger
+from .MachineRegistry import MachineRegistry
+
+try:
+    # forked workers inherit the adapter with its configuration and connections
+    _context = multiprocessing.get_context("fork")
+except AttributeError:
+    _context = multiprocessing
+
+
+class ChangeRecorder(object):
+    """Registry journal collecting changes in memory."""
+
+    def __init__(self):
+        self.sequence = 0
+        self.entries = []
+
+    def append(self, operation, mid, *args):
+        self.sequence += 1
+        self.entries.append((operation, mid) + args)
+
+
+class AdapterProcess(object):
+    """Runs manage() of an adapter in a worker process.
+
+    The worker is forked from the core and keeps running between cycles. Start workers before the core
+    starts other threads (see AdapterBoxBase.startWorkers). A worker restarted later renews the locks it
+    inherited, in case another thread held them when forking. Each cycle it receives a slice
+    of the machine registry and the prefetched query results, calls manage() and returns the registry
+    changes (see MachineRegistry.applyChanges), monitoring log items and an error message (or None).
+    Events are published by the core when it applies the changes, so event handlers keep running in
+    the core process. Adapter state changed by manage() is only kept in the worker: site state used by
+    the core, e.g. VM lists cached for spawn and terminate (applying decisions), is no longer updated by
+    manage(). Such adapters have to refresh it there, or not be isolatable.
+    """
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.started = None
+        self.__process = None
+        self.__connection = None
+
+    @property
+    def alive(self):
+        # type: () -> bool
+        return self.__process is not None and self.__process.is_alive()
+
+    def start(self):
+        connection, workerConnection = _context.Pipe()
+        mr = MachineRegistry()
+        # no other thread may hold the registry lock while forking
+        with mr._lock:
+            self.__process = _context.Process(target=self.__serve, args=(workerConnection,),
+                                              name="Worker %s" % self.adapter.description)
+            self.__process.daemon = True
+            self.__process.start()
+        workerConnection.close()
+        self.__connection = connection
+
+    def kill(self):
+        if self.__process is not None:
+            self.__process.terminate()
+            self.__process.join(1)
+            self.__connection.close()
+        self.__process = None
+        self.__connection = None
+
+    def restart(self):
+        self.kill()
+        self.start()
+
+    def request(self, machines, started):
+        # type: (dict, float) -> None
+        """Let the worker manage the adapter, with the registry slice "machines"."""
+        if not self.alive:
+            if self.__process is not None:
+                logging.warning("Worker of %s died, restarting." % self.adapter.description)
+            self.restart()
+        try:
+            self.__connection.send((machines, self.adapter.prefetched))
+        except Exception:
+            # e.g. prefetched results which can't be pickled, the worker queries itself then
+            self.__connection.send((machines, {}))
+        self.started = started
+
+    def poll(self, timeout):
+        # type: (float) -> bool
+        """Wait for the result of the current request. Return False if the timeout expired first."""
+        try:
+            return self.__connection.poll(timeout)
+        except (EOFError, IOError, OSError):
+            return True
+
+    def receive(self):
+        # type: () -> tuple
+        """Result of the current request: (changes, log items, error, remote calls)."""
+        try:
+            return self.__connection.recv()
+        except (EOFError, IOError, OSError):
+            self.kill()
+            return [], {}, "Worker process exited.", 0
+
+    def __serve(self, connection):
+        mr = MachineRegistry()
+        # events are published by the core, when it applies the changes
+        mr.afterFork()
+        while True:
+            try:
+                request = connection.recv()
+            except (EOFError, KeyboardInterrupt):
+                break
+            machines, self.adapter.prefetched = request
+            mr.journal = None
+            mr.machines = machines
+            recorder = ChangeRecorder()
+            mr.journal = recorder
+            JsonLog.takeItems()
+            # statistics and history of the changes are recorded by the core, when it applies them
+            CsvStats.reset()
+            MachineHistoryLogger.reset()
+            error = None
+            self.adapter.remoteCalls = 0
+            try:
+                with mr.deferredBatch([]):
+                    self.adapter.manage()
+            except Exception:
+                error = traceback.format_exc()
+            mr.journal = None
+            connection.send((recorder.entries, JsonLog.takeItems(), error, self.adapter.remoteCalls))
@@ -21,14 +21,35 @@
 from __future__ import unicode_literals, absolute_import
 
 import abc
+import heapq
+import itertools
 import logging
+import sys
+import threading
 import uuid
-from datetime import datetime
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
-from Util.Logging import CsvStats
+from Util.Logging import CsvStats, MachineHistoryLogger
 from Util.PythonTools import Singleton
 from . import Event
 
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+try:
+    from types import MappingProxyType
+except ImportError:
+    MappingProxyType = dict
+
+# Marker for "key not set" in index updates (None is a valid value).
+_missing = object()
+
+PY3 = sys.version_info > (3,)
+
 
 class MachineRegistry(Event.EventPublisher, Singleton):
     statusBooting = "booting"
@@ -46,6 +67,8 @@ class MachineRegistry(Event.EventPublisher, Singleton):
                    statusDisintegrating, statusDisintegrated, statusDown)
 
     statusChangeHistory = "state_change_history"
+    # number of state changes kept per machine, older ones are moved to the history file
+    historyLength = 20
 
     regStatus = "status"
     regStatusLastUpdate = "status_last_update"
@@ -68,47 +91,521 @@ class MachineRegistry(Event.EventPublisher, Singleton):
     regVpnCert = "vpn_cert"
     regVpnCertIsValid = "vpn_cert_is_valid"
 
+    # keys with a secondary index {key: {value: {machine_id, ...}}}, extended via registerKeyIndex
+    indexedKeys = frozenset((regSite, regStatus, regMachineType))
+    # position of indexed keys in counter keys (site, machine type, status)
+    __counterPositions = {regSite: 0, regMachineType: 1, regStatus: 2}
+    # number of per machine locks (machines share locks)
+    lockStripes = 64
+
+    # kinds of changes tracked for consumers
+    changeCreated = "created"
+    changeModified = "modified"
+    changeRemoved = "removed"
+
     def init(self):
         self.logger = logging.getLogger("MachReg")
-        self.machines = dict()
+        # Locking: The registry lock protects the registry structure, indexes, counters and timers.
+        # Machine locks protect single entries (see update), writes to keys which are not indexed only take
+        # the machine lock. The change lock protects the journal, generation and change sets, it is held
+        # briefly. Acquire them in this order.
+        self._lock = threading.RLock()
+        self._machineLocks = [threading.RLock() for _ in range(self.lockStripes)]
+        self._changeLock = threading.RLock()
+        # incremented on every change, see checkpoint (also used for lock-free snapshots)
+        self._generation = 0
+        # changes not yet seen by consumers {name: (created, modified, removed)}
+        self._consumers = dict()
+        self._local = threading.local()
+        self._machines = dict()
+        self.indexedKeys = MachineRegistry.indexedKeys
+        self._index = {key: dict() for key in self.indexedKeys}
+        # number of machines per (site, machine type, status)
+        self._counters = Counter()
+        # state timeouts {key: DeadlineQueue} and policies arming them {key: (status, timeout, site)}
+        self._timers = dict()
+        self._timeoutPolicies = dict()
+        # journal of all changes (see MachineRegistryLogger.append), None: no journal
+        self.journal = None
+        # machines requested from a site, not yet in the registry {machine_id: (site, machine type)}
+        self._requests = dict()
         super(MachineRegistry, self).init()
 
+    @property
+    def machines(self):
+        # type: () -> dict
+        """Dictionary of all machines {machine_id: {a:b, c:d, e:f}, ...}.
+
+        Add/remove machines via newMachine/removeMachine, otherwise the indexes get out of sync.
+        """
+        return self._machines
+
+    @machines.setter
+    def machines(self, machines):
+        # type: (dict) -> None
+        """Replace the whole registry content (e.g. when loading a previous state) and rebuild indexes.
+
+        This is not journaled, so a new snapshot is required afterwards. Status change histories are cut
+        to historyLength: older entries were written to the history file when they were pushed out
+        (see _setStatus), also those a replayed journal adds again.
+        """
+        with self._lock:
+            journal, self.journal = self.journal, None
+            for mid in self._machines:
+                self._recordChange(mid, self.changeRemoved)
+            self._machines = dict()
+            self._index = {key: dict() for key in self.indexedKeys}
+            self._counters = Counter()
+            for mid, machine in machines.items():
+                self._attach(mid)
+                self._machines[mid].update(machine)
+                history = self._machines[mid].get(self.statusChangeHistory, ())
+                self._machines[mid][self.statusChangeHistory] = deque(history, maxlen=self.historyLength)
+            for timers in self._timers.values():
+                timers.clear()
+            for mid in self._machines:
+                self._armTimers(mid)
+            self.journal = journal
+
+    @property
+    def _batch(self):
+        """Per thread batch() state: nesting depth and events deferred until the outermost batch ends."""
+        state = self._local
+        if not hasattr(state, "depth"):
+            state.depth = 0
+            state.events = []
+        return state
+
+    def machineLock(self, mid):
+        # type: (str) -> threading.RLock
+        """Lock protecting a single machine entry. Acquire the registry lock first, if both are required."""
+        return self._machineLocks[hash(mid) % self.lockStripes]
+
+    @contextmanager
+    def _writeLock(self, mid, indexed):
+        """Locks for writing a machine entry: its machine lock, and the registry lock if indexes change."""
+        if indexed:
+            with self._lock, self.machineLock(mid):
+                yield
+        else:
+            with self.machineLock(mid):
+                yield
+
+    def update(self, mid, fields=None, **kwargs):
+        # type: (str, dict, ...) -> None
+        """Atomically update several fields of a machine.
+
+        A status change (key regStatus) is applied last, via updateMachineStatus.
+        Example: mr.update(mid, {mr.regHostname: "vm-1"}, machine_load=0.5)
+        """
+        fields = dict(fields or (), **kwargs)
+        newStatus = fields.pop(self.regStatus, _missing)
+        indexed = newStatus is not _missing or any(key in self.indexedKeys for key in fields)
+        with self._writeLock(mid, indexed):
+            machine = self._machines[mid]
+            for key, value in fields.items():
+                machine[key] = value
+            if newStatus is not _missing:
+                oldStatus = self._setStatus(mid, newStatus)
+        if newStatus is not _missing:
+            self._statusChanged(mid, oldStatus, newStatus)
+
+    def snapshot(self):
+        # type: () -> dict
+        """Consistent copy of the registry {machine_id: {a:b, c:d, e:f}, ...}.
+
+        Entries are copied without holding the registry lock. If the registry changed meanwhile,
+        the copy is retried and finally made while holding the registry lock.
+        """
+        return self.journaledSnapshot()[0]
+
+    def journaledSnapshot(self):
+        # type: () -> tuple
+        """Consistent copy of the registry and the journal sequence number of the last change it contains."""
+        # a change is journaled and applied while holding its machine lock, then the generation is
+        # increased: copying the entry waits for the change, a change after reading the sequence is noticed
+        for _ in range(3):
+            with self._changeLock:
+                generation = self._generation
+                sequence = self._journalSequence()
+            snapshot = {mid: self._copyMachine(mid, machine) for mid, machine in self._machines.copy().items()}
+            if generation == self._generation:
+                return snapshot, sequence
+        with self._lock:
+            with self._changeLock:
+                sequence = self._journalSequence()
+            return ({mid: self._copyMachine(mid, machine) for mid, machine in self._machines.items()}, sequence)
+
+    def _journalSequence(self):
+        journal = self.journal
+        return journal.sequence if journal is not None else None
+
+    def _journal(self, operation, mid, *args):
+        """Append a change to the journal (machine lock held, for changes of a machine entry)."""
+        if self.journal is not None:
+            with self._changeLock:
+                self.journal.append(operation, mid, *args)
+
+    def _copyMachine(self, mid, machine):
+        with self.machineLock(mid):
+            copy_ = dict(machine)
+        if self.statusChangeHistory in copy_:
+            copy_[self.statusChangeHistory] = list(copy_[self.statusChangeHistory])
+        return copy_
+
+    def _attach(self, mid):
+        """Add an empty record to the registry."""
+        self._recordChange(mid, self.changeCreated)
+        self._machines[mid] = MachineRecord(self, mid)
+        self._counters[(None, None, None)] += 1
+
+    def _counterKey(self, machine, key=None, value=None):
+        """(site, machine type, status) of a machine, optionally with one of the values replaced."""
+        counterKey = [machine.get(self.regSite), machine.get(self.regMachineType), machine.get(self.regStatus)]
+        if key is not None:
+            counterKey[self.__counterPositions[key]] = None if value is _missing else value
+        return tuple(counterKey)
+
+    def _updateIndex(self, mid, key, oldValue, newValue):
+        """Update indexes and counters after a write to an indexed key. Called by MachineRecord (locked)."""
+        if key in self.__counterPositions:
+            machine = self._machines[mid]
+            self._decrementCounter(self._counterKey(machine, key, oldValue))
+            self._counters[self._counterKey(machine, key, newValue)] += 1
+        self._moveInIndex(mid, key, oldValue, newValue)
+
+    def _decrementCounter(self, counterKey):
+        self._counters[counterKey] -= 1
+        if self._counters[counterKey] <= 0:
+            del self._counters[counterKey]
+
+    def _moveInIndex(self, mid, key, oldValue, newValue):
+        """Move machine from one index bucket to another."""
+        index = self._index[key]
+        if oldValue is not _missing:
+            bucket = index.get(oldValue)
+            if bucket is not None:
+                bucket.discard(mid)
+                if not bucket:
+                    del index[oldValue]
+        if newValue is not _missing:
+            index.setdefault(newValue, set()).add(mid)
+
+    def _dropFromIndex(self, mid):
+        """Remove machine from all indexes and counters and detach its entry from the registry."""
+        self._recordChange(mid, self.changeRemoved)
+        machine = self._machines[mid]
+        self._decrementCounter(self._counterKey(machine))
+        for key in self.indexedKeys:
+            if key in machine:
+                self._moveInIndex(mid, key, machine[key], _missing)
+        # later writes (e.g. by event listeners holding the entry) must not touch the indexes
+        machine._registry = None
+
+    def _recordChange(self, mid, change):
+        """Increase generation and add machine to the change sets of all consumers."""
+        with self._changeLock:
+            self.__recordChange(mid, change)
+
+    def __recordChange(self, mid, change):
+        self._generation += 1
+        for created, modified, removed in self._consumers.values():
+            if change == self.changeModified:
+                if mid not in created:
+                    modified.add(mid)
+            elif change == self.changeCreated:
+                # re-created machines are known to the consumer
+                if mid in removed:
+                    removed.discard(mid)
+                    modified.add(mid)
+                else:
+                    created.add(mid)
+            else:
+                modified.discard(mid)
+                if mid in created:
+                    created.discard(mid)
+                else:
+                    removed.add(mid)
+
+    @property
+    def generation(self):
+        # type: () -> int
+        """Number of changes made to the registry so far."""
+        return self._generation
+
+    def registerConsumer(self, name):
+        # type: (str) -> None
+        """Track changes for a consumer (e.g. persistence), which processes only changed machines.
+
+        Tracking starts with the registration, see checkpoint.
+        """
+        with self._changeLock:
+            if name not in self._consumers:
+                self._consumers[name] = (set(), set(), set())
+
+    def checkpoint(self, name):
+        # type: (str) -> ChangeSet
+        """Machines created, modified and removed since the last checkpoint of the consumer.
+
+        Writes to machine entries are tracked, changes of mutable values inside an entry
+        (e.g. appending to a list) are not.
+        """
+        with self._changeLock:
+            created, modified, removed = self._consumers[name]
+            self._consumers[name] = (set(), set(), set())
+            return ChangeSet(self._generation, created, modified, removed)
+
+    def _filters(self, site, status, machineType):
+        return [(key, value) for key, value in ((self.regSite, site), (self.regStatus, status),
+                                                (self.regMachineType, machineType))
+                if value is not None]
+
+    def _candidates(self, filters):
+        """Machine ids matching the filters: smallest index bucket, checked against the others."""
+        buckets = sorted((self._index[key].get(value, ()) for key, value in filters), key=len)
+        return (mid for mid in buckets[0] if all(mid in bucket for bucket in buckets[1:]))
+
     def getMachines(self, site=None, status=None, machineType=None):
         """Return MachineRegistry dictionary, filtered by variables.
 
+        Filtered queries are answered via secondary indexes, so the cost depends on the size of
+        the result, not on the size of the registry.
+        If the result is only iterated or counted, use iterMachines/countMachines/view instead.
+
         :return {machine_id: {a:b, c:d, e:f}, ... }
         """
-        return {mid: machine for mid, machine in self.machines.items() if
-                (site is None or machine.get(self.regSite) == site) and
-                (status is None or machine.get(self.regStatus) == status) and
-                (machineType is None or machine.get(self.regMachineType) == machineType)}
+        filters = self._filters(site, status, machineType)
+        with self._lock:
+            if not filters:
+                return dict(self._machines)
+            return {mid: self._machines[mid] for mid in self._candidates(filters)}
+
+    def iterMachines(self, site=None, status=None, machineType=None):
+        """Iterate over (machine_id, machine) pairs, filtered by variables, without copying the registry.
+
+        Machines may be changed or removed while iterating. Machines which were removed or
+        don't match the filters anymore when it's their turn are skipped.
+        """
+        filters = self._filters(site, status, machineType)
+        with self._lock:
+            if filters:
+                mids = list(self._candidates(filters))
+            else:
+                mids = list(self._machines)
+        for mid in mids:
+            machine = self._machines.get(mid)
+            if machine is not None and all(machine.get(key) == value for key, value in filters):
+                yield mid, machine
+
+    def registerKeyIndex(self, key):
+        # type: (str) -> None
+        """Maintain a secondary index on a (site specific) key, e.g. the ID of a machine at the site.
+
+        Enables lookup(key, value), so remote information can be matched with the registry without
+        scanning all machines.
+        """
+        with self._lock:
+            if key in self.indexedKeys:
+                return
+            self._index[key] = dict()
+            for mid, machine in self._machines.items():
+                if key in machine:
+                    self._moveInIndex(mid, key, _missing, machine[key])
+            self.indexedKeys = self.indexedKeys | frozenset((key,))
+
+    def lookup(self, key, value):
+        # type: (str, object) -> Optional[str]
+        """Machine ID of the machine with machine[key] == value or None. The key has to be indexed.
+
+        If several machines share the value, an arbitrary one of them is returned.
+        """
+        with self._lock:
+            for mid in self._index[key].get(value, ()):
+                return mid
+        return None
+
+    def view(self, site=None, status=None, machineType=None):
+        # type: (str, str, str) -> MachineView
+        """Read-only, live mapping {machine_id: machine} of all machines matching the filters."""
+        return MachineView(self, site, status, machineType)
 
     def updateMachineStatus(self, mid, newStatus):
         """Change Machine status"""
+        with self._lock, self.machineLock(mid):
+            oldStatus = self._setStatus(mid, newStatus)
+        self._statusChanged(mid, oldStatus, newStatus)
+
+    def _setStatus(self, mid, newStatus):
+        """Status change of the machine entry. Requires registry and machine lock. Returns old status."""
+        machine = self._machines[mid]
         newTime = datetime.now()
-        if self.regStatusLastUpdate in self.machines[mid]:
-            oldTime = self.machines[mid][self.regStatusLastUpdate]
+        if self.regStatusLastUpdate in machine:
+            oldTime = machine[self.regStatusLastUpdate]
         else:
             oldTime = newTime
         diffTime = newTime - oldTime
 
-        oldStatus = self.machines[mid].get(self.regStatus, None)
-        self.machines[mid][self.regStatus] = newStatus
-        self.machines[mid][self.regStatusLastUpdate] = newTime
-        self.machines[mid][self.statusChangeHistory].append({"old_status": oldStatus, "new_status": newStatus,
-                                                             "timestamp": str(newTime), "time_diff": str(diffTime)})
+        oldStatus = machine.get(self.regStatus, None)
+        entry = {"old_status": oldStatus, "new_status": newStatus,
+                 "timestamp": str(newTime), "time_diff": str(diffTime)}
+        self._journal("status", mid, {self.regStatus: newStatus, self.regStatusLastUpdate: newTime},
+                      self.statusChangeHistory, entry)
+        machine._assign(self.regStatus, newStatus)
+        machine._assign(self.regStatusLastUpdate, newTime)
+        history = machine[self.statusChangeHistory]
+        if len(history) == history.maxlen:
+            MachineHistoryLogger.append(mid, (history[0],))
+        history.append(entry)
+        self._armTimers(mid)
+
+        row = StatsRow(site=machine.get(self.regSite), mid=mid, old_status=oldStatus, new_status=newStatus,
+                       timestamp=str(newTime), time_diff=str(diffTime))
+        state = self._batch
+        if state.depth > 0:
+            # written by commitBatch, in the order batches are committed
+            state.events.append(row)
+        else:
+            CsvStats.add_item(**row._asdict())
+        return oldStatus
 
-        if mid in self.machines and len(self.machines[mid][self.statusChangeHistory]) > 0:
+    def _statusChanged(self, mid, oldStatus, newStatus):
+        """Statistics, logging and event of a status change (without holding locks)."""
+        if self._batch.depth > 0:
+            self.logger.debug("Updating status of %s: %s -> %s" % (mid, oldStatus, newStatus))
+        else:
             with CsvStats() as csv_stats:
-                csv_stats.add_item(site=self.machines[mid][self.regSite], mid=mid,
-                                   old_status=self.machines[mid][self.statusChangeHistory][-1]["old_status"],
-                                   new_status=self.machines[mid][self.statusChangeHistory][-1]["new_status"],
-                                   timestamp=self.machines[mid][self.statusChangeHistory][-1]["timestamp"],
-                                   time_diff=self.machines[mid][self.statusChangeHistory][-1]["time_diff"])
                 csv_stats.write_stats()
+            self.logger.info("Updating status of %s: %s -> %s" % (mid, oldStatus, newStatus))
+        machine = self._machines.get(mid)
+        site = machine.get(self.regSite) if machine is not None else None
+        self.publishEvent(StatusChangedEvent(mid, oldStatus, newStatus, site))
+
+    @contextmanager
+    def batch(self):
+        """Group registry changes, e.g. all status changes of one adapter's manage call.
+
+        Within a batch, state change statistics are buffered and written at once and events are
+        queued. When the outermost batch ends, all queued events are published in their original order,
+        including transitions superseded later in the batch (e.g. disintegrating -> disintegrated).
+        Listeners may therefore find the machine in a later status or already removed.
+        Batches may be nested. Batches are per thread, changes by other threads are not deferred.
+        """
+        state = self._batch
+        state.depth += 1
+        try:
+            yield self
+        finally:
+            state.depth -= 1
+            if state.depth == 0:
+                events, state.events = state.events, []
+                self.commitBatch(events)
+
+    @contextmanager
+    def deferredBatch(self, events):
+        # type: (list) -> None
+        """Batch whose queued events and statistics rows are moved to "events" instead of being published.
+
+        Publish them later with commitBatch, e.g. to commit the batches of concurrently managed
+        adapters in a fixed order from the core thread.
+        """
+        state = self._batch
+        state.depth += 1
+        try:
+            yield self
+        finally:
+            state.depth -= 1
+            if state.depth == 0:
+                events.extend(state.events)
+                state.events = []
+
+    def commitBatch(self, events):
+        # type: (list) -> None
+        """Write the statistics rows and publish the events queued by a batch."""
+        rows = [item for item in events if isinstance(item, StatsRow)]
+        if rows:
+            for row in rows:
+                CsvStats.add_item(**row._asdict())
+            with CsvStats() as csv_stats:
+                csv_stats.write_stats()
+            self.logger.info("Updated status of %d machine(s)." % len(rows))
+        for evt in events:
+            if not isinstance(evt, StatsRow):
+                self.publishEvent(evt)
+
+    def publishEvent(self, evt):
+        # type: (Event.EventBase) -> None
+        """Publish event to all listeners. Inside a batch, the event is queued instead."""
+        state = self._batch
+        if state.depth > 0:
+            state.events.append(evt)
+        else:
+            super(MachineRegistry, self).publishEvent(evt)
+
+    def registerTimeout(self, key, status, timeout, site=None):
+        # type: (str, str, Union[float, Callable], str) -> None
+        """Expire machines which stay in a status for longer than timeout seconds.
+
+        Whenever a machine (of the site, if given) enters the status, a deadline is set. Deadlines are
+        cancelled automatically when the machine changes its status or is removed. Expired machines
+        are returned by getExpired(key).
+
+        :param key: unique name of the timeout, e.g. "<site name>_boot_timeout"
+        :param timeout: seconds or callable(mid) returning seconds (e.g. randomised timeouts)
+        """
+        with self._lock:
+            self._timeoutPolicies[key] = (status, timeout, site)
+            self._timers[key] = DeadlineQueue()
+            for mid, _ in self.iterMachines(site=site, status=status):
+                self._armTimers(mid, keys=(key,))
+
+    def setDeadline(self, key, mid, timeout):
+        # type: (str, str, float) -> None
+        """(Re-)Set a deadline for a machine in its current status, e.g. to check an expired machine again later."""
+        with self._lock:
+            timers = self._timers.setdefault(key, DeadlineQueue())
+            timers.add(mid, self.machines[mid].get(self.regStatus), datetime.now() + timedelta(seconds=timeout))
+
+    def hasDeadline(self, key, mid):
+        # type: (str, str) -> bool
+        """Is a deadline (passed or not) set for the machine in its current status?"""
+        with self._lock:
+            return mid in self._timers.get(key, ())
+
+    def getExpired(self, key, now=None):
+        # type: (str, datetime) -> list
+        """Machines whose deadline has passed and which are still in the same status.
+
+        Machines stay expired until their status changes, they are removed or setDeadline is called.
+        """
+        with self._lock:
+            timers = self._timers.get(key)
+            if timers is None:
+                return []
+            return [mid for mid, status in timers.expired(now or datetime.now())
+                    if mid in self._machines and self._machines[mid].get(self.regStatus) == status]
 
-        self.logger.info("Updating status of %s: %s -> %s" % (mid, oldStatus, newStatus))
-        self.publishEvent(StatusChangedEvent(mid, oldStatus, newStatus))
+    def _armTimers(self, mid, keys=None):
+        """Cancel deadlines of a machine and set new ones according to the timeout policies (locked)."""
+        machine = self._machines[mid]
+        status = machine.get(self.regStatus)
+        for key in keys or self._timers:
+            self._timers[key].discard(mid)
+            policy = self._timeoutPolicies.get(key)
+            if policy is None or policy[0] != status or policy[2] not in (None, machine.get(self.regSite)):
+                continue
+            timeout = policy[1](mid) if callable(policy[1]) else policy[1]
+            start = machine.get(self.regStatusLastUpdate)
+            if not isinstance(start, datetime):
+                start = datetime.now()
+            self._timers[key].add(mid, status, start + timedelta(seconds=timeout))
+
+    def getStatusHistory(self, mid):
+        # type: (str) -> list
+        """Complete state change history of a machine, including entries moved to the history file."""
+        history = MachineHistoryLogger.query(mid)
+        if mid in self.machines:
+            history.extend(self.machines[mid].get(self.statusChangeHistory, ()))
+        return history
 
     def calcLastStateChange(self, mid):
         # type: (str) -> int
@@ -120,10 +617,92 @@ class MachineRegistry(Event.EventPublisher, Singleton):
         diff = datetime.now() - self.machines[mid].get(self.regStatusLastUpdate, datetime.now())
         return diff.total_seconds()
 
+    def countMachines(self, site=None, status=None, machineType=None):
+        # type: (str, Union[str, Iterable[str]], str) -> int
+        """Number of machines, filtered by variables. Uses live counters instead of looking at the machines.
+
+        :param status: single status or a collection of states
+        """
+        return sum(self.countMachinesPerType(site=site, status=status, machineType=machineType).values())
+
+    def countMachinesPerType(self, site=None, status=None, machineType=None):
+        # type: (str, Union[str, Iterable[str]], str) -> dict
+        """Number of machines per machine type, filtered by variables.
+
+        :param status: single status or a collection of states
+        :return {machine_type: integer, ...}:
+        """
+        if status is not None and not isinstance(status, (list, tuple, set, frozenset)):
+            status = (status,)
+        result = dict()
+        with self._lock:
+            counters = list(self._counters.items())
+        for (site_, machineType_, status_), count in counters:
+            if ((site is None or site_ == site) and
+                    (machineType is None or machineType_ == machineType) and
+                    (status is None or status_ in status)):
+                result[machineType_] = result.get(machineType_, 0) + count
+        return result
+
+    def addRequest(self, mid, site, machineType):
+        # type: (str, str, str) -> None
+        """Track a machine requested from a site (see SiteAdapterBase.requestMachines).
+
+        Requested machines are counted (see countRequests), but not added to the registry and not published
+        until the request succeeded. Requests are not journaled, requests running at a restart are lost.
+        """
+        with self._lock:
+            self._requests[mid] = (site, machineType)
+
+    def removeRequest(self, mid):
+        # type: (str) -> bool
+        """Stop tracking a request, once it completed. Return False if it wasn't tracked."""
+        with self._lock:
+            return self._requests.pop(mid, None) is not None
+
+    def isRequested(self, mid):
+        # type: (str) -> bool
+        """Is the machine requested from its site, but not yet added?"""
+        return mid in self._requests
+
+    def countRequests(self, site=None):
+        # type: (str) -> dict
+        """Number of running requests per machine type.
+
+        :return {machine_type: integer, ...}:
+        """
+        result = dict()
+        with self._lock:
+            requests = list(self._requests.values())
+        for site_, machineType in requests:
+            if site is None or site_ == site:
+                result[machineType] = result.get(machineType, 0) + 1
+        return result
+
+    def aggregate(self):
+        # type: () -> MachineAggregate
+        """Immutable summary of the registry: machine counts and drained cores per (site, machine type, status).
+
+        Built once per management cycle and passed on, instead of counting again for each site.
+        """
+        drainedCores = Counter()
+        with self._lock:
+            counts = dict(self._counters)
+            for machine in self._machines.values():
+                if machine.get(self.regMachineDrain):
+                    try:
+                        drainedCores[self._counterKey(machine)] += int(machine[self.regMachineCores])
+                    except (KeyError, TypeError, ValueError):
+                        pass
+            generation = self._generation
+            requests = Counter(self._requests.values())
+        return MachineAggregate(generation, MappingProxyType(counts), MappingProxyType(dict(drainedCores)),
+                                MappingProxyType(dict(requests)))
+
     def getMachineOverview(self):
         # type: () -> str
         """Create comma-separated list of number of machines in each state."""
-        info = "MachineState: %s" % ",".join((str(len(self.getMachines(status=status_)))
+        info = "MachineState: %s" % ",".join((str(self.countMachines(status=status_))
                                               for status_ in self.list_status))
         return info
 
@@ -133,11 +712,18 @@ class MachineRegistry(Event.EventPublisher, Singleton):
         if mid is None:
             mid = str(uuid.uuid4())
         self.logger.debug("Adding machine with id %s." % mid)
-        self.machines[mid] = dict()
-        self.machines[mid][self.regSite] = self.regSite
-        self.machines[mid][self.statusChangeHistory] = []
-        self.machines[mid][self.regMachineBusy] = False
-        self.machines[mid][self.regMachineDrain] = False
+        with self._lock, self.machineLock(mid):
+            # snapshots reading the journal sequence see the new entry as well
+            with self._changeLock:
+                self._journal("new", mid)
+                if mid in self.machines:
+                    self._dropFromIndex(mid)
+                    [timers.discard(mid) for timers in self._timers.values()]
+                self._attach(mid)
+            self.machines[mid][self.regSite] = self.regSite
+            self.machines[mid][self.statusChangeHistory] = deque(maxlen=self.historyLength)
+            self.machines[mid][self.regMachineBusy] = False
+            self.machines[mid][self.regMachineDrain] = False
         self.publishEvent(NewMachineEvent(mid))
         return mid
 
@@ -146,27 +732,348 @@ class MachineRegistry(Event.EventPublisher, Singleton):
         """Remove a machine entry and publish "MachineRemovedEvent" event to all listeners."""
         self.logger.debug("Removing machine with id %s." % mid)
         # Also publish machine information for possible cleanups, since it's already removed when the event occurs.
-        machine = self.machines[mid]
-        self.machines.pop(mid)
+        with self._lock, self.machineLock(mid):
+            self._journal("remove", mid)
+            self._dropFromIndex(mid)
+            [timers.discard(mid) for timers in self._timers.values()]
+            machine = self.machines.pop(mid)
+        # keep the history queryable after the machine is gone
+        MachineHistoryLogger.append(mid, machine.get(self.statusChangeHistory, ()))
         event = MachineRemovedEvent(mid, machine)
         self.publishEvent(event)
 
+    def applyChanges(self, entries):
+        # type: (list) -> None
+        """Apply changes recorded by a journal elsewhere (e.g. in a worker process), entries as passed to
+        journal.append: (operation, machine ID, arguments...).
+
+        Changes go through the regular methods, so indexes, timers and the journal are updated and events
+        are published. Status changes get a new timestamp. Changes of machines or fields the core changed
+        meanwhile (e.g. removed) are skipped.
+        """
+        for entry in entries:
+            operation, mid, args = entry[0], entry[1], entry[2:]
+            if operation == "new":
+                self.newMachine(mid)
+            elif mid not in self._machines:
+                self.logger.warning("Ignoring change %s of unknown machine %s." % (operation, mid))
+            elif operation == "set":
+                self._machines[mid][args[0]] = args[1]
+            elif operation == "del":
+                # the field can't vanish between checking and deleting
+                with self._writeLock(mid, args[0] in self.indexedKeys):
+                    if args[0] in self._machines[mid]:
+                        del self._machines[mid][args[0]]
+            elif operation == "status":
+                self.updateMachineStatus(mid, args[0][self.regStatus])
+            elif operation == "remove":
+                self.removeMachine(mid)
+
+    def afterFork(self):
+        """Prepare the registry of a forked worker process.
+
+        Locks are renewed, as other threads of the parent may have held them when forking. Listeners
+        and change tracking consumers are dropped, they belong to the parent.
+        """
+        self._lock = threading.RLock()
+        self._machineLocks = [threading.RLock() for _ in range(self.lockStripes)]
+        self._changeLock = threading.RLock()
+        self._local = threading.local()
+        self._consumers = dict()
+        self.clearListeners()
+
     def clear(self):
         """ Clear machine registry (without raising any events). Should only be used in unit tests."""
+        self.indexedKeys = MachineRegistry.indexedKeys
+        self.journal = None
         self.machines = dict()
+        self._requests = dict()
+        self._local = threading.local()
+        self._consumers = dict()
+        self._timers = dict()
+        self._timeoutPolicies = dict()
         self.clearListeners()
 
 
+class StatsRow(namedtuple("StatsRow", ("site", "mid", "old_status", "new_status", "timestamp", "time_diff"))):
+    """Status change statistics (see CsvStats), queued by a batch."""
+    __slots__ = ()
+
+
+class ChangeSet(namedtuple("ChangeSet", ("generation", "created", "modified", "removed"))):
+    """Machine IDs created, modified and removed since the last checkpoint of a consumer."""
+    __slots__ = ()
+
+    @property
+    def changed(self):
+        # type: () -> bool
+        return bool(self.created or self.modified or self.removed)
+
+
+class MachineAggregate(namedtuple("MachineAggregate", ("generation", "counts", "drainedCores", "requests"))):
+    """Read-only machine statistics of a registry generation (see MachineRegistry.aggregate).
+
+    counts, drainedCores: {(site, machine type, status): integer}
+    requests: {(site, machine type): integer}
+    """
+    __slots__ = ()
+
+    def _select(self, values, site, status, machineType):
+        if status is not None and not isinstance(status, (list, tuple, set, frozenset)):
+            status = (status,)
+        result = dict()
+        for (site_, machineType_, status_), value in values.items():
+            if ((site is None or site_ == site) and
+                    (machineType is None or machineType_ == machineType) and
+                    (status is None or status_ in status)):
+                result[machineType_] = result.get(machineType_, 0) + value
+        return result
+
+    def countMachinesPerType(self, site=None, status=None, machineType=None):
+        # type: (str, Union[str, Iterable[str]], str) -> dict
+        """Same as MachineRegistry.countMachinesPerType, at the time of the aggregate."""
+        return self._select(self.counts, site, status, machineType)
+
+    def countMachines(self, site=None, status=None, machineType=None):
+        # type: (str, Union[str, Iterable[str]], str) -> int
+        return sum(self.countMachinesPerType(site, status, machineType).values())
+
+    def drainedCoresPerType(self, site=None, status=None, machineType=None):
+        # type: (str, Union[str, Iterable[str]], str) -> dict
+        """Cores of drained machines per machine type."""
+        return self._select(self.drainedCores, site, status, machineType)
+
+    def countRequests(self, site=None):
+        # type: (str) -> dict
+        """Same as MachineRegistry.countRequests, at the time of the aggregate."""
+        result = dict()
+        for (site_, machineType), count in self.requests.items():
+            if site is None or site_ == site:
+                result[machineType] = result.get(machineType, 0) + count
+        return result
+
+
+class DeadlineQueue(object):
+    """Min-heap of machine deadlines.
+
+    Cancelled deadlines are not removed from the heap, but ignored when they come up (and
+    dropped when the heap is rebuilt), so cancelling is O(1).
+    """
+
+    def __init__(self):
+        self._heap = []
+        # active deadlines {mid: (sequence number, status)}
+        self._active = dict()
+        # machines with passed deadline {mid: status}
+        self._expired = dict()
+        self._sequence = itertools.count()
+
+    def add(self, mid, status, deadline):
+        # type: (str, str, datetime) -> None
+        self.discard(mid)
+        seq = next(self._sequence)
+        self._active[mid] = (seq, status)
+        heapq.heappush(self._heap, (deadline, seq, mid))
+        if len(self._heap) > 2 * len(self._active) + 64:
+            self._heap = [entry for entry in self._heap if self._active.get(entry[2], (None,))[0] == entry[1]]
+            heapq.heapify(self._heap)
+
+    def discard(self, mid):
+        # type: (str) -> None
+        self._active.pop(mid, None)
+        self._expired.pop(mid, None)
+
+    def clear(self):
+        self.__init__()
+
+    def expired(self, now):
+        # type: (datetime) -> list
+        """List of (mid, status) whose deadline is before "now"."""
+        while self._heap and self._heap[0][0] <= now:
+            deadline, seq, mid = heapq.heappop(self._heap)
+            if self._active.get(mid, (None,))[0] == seq:
+                self._expired[mid] = self._active.pop(mid)[1]
+        return list(self._expired.items())
+
+    def __contains__(self, mid):
+        return mid in self._active or mid in self._expired
+
+    def __len__(self):
+        return len(self._active) + len(self._expired)
+
+
+class MachineView(Mapping):
+    """Read-only view on (a filtered part of) the machine registry.
+
+    The view doesn't copy anything, it always reflects the current registry content.
+    """
+
+    def __init__(self, registry, site=None, status=None, machineType=None):
+        self._registry = registry
+        self._site = site
+        self._status = status
+        self._machineType = machineType
+        self._filters = registry._filters(site, status, machineType)
+
+    def __getitem__(self, mid):
+        machine = self._registry.machines[mid]
+        if any(machine.get(key) != value for key, value in self._filters):
+            raise KeyError(mid)
+        return machine
+
+    def __contains__(self, mid):
+        machine = self._registry.machines.get(mid)
+        return machine is not None and all(machine.get(key) == value for key, value in self._filters)
+
+    def __iter__(self):
+        return (mid for mid, _ in self._registry.iterMachines(self._site, self._status, self._machineType))
+
+    def __len__(self):
+        return self._registry.countMachines(self._site, self._status, self._machineType)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class MachineRecord(MutableMapping):
+    """Compact machine registry entry.
+
+    Fields used by (nearly) every machine are stored in slots, adapter specific keys end up in a
+    small overflow dictionary. The record behaves like a dictionary, so adapters can keep using
+    "mr.machines[mid][key]". Writes are reported to the registry, which keeps its secondary indexes
+    (site, status, machine type, ...) and change tracking in sync.
+    """
+    coreKeys = (MachineRegistry.regStatus, MachineRegistry.regStatusLastUpdate, MachineRegistry.regSite,
+                MachineRegistry.regSiteType, MachineRegistry.regMachineType, MachineRegistry.regHostname,
+                MachineRegistry.regInternalIp, MachineRegistry.regMachineCores, MachineRegistry.regMachineLoad,
+                MachineRegistry.regMachineBusy, MachineRegistry.regMachineDrain,
+                MachineRegistry.statusChangeHistory)
+    # slot names have to be native strings (Python 2)
+    __slots__ = tuple(str(key) for key in coreKeys) + ("_extra", "_registry", "_mid")
+    __coreKeys = frozenset(coreKeys)
+
+    def __init__(self, registry, mid, data=None):
+        self._extra = None
+        self._registry = registry
+        self._mid = mid
+        if data:
+            self.update(data)
+
+    def __getitem__(self, key):
+        if key in self.__coreKeys:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is not None:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        registry = self._registry
+        if registry is None:
+            self.__set(key, value)
+            return
+        # the machine lock keeps snapshots (see MachineRegistry._copyMachine) from seeing a half-written record
+        with registry._writeLock(self._mid, key in registry.indexedKeys):
+            if self._registry is None:
+                # removed meanwhile
+                self.__set(key, value)
+                return
+            registry._journal("set", self._mid, key, value)
+            self._assign(key, value)
+
+    def _assign(self, key, value):
+        """Set a field and update the registry indexes, but don't journal it (see MachineRegistry._writeLock)."""
+        registry = self._registry
+        if key in registry.indexedKeys:
+            oldValue = self.get(key, _missing)
+            self.__set(key, value)
+            registry._updateIndex(self._mid, key, oldValue, value)
+        else:
+            self.__set(key, value)
+        registry._recordChange(self._mid, registry.changeModified)
+
+    def __set(self, key, value):
+        if key in self.__coreKeys:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = dict()
+            self._extra[sys.intern(key) if PY3 else key] = value
+
+    def __delitem__(self, key):
+        registry = self._registry
+        if registry is None:
+            self.__delete(key)
+            return
+        with registry._writeLock(self._mid, key in registry.indexedKeys):
+            if self._registry is None:
+                self.__delete(key)
+                return
+            registry._journal("del", self._mid, key)
+            if key in registry.indexedKeys:
+                oldValue = self[key]
+                self.__delete(key)
+                registry._updateIndex(self._mid, key, oldValue, _missing)
+            else:
+                self.__delete(key)
+            registry._recordChange(self._mid, registry.changeModified)
+
+    def __delete(self, key):
+        if key in self.__coreKeys:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is not None:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.__coreKeys:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key in self.coreKeys:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return (sum(1 for key in self.coreKeys if hasattr(self, key)) +
+                (len(self._extra) if self._extra is not None else 0))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        # copies/pickles are detached from the registry
+        return type(self), (None, self._mid, dict(self))
+
+    def copy(self):
+        # type: () -> dict
+        """Return a plain dictionary copy."""
+        return dict(self)
+
+
 class MachineEvent(Event.EventBase):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, mid):
+    def __init__(self, mid, site=None):
         super(MachineEvent, self).__init__()
         self.id = mid
+        # site of the machine (if known), used to dispatch to site specific subscriptions
+        self.site = site
 
 
 class NewMachineEvent(MachineEvent):
     def __init__(self, mid):
+        # a new machine has no site yet, it's assigned by the site adapter afterwards
         super(NewMachineEvent, self).__init__(mid)
 
 
@@ -174,12 +1081,12 @@ class MachineRemovedEvent(MachineEvent):
     def __init__(self, mid, machine):
         # type: (str, dict) -> None
         """Event "Machine was removed from MachineRegistry", published to every registered listener."""
-        super(MachineRemovedEvent, self).__init__(mid)
+        super(MachineRemovedEvent, self).__init__(mid, machine.get(MachineRegistry.regSite))
         self.machine = machine
 
 
 class StatusChangedEvent(MachineEvent):
-    def __init__(self, mid, oldStatus, newStatus):
-        super(StatusChangedEvent, self).__init__(mid)
+    def __init__(self, mid, oldStatus, newStatus, site=None):
+        super(StatusChangedEvent, self).__init__(mid, site)
         self.newStatus = newStatus
         self.oldStatus = oldStatus
@@ -0,0 +1,500 @@
+# ===============================================================================
+#
+# Copyright (c) 2010, 2011 by Thomas Hauth and Stephan Riedel
+#
+# This file is part of ROCED.
+#
+# ROCED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ROCED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ROCED.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+from __future__ import unicode_literals, absolute_import
+
+import copy
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+from Util.Logging import MachineHistoryLogger, MachineRegistryLogger
+from . import MachineRegistry
+from . import ScaleTest
+
+
+class EventRecorder(object):
+    def __init__(self):
+        self.events = []
+
+    def onEvent(self, evt):
+        self.events.append(evt)
+
+
+class JournalRecorder(object):
+    def __init__(self):
+        self.entries = []
+        self.sequence = 0
+
+    def append(self, operation, mid, *args):
+        # copy values like serializing them would
+        self.sequence += 1
+        self.entries.append([self.sequence, operation, mid] +
+                            [list(arg) if isinstance(arg, deque) else copy.deepcopy(arg) for arg in args])
+
+
+class MachineRegistryTest(ScaleTest.ScaleTestBase):
+    def setUp(self):
+        super(MachineRegistryTest, self).setUp()
+        self.mr = MachineRegistry.MachineRegistry()
+        self.mr.clear()
+
+    def tearDown(self):
+        self.mr.clear()
+
+    def addMachine(self, site, machineType, status):
+        mid = self.mr.newMachine()
+        self.mr.machines[mid][self.mr.regSite] = site
+        self.mr.machines[mid][self.mr.regMachineType] = machineType
+        self.mr.updateMachineStatus(mid, status)
+        return mid
+
+    def test_getMachines(self):
+        logging.debug("=======Testing Machine Registry=======")
+        mid1 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        mid2 = self.addMachine("site1", "type2", self.mr.statusWorking)
+        mid3 = self.addMachine("site2", "type1", self.mr.statusWorking)
+
+        self.assertEqual(len(self.mr.getMachines()), 3)
+        self.assertEqual(set(self.mr.getMachines(site="site1")), {mid1, mid2})
+        self.assertEqual(set(self.mr.getMachines(status=self.mr.statusWorking)), {mid2, mid3})
+        self.assertEqual(set(self.mr.getMachines(site="site2", machineType="type1")), {mid3})
+        self.assertEqual(self.mr.getMachines(site="site3"), {})
+
+        # direct writes keep the indexes in sync
+        self.mr.updateMachineStatus(mid1, self.mr.statusWorking)
+        self.mr.machines[mid2][self.mr.regSite] = "site2"
+        self.assertEqual(set(self.mr.getMachines(site="site1", status=self.mr.statusWorking)), {mid1})
+        self.assertEqual(set(self.mr.getMachines(site="site2")), {mid2, mid3})
+
+        self.mr.removeMachine(mid3)
+        self.assertEqual(set(self.mr.getMachines(site="site2")), {mid2})
+        self.assertEqual(set(self.mr.getMachines(machineType="type1")), {mid1})
+
+    def test_replaceMachines(self):
+        self.addMachine("site1", "type1", self.mr.statusBooting)
+        self.mr.machines = {"vm1": {self.mr.regSite: "site2", self.mr.regStatus: self.mr.statusUp}}
+
+        self.assertEqual(self.mr.getMachines(site="site1"), {})
+        self.assertEqual(list(self.mr.getMachines(site="site2", status=self.mr.statusUp)), ["vm1"])
+
+    def test_machineRecord(self):
+        mid = self.addMachine("site1", "type1", self.mr.statusBooting)
+        machine = self.mr.machines[mid]
+        machine["adapter_specific_key"] = "value"
+
+        self.assertTrue(isinstance(machine, MachineRegistry.MachineRecord))
+        self.assertEqual(machine[self.mr.regSite], "site1")
+        self.assertEqual(machine.get("adapter_specific_key"), "value")
+        self.assertFalse(self.mr.regHostname in machine)
+        self.assertRaises(KeyError, lambda: machine[self.mr.regHostname])
+        self.assertEqual(machine.get(self.mr.regHostname, "none"), "none")
+
+        copy_ = dict(machine)
+        self.assertEqual(len(copy_), len(machine))
+        self.assertEqual(copy_["adapter_specific_key"], "value")
+        self.assertEqual(copy_[self.mr.regStatus], self.mr.statusBooting)
+
+        del machine["adapter_specific_key"]
+        self.assertFalse("adapter_specific_key" in machine)
+
+    def test_boundedHistory(self):
+        self.mr.historyLength = 2
+        try:
+            mid = self.addMachine("site1", "type1", self.mr.statusBooting)
+            for status_ in (self.mr.statusUp, self.mr.statusIntegrating, self.mr.statusWorking):
+                self.mr.updateMachineStatus(mid, status_)
+
+            history = self.mr.machines[mid][self.mr.statusChangeHistory]
+            self.assertEqual(len(history), 2)
+            self.assertEqual(history[-1]["new_status"], self.mr.statusWorking)
+
+            fullHistory = self.mr.getStatusHistory(mid)
+            self.assertEqual([entry["new_status"] for entry in fullHistory],
+                             [self.mr.statusBooting, self.mr.statusUp, self.mr.statusIntegrating,
+                              self.mr.statusWorking])
+        finally:
+            del self.mr.historyLength
+
+    def test_historyFile(self):
+        cwd, folder = os.getcwd(), tempfile.mkdtemp()
+        os.chdir(folder)
+        MachineHistoryLogger.reset()
+        try:
+            # the log folder is created on the first write
+            MachineHistoryLogger.append("vm-1", [{"new_status": "booting"}])
+            MachineHistoryLogger.append("vm-10", [{"new_status": "up"}])
+            MachineHistoryLogger.write()
+            self.assertTrue(os.path.isdir("log"))
+            MachineHistoryLogger.append("vm-1", [{"new_status": "up"}])
+            self.assertEqual(MachineHistoryLogger.query("vm-1"), [{"new_status": "booting"}, {"new_status": "up"}])
+
+            # lines of a previous run are indexed once
+            MachineHistoryLogger.reset()
+            self.assertEqual(MachineHistoryLogger.query("vm-10"), [{"new_status": "up"}])
+            self.assertEqual(MachineHistoryLogger.query("vm-2"), [])
+        finally:
+            MachineHistoryLogger.reset()
+            os.chdir(cwd)
+            shutil.rmtree(folder)
+
+    def test_countMachines(self):
+        mid1 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        self.addMachine("site1", "type2", self.mr.statusBooting)
+        self.addMachine("site2", "type1", self.mr.statusUp)
+
+        self.assertEqual(self.mr.countMachines(), 3)
+        self.assertEqual(self.mr.countMachines(site="site1", status=self.mr.statusBooting), 2)
+        self.assertEqual(self.mr.countMachinesPerType(status=[self.mr.statusBooting, self.mr.statusUp]),
+                         {"type1": 2, "type2": 1})
+
+        self.mr.updateMachineStatus(mid1, self.mr.statusUp)
+        self.mr.machines[mid1][self.mr.regSite] = "site2"
+        self.assertEqual(self.mr.countMachines(site="site2", status=self.mr.statusUp), 2)
+        self.assertEqual(self.mr.countMachines(site="site1"), 1)
+
+        self.mr.removeMachine(mid1)
+        self.assertEqual(self.mr.countMachines(site="site2"), 1)
+        self.assertEqual(self.mr.countMachines(status=self.mr.statusUp),
+                         len(self.mr.getMachines(status=self.mr.statusUp)))
+
+    def test_aggregate(self):
+        mid1 = self.addMachine("site1", "type1", self.mr.statusWorking)
+        self.addMachine("site1", "type1", self.mr.statusWorking)
+        self.addMachine("site2", "type2", self.mr.statusUp)
+        self.mr.update(mid1, {self.mr.regMachineDrain: True, self.mr.regMachineCores: 4})
+
+        aggregate = self.mr.aggregate()
+        self.assertEqual(aggregate.countMachinesPerType(site="site1"), {"type1": 2})
+        self.assertEqual(aggregate.countMachines(status=[self.mr.statusWorking, self.mr.statusUp]), 3)
+        self.assertEqual(aggregate.drainedCoresPerType(site="site1", status=self.mr.statusWorking), {"type1": 4})
+        with self.assertRaises(TypeError):
+            aggregate.counts[("site3", "type1", self.mr.statusUp)] = 1
+
+        # later changes don't affect the aggregate
+        self.mr.updateMachineStatus(mid1, self.mr.statusDisintegrated)
+        self.assertEqual(aggregate.countMachines(status=self.mr.statusWorking), 2)
+        self.assertEqual(self.mr.aggregate().countMachines(status=self.mr.statusWorking), 1)
+
+    def test_batch(self):
+        mid1 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        mid2 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        recorder = EventRecorder()
+        self.mr.registerListener(recorder)
+
+        with self.mr.batch():
+            self.mr.updateMachineStatus(mid1, self.mr.statusUp)
+            with self.mr.batch():
+                self.mr.updateMachineStatus(mid2, self.mr.statusUp)
+            self.mr.updateMachineStatus(mid2, self.mr.statusIntegrating)
+            mid3 = self.addMachine("site1", "type1", self.mr.statusBooting)
+            self.mr.removeMachine(mid1)
+            # registry itself is up to date, only events are deferred
+            self.assertEqual(self.mr.countMachines(status=self.mr.statusIntegrating), 1)
+            self.assertEqual(recorder.events, [])
+
+        # every event is published in order, including superseded transitions
+        self.assertEqual([type(evt) for evt in recorder.events],
+                         [MachineRegistry.StatusChangedEvent, MachineRegistry.StatusChangedEvent,
+                          MachineRegistry.StatusChangedEvent, MachineRegistry.NewMachineEvent,
+                          MachineRegistry.StatusChangedEvent, MachineRegistry.MachineRemovedEvent])
+        self.assertEqual([(evt.id, evt.newStatus) for evt in recorder.events[:3]],
+                         [(mid1, self.mr.statusUp), (mid2, self.mr.statusUp), (mid2, self.mr.statusIntegrating)])
+        self.assertEqual(recorder.events[3].id, mid3)
+        self.assertEqual(recorder.events[5].id, mid1)
+
+        recorder.events = []
+        with self.mr.batch():
+            for status in (self.mr.statusPendingDisintegration, self.mr.statusDisintegrating,
+                           self.mr.statusDisintegrated):
+                self.mr.updateMachineStatus(mid2, status)
+        self.assertEqual([evt.newStatus for evt in recorder.events],
+                         [self.mr.statusPendingDisintegration, self.mr.statusDisintegrating,
+                          self.mr.statusDisintegrated])
+
+    def test_iterMachines(self):
+        mid1 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        mid2 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        self.addMachine("site2", "type1", self.mr.statusBooting)
+
+        seen = []
+        for mid, machine in self.mr.iterMachines(site="site1", status=self.mr.statusBooting):
+            seen.append(mid)
+            self.assertEqual(machine[self.mr.regSite], "site1")
+            # changing machines while iterating is fine, changed machines are skipped
+            self.mr.updateMachineStatus(mid1, self.mr.statusUp)
+            self.mr.removeMachine(mid2)
+        self.assertEqual(len(seen), 1)
+
+        view = self.mr.view(site="site1")
+        self.assertEqual(len(view), 1)
+        self.assertTrue(mid1 in view)
+        self.assertFalse(mid2 in view)
+        self.assertEqual(list(view), [mid1])
+        self.assertEqual(view[mid1][self.mr.regStatus], self.mr.statusUp)
+        self.assertFalse(hasattr(view, "__setitem__"))
+
+        self.mr.updateMachineStatus(mid1, self.mr.statusDown)
+        self.assertEqual(len(self.mr.view(site="site1", status=self.mr.statusUp)), 0)
+        self.assertRaises(KeyError, lambda: self.mr.view(status=self.mr.statusUp)[mid1])
+
+    def test_timeouts(self):
+        mid1 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        self.mr.registerTimeout("boot", self.mr.statusBooting, 60, site="site1")
+        mid2 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        mid3 = self.addMachine("site2", "type1", self.mr.statusBooting)
+        now = datetime.now()
+
+        self.assertEqual(self.mr.getExpired("boot"), [])
+        self.assertEqual(sorted(self.mr.getExpired("boot", now + timedelta(seconds=61))), sorted([mid1, mid2]))
+        # expired machines are returned until their status changes
+        self.mr.updateMachineStatus(mid1, self.mr.statusUp)
+        self.assertEqual(self.mr.getExpired("boot", now + timedelta(seconds=61)), [mid2])
+        # deadlines are set again when (re-)entering the status
+        self.mr.updateMachineStatus(mid2, self.mr.statusBooting)
+        self.assertEqual(self.mr.getExpired("boot", now + timedelta(seconds=30)), [])
+        self.mr.removeMachine(mid2)
+        self.assertEqual(self.mr.getExpired("boot", now + timedelta(seconds=120)), [])
+
+        self.mr.setDeadline("manual", mid3, 10)
+        self.assertEqual(self.mr.getExpired("manual", now + timedelta(seconds=11)), [mid3])
+        self.mr.updateMachineStatus(mid3, self.mr.statusUp)
+        self.assertEqual(self.mr.getExpired("manual", now + timedelta(seconds=11)), [])
+
+    def test_keyIndex(self):
+        mid1 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        self.mr.machines[mid1]["batch_job_id"] = "1001"
+        self.mr.registerKeyIndex("batch_job_id")
+        mid2 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        self.mr.machines[mid2]["batch_job_id"] = "1002"
+
+        self.assertEqual(self.mr.lookup("batch_job_id", "1001"), mid1)
+        self.assertEqual(self.mr.lookup("batch_job_id", "1002"), mid2)
+        self.assertEqual(self.mr.lookup("batch_job_id", "1003"), None)
+
+        self.mr.machines[mid2]["batch_job_id"] = "1003"
+        self.assertEqual(self.mr.lookup("batch_job_id", "1002"), None)
+        self.assertEqual(self.mr.lookup("batch_job_id", "1003"), mid2)
+        self.mr.removeMachine(mid1)
+        self.assertEqual(self.mr.lookup("batch_job_id", "1001"), None)
+        # other indexes and counters are not affected
+        self.assertEqual(self.mr.countMachines(site="site1", status=self.mr.statusBooting), 1)
+
+        # indexes are rebuilt when the registry is replaced
+        self.mr.machines = {"vm1": {self.mr.regSite: "site1", "batch_job_id": "2001"}}
+        self.assertEqual(self.mr.lookup("batch_job_id", "2001"), "vm1")
+
+    def test_update(self):
+        mid = self.addMachine("site1", "type1", self.mr.statusBooting)
+        recorder = EventRecorder()
+        self.mr.registerListener(recorder)
+
+        self.mr.update(mid, {self.mr.regStatus: self.mr.statusUp, self.mr.regSite: "site2"},
+                       hostname="vm-1")
+        self.assertEqual(self.mr.machines[mid][self.mr.regHostname], "vm-1")
+        self.assertEqual(list(self.mr.getMachines(site="site2", status=self.mr.statusUp)), [mid])
+        self.assertEqual([(evt.id, evt.newStatus) for evt in recorder.events], [(mid, self.mr.statusUp)])
+
+        snapshot = self.mr.snapshot()
+        self.mr.machines[mid][self.mr.regHostname] = "vm-2"
+        self.assertEqual(snapshot[mid][self.mr.regHostname], "vm-1")
+        self.assertEqual(type(snapshot[mid]), dict)
+
+    def test_concurrency(self):
+        def worker(site):
+            with self.mr.batch():
+                for i in range(50):
+                    mid = self.addMachine(site, "type1", self.mr.statusBooting)
+                    self.mr.update(mid, status=self.mr.statusUp, machine_load=i)
+                    if i % 2 == 0:
+                        self.mr.removeMachine(mid)
+                    self.mr.snapshot()
+
+        threads = [threading.Thread(target=worker, args=("site%d" % i,)) for i in range(4)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+        self.assertEqual(self.mr.countMachines(status=self.mr.statusUp), 4 * 25)
+        for i in range(4):
+            self.assertEqual(self.mr.countMachines(site="site%d" % i), 25)
+            self.assertEqual(len(self.mr.getMachines(site="site%d" % i, status=self.mr.statusUp)), 25)
+
+    def test_machineLocking(self):
+        mid = self.addMachine("site1", "type1", self.mr.statusUp)
+        written = threading.Event()
+
+        def writer():
+            self.mr.machines[mid][self.mr.regMachineLoad] = 0.5
+            self.mr.update(mid, hostname="vm-1")
+            written.set()
+
+        # fields which are not indexed only need the machine lock
+        with self.mr._lock:
+            thread = threading.Thread(target=writer)
+            thread.start()
+            self.assertTrue(written.wait(5))
+        thread.join()
+        self.assertEqual(self.mr.machines[mid][self.mr.regHostname], "vm-1")
+
+    def test_snapshotWhileWriting(self):
+        mids = [self.addMachine("site1", "type1", self.mr.statusUp) for _ in range(50)]
+        done = threading.Event()
+        errors = []
+
+        def writer():
+            i = 0
+            while not done.is_set():
+                mid = mids[i % len(mids)]
+                self.mr.machines[mid]["key%d" % (i % 7)] = i
+                if i % 3 == 0:
+                    self.mr.machines[mid].pop("key%d" % ((i + 1) % 7), None)
+                i += 1
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            for _ in range(1000):
+                try:
+                    self.mr.snapshot()
+                except (RuntimeError, KeyError) as err:
+                    errors.append(err)
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_changeTracking(self):
+        mid1 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        mid2 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        self.mr.registerConsumer("test")
+        generation = self.mr.generation
+
+        self.assertFalse(self.mr.checkpoint("test").changed)
+        mid3 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        self.mr.machines[mid1][self.mr.regHostname] = "vm-1"
+        self.mr.removeMachine(mid2)
+        mid4 = self.mr.newMachine()
+        self.mr.removeMachine(mid4)
+
+        changes = self.mr.checkpoint("test")
+        self.assertTrue(changes.changed)
+        self.assertTrue(changes.generation > generation)
+        self.assertEqual((changes.created, changes.modified, changes.removed), ({mid3}, {mid1}, {mid2}))
+
+        self.mr.updateMachineStatus(mid3, self.mr.statusUp)
+        changes = self.mr.checkpoint("test")
+        self.assertEqual((changes.created, changes.modified, changes.removed), (set(), {mid3}, set()))
+        self.assertFalse(self.mr.checkpoint("test").changed)
+
+    def test_journaledSnapshotWhileChanging(self):
+        mr = self.mr
+        results = []
+
+        class SnapshotOnAppend(JournalRecorder):
+            def append(self, operation, mid_, *args):
+                # snapshot from another thread between journaling and applying the change
+                super(SnapshotOnAppend, self).append(operation, mid_, *args)
+                thread = threading.Thread(target=lambda: results.append(mr.journaledSnapshot()))
+                thread.start()
+                thread.join(0.2)
+                self.threads.append(thread)
+
+        journal = SnapshotOnAppend()
+        journal.threads = []
+        self.mr.journal = journal
+        self.mr.newMachine("new")
+        [thread.join() for thread in journal.threads]
+
+        self.assertEqual(len(results), journal.sequence)
+        # a snapshot covering the new machine's journal entry has to contain it
+        for snapshot, sequence in results:
+            if sequence >= 1:
+                self.assertIn("new", snapshot)
+
+    def test_journal(self):
+        mid1 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        mid2 = self.addMachine("site1", "type1", self.mr.statusBooting)
+        journal = JournalRecorder()
+        self.mr.journal = journal
+        snapshot, sequence = self.mr.journaledSnapshot()
+        self.assertEqual(sequence, 0)
+
+        mid3 = self.addMachine("site2", "type1", self.mr.statusBooting)
+        self.mr.update(mid1, {self.mr.regHostname: "vm-1"}, status=self.mr.statusUp)
+        del self.mr.machines[mid1][self.mr.regHostname]
+        self.mr.removeMachine(mid2)
+        self.mr.newMachine(mid3)
+        self.mr.machines[mid3][self.mr.regSite] = "site3"
+
+        # replaying the journal on top of the old snapshot restores the current state
+        self.assertEqual(MachineRegistryLogger.replay(snapshot, journal.entries, sequence), journal.sequence)
+        self.assertEqual(snapshot, self.mr.snapshot())
+        self.assertEqual(self.mr.journaledSnapshot()[1], journal.sequence)
+        # already contained entries are skipped
+        self.assertEqual(MachineRegistryLogger.replay(snapshot, journal.entries, journal.sequence), journal.sequence)
+        self.assertEqual(snapshot, self.mr.snapshot())
+
+        # missing entries are reported
+        with self.assertLogs("Core", logging.ERROR):
+            MachineRegistryLogger.replay(copy.deepcopy(snapshot), journal.entries[2:], sequence)
+
+        # loading a state isn't journaled
+        self.mr.machines = snapshot
+        self.assertEqual(len(journal.entries), journal.sequence)
+        self.assertIs(self.mr.journal, journal)
+
+    def test_journalFile(self):
+        cwd, folder = os.getcwd(), tempfile.mkdtemp()
+        os.chdir(folder)
+        try:
+            MachineRegistryLogger.load()
+            self.mr.journal = MachineRegistryLogger
+            mid = self.addMachine("site1", "type1", self.mr.statusBooting)
+            MachineRegistryLogger.dump(*self.mr.journaledSnapshot())
+            self.mr.updateMachineStatus(mid, self.mr.statusUp)
+            MachineRegistryLogger.dump(*self.mr.journaledSnapshot())
+            self.mr.updateMachineStatus(mid, self.mr.statusIntegrating)
+
+            # the latest snapshot is broken: the backup and the journal kept for it restore the state
+            with open("log/machine_registry.json", "w") as file_:
+                file_.write("{")
+            state = MachineRegistryLogger.load()
+            self.assertEqual(state[mid][self.mr.regStatus], self.mr.statusIntegrating)
+            self.assertEqual(len(state[mid][self.mr.statusChangeHistory]), 3)
+        finally:
+            self.mr.journal = None
+            MachineRegistryLogger.close()
+            os.chdir(cwd)
+            shutil.rmtree(folder)
+
+    def test_applyChanges(self):
+        mid = self.addMachine("site1", "type1", self.mr.statusBooting)
+        journal = JournalRecorder()
+        self.mr.journal = journal
+        # fields or machines the core dropped meanwhile are skipped
+        self.mr.applyChanges([("del", mid, "worker_key"), ("set", "vm-gone", "worker_key", 1),
+                              ("set", mid, "worker_key", 2), ("del", mid, self.mr.regHostname)])
+        self.assertEqual(self.mr.machines[mid]["worker_key"], 2)
+        self.assertEqual([entry[1:] for entry in journal.entries], [["set", mid, "worker_key", 2]])
+        self.mr.journal = None
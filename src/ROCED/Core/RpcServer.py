@@ -0,0 +1,54 @@
+# ===============================================================================
+#
+# Copyright (c) 2010, 2011 by Thomas Hauth and Stephan Riedel
+# 
+# This file is part of ROCED.
+# 
+# ROCED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# ROCED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with ROCED.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+from __future__ import unicode_literals, absolute_import
+
+import logging
+import threading
+
+import xmlrpc.server
+
+
+class LocalRpcServer(xmlrpc.server.SimpleXMLRPCServer):
+    """XML-RPC server for local clients (e.g. a batch system submit hook), handled on a background thread.
+
+    Adapters and the core export their methods with "exportMethod", i.e. register_function.
+    """
+
+    def __init__(self, port, host="localhost"):
+        # type: (int, str) -> None
+        xmlrpc.server.SimpleXMLRPCServer.__init__(self, (host, port), logRequests=False, allow_none=True)
+        self.logger = logging.getLogger("RPC")
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is not None:
+            return
+        self.__thread = threading.Thread(target=self.serve_forever, name="LocalRpcServer")
+        self.__thread.daemon = True
+        self.__thread.start()
+        self.logger.info("Listening on %s:%d." % self.server_address[:2])
+
+    def stop(self):
+        if self.__thread is None:
+            return
+        self.shutdown()
+        self.server_close()
+        self.__thread = None
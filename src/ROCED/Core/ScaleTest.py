@@ -21,9 +21,46 @@
 
 
 import logging
+import threading
+import time
 import unittest
 
 
 class ScaleTestBase(unittest.TestCase):
     def setUp(self):
         logging.basicConfig(level=logging.DEBUG)
+
+
+class Rendezvous(object):
+    """Lets a number of calls wait for each other, which only succeeds if they run at the same time.
+
+    Used instead of timing calls to check they run concurrently.
+    """
+
+    def __init__(self, parties, timeout=5):
+        self.parties = parties
+        self.timeout = timeout
+        self.arrived = 0
+        self.complete = threading.Event()
+        self.__lock = threading.Lock()
+
+    def arrive(self):
+        with self.__lock:
+            self.arrived += 1
+            if self.arrived >= self.parties:
+                self.complete.set()
+
+    def wait(self):
+        self.arrive()
+        if not self.complete.wait(self.timeout):
+            raise RuntimeError("Only %d of %d calls ran at once." % (self.arrived, self.parties))
+
+
+def waitUntil(condition, timeout=5):
+    """Poll condition() until it holds. Return False if the timeout expired first."""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
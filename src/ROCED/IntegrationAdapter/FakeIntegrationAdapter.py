@@ -44,37 +44,39 @@ class FakeIntegrationAdapter(IntegrationAdapterBase):
                                      description="Site name")
         self.addOptionalConfigKeys(self.configSiteLogger, Config.ConfigTypeString,
                                    description="Logger name of Site Adapter", default="FakeInt")
-        self.mr.registerListener(self)
 
     def init(self):
         super(FakeIntegrationAdapter, self).init()
         self.logger = logging.getLogger(self.getConfig("logger_name"))
         self.siteName = self.getConfig(self.configSiteName)
+        self.timeoutDisintegrating = "%s_disintegrating" % self.siteName
+        self.mr.registerTimeout(self.timeoutDisintegrating, self.mr.statusDisintegrating,
+                                lambda mid: random.randint(2, 6), site=self.siteName)
+        for status in (self.mr.statusUp, self.mr.statusWorking, self.mr.statusPendingDisintegration):
+            self.mr.subscribe(self, MachineRegistry.StatusChangedEvent, site=self.siteName, newStatus=status)
 
     def manage(self):
         [self.mr.updateMachineStatus(mid, self.mr.statusDisintegrated) for mid
-         in self.mr.getMachines(site=self.siteName, status=self.mr.statusDisintegrating)
-         if self.mr.calcLastStateChange(mid) > random.randint(2, 6)]
+         in self.mr.getExpired(self.timeoutDisintegrating)]
 
         # In our test cases, this is done by site adapter & requirement adapter
         # [self.mr.updateMachineStatus(mid, self.mr.statusPendingDisintegration) for mid
         #  in self.mr.getMachines(status=self.mr.statusWorking)
         #  if self.mr.calcLastStateChange(mid) > random.randint(2, 6)]
-        [self.mr.updateMachineStatus(mid, self.mr.statusWorking) for mid
-         in self.mr.getMachines(site=self.siteName, status=self.mr.statusIntegrating)]
+        [self.mr.updateMachineStatus(mid, self.mr.statusWorking) for mid, _
+         in self.mr.iterMachines(site=self.siteName, status=self.mr.statusIntegrating)]
 
     def onEvent(self, evt):
-        if (isinstance(evt, MachineRegistry.StatusChangedEvent) and
-                    self.mr.machines[evt.id].get(self.mr.regSite) == self.siteName):
-            if evt.newStatus == self.mr.statusUp:
-                self.logger.info("Integrating machine with ip %s" % self.mr.machines[evt.id].get(self.mr.regHostname))
-                # ha, new machine to integrate
-                self.mr.updateMachineStatus(evt.id, self.mr.statusIntegrating)
-            elif evt.newStatus == self.mr.statusWorking:
-                self.mr.machines[evt.id][self.mr.regMachineLoad] = 0
-            elif evt.newStatus == self.mr.statusPendingDisintegration:
-                # ha, machine to disintegrate
-                self.mr.updateMachineStatus(evt.id, self.mr.statusDisintegrating)
+        # type: (MachineRegistry.StatusChangedEvent) -> None
+        if evt.newStatus == self.mr.statusUp:
+            self.logger.info("Integrating machine with ip %s" % self.mr.machines[evt.id].get(self.mr.regHostname))
+            # ha, new machine to integrate
+            self.mr.updateMachineStatus(evt.id, self.mr.statusIntegrating)
+        elif evt.newStatus == self.mr.statusWorking:
+            self.mr.machines[evt.id][self.mr.regMachineLoad] = 0
+        elif evt.newStatus == self.mr.statusPendingDisintegration:
+            # ha, machine to disintegrate
+            self.mr.updateMachineStatus(evt.id, self.mr.statusDisintegrating)
 
     @property
     def description(self):
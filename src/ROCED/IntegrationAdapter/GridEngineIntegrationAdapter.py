@@ -45,7 +45,8 @@ class GridEngineIntegrationAdapter(IntegrationAdapterBase):
 
     def init(self):
         super(GridEngineIntegrationAdapter, self).init()
-        self.mr.registerListener(self)
+        for status in (self.mr.statusUp, self.mr.statusPendingDisintegration):
+            self.mr.subscribe(self, MachineRegistry.StatusChangedEvent, newStatus=status)
 
     def manage(self):
         """called every manage cycle"""
@@ -124,33 +125,31 @@ class GridEngineIntegrationAdapter(IntegrationAdapterBase):
         return ssh.handleSshCall(cmd)
 
     def onEvent(self, evt):
+        # type: (MachineRegistry.StatusChangedEvent) -> None
+        if evt.newStatus == self.mr.statusUp:
+            logging.info("Integrating machine with ip %s"
+                         % self.mr.machines[evt.id].get(self.mr.regHostname))
 
-        if isinstance(evt, MachineRegistry.StatusChangedEvent):
+            self.mr.updateMachineStatus(evt.id, self.mr.statusIntegrating)
 
-            if evt.newStatus == self.mr.statusUp:
-                logging.info("Integrating machine with ip %s"
-                             % self.mr.machines[evt.id].get(self.mr.regHostname))
+            res_ge = self.integrateWithGridEngine(evt.id)
+            res_node = self.integrateNode(evt.id)
 
-                self.mr.updateMachineStatus(evt.id, self.mr.statusIntegrating)
+            if res_ge[0] == 0 and res_node[0] == 0:  # check if ssh commands were successful
+                self.mr.updateMachineStatus(evt.id, self.mr.statusWorking)
 
-                res_ge = self.integrateWithGridEngine(evt.id)
-                res_node = self.integrateNode(evt.id)
+        if evt.newStatus == self.mr.statusPendingDisintegration:
+            logging.info("Disintegrating machine with ip %s"
+                         % self.mr.machines[evt.id].get(self.mr.regHostname))
 
-                if res_ge[0] == 0 and res_node[0] == 0:  # check if ssh commands were successful
-                    self.mr.updateMachineStatus(evt.id, self.mr.statusWorking)
+            res = self.drainNode(
+                evt.id)  # delete/drain node so that no new jobs are executed on the node
 
-            if evt.newStatus == self.mr.statusPendingDisintegration:
-                logging.info("Disintegrating machine with ip %s"
-                             % self.mr.machines[evt.id].get(self.mr.regHostname))
+            if res[0] == 0:  # check if ssh command was successful
+                self.mr.updateMachineStatus(evt.id, self.mr.statusDisintegrating)
 
-                res = self.drainNode(
-                    evt.id)  # delete/drain node so that no new jobs are executed on the node
-
-                if res[0] == 0:  # check if ssh command was successful
-                    self.mr.updateMachineStatus(evt.id, self.mr.statusDisintegrating)
-
-                logging.info("Draining node %s"
-                             % self.mr.machines[evt.id][self.reg_gridengine_node_name])
+            logging.info("Draining node %s"
+                         % self.mr.machines[evt.id][self.reg_gridengine_node_name])
 
     @property
     def description(self):
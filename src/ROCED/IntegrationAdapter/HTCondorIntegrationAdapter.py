@@ -110,7 +110,22 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
         :return:
         """
         super(HTCondorIntegrationAdapter, self).init()
-        self.mr.registerListener(self)
+        self.mr.subscribe(self, MachineRegistry.StatusChangedEvent, site=self.siteName, newStatus=self.mr.statusUp)
+
+        # state timeouts, checked in manage
+        condor_timeout = self.getConfig(self.configCondorDeadline) * 60
+        self.timeoutIntegrating = "%s_integrating" % self.siteName
+        self.timeoutWorking = "%s_working" % self.siteName
+        self.timeoutPendingDisintegration = "%s_pending_disintegration" % self.siteName
+        self.timeoutDisintegrating = "%s_disintegrating" % self.siteName
+        self.mr.registerTimeout(self.timeoutIntegrating, self.mr.statusIntegrating, condor_timeout,
+                                site=self.siteName)
+        self.mr.registerTimeout(self.timeoutWorking, self.mr.statusWorking,
+                                self.getConfig(self.configCondorWaitWorking) * 60, site=self.siteName)
+        self.mr.registerTimeout(self.timeoutPendingDisintegration, self.mr.statusPendingDisintegration,
+                                self.getConfig(self.configCondorWaitPD) * 60, site=self.siteName)
+        self.mr.registerTimeout(self.timeoutDisintegrating, self.mr.statusDisintegrating, condor_timeout,
+                                site=self.siteName)
 
     @classmethod
     def calcMachineLoad(cls, machine_id):
@@ -215,13 +230,9 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
         :return:
         """
 
-        condor_timeout = self.getConfig(self.configCondorDeadline) * 60
-        condor_wait_working = self.getConfig(self.configCondorWaitWorking) * 60
-        condor_wait_PD = self.getConfig(self.configCondorWaitPD) * 60
-
         try:
             condor_machines = self.condorList
-            if condor_machines is None or len(self.mr.getMachines(self.siteName)) == 0:
+            if condor_machines is None or self.mr.countMachines(self.siteName) == 0:
                 raise ValueError
         except ValueError as err:
             if str(err):
@@ -229,69 +240,75 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
             self.logger.debug("Content of machine registry:\n%s" % self.getSiteMachines())
             return None
 
+        # machines which exceeded the timeouts of their current status
+        integrating_timed_out = set(self.mr.getExpired(self.timeoutIntegrating))
+        working_timed_out = set(self.mr.getExpired(self.timeoutWorking))
+        pending_disintegration_timed_out = set(self.mr.getExpired(self.timeoutPendingDisintegration))
+        disintegrating_timed_out = set(self.mr.getExpired(self.timeoutDisintegrating))
+
         # check machine registry
-        for mid in self.mr.getMachines(self.siteName):
-            machine_ = self.mr.machines[mid]
-
-            # Is an "Integrating" machine completely started up? (appears in condor) -> "Working"
-            if machine_[self.mr.regStatus] == self.mr.statusIntegrating:
-                if machine_[self.reg_site_server_node_name] in condor_machines:
-                    self.mr.updateMachineStatus(mid, self.mr.statusWorking)
-                    # number of cores = number of slots
-                    self.mr.machines[mid][self.reg_site_condor_status] = condor_machines[
-                        machine_[self.reg_site_server_node_name]]
-                    self.mr.machines[mid][self.mr.regMachineCores] = len(
-                        self.mr.machines[mid][self.reg_site_condor_status])
-                # Machine stuck integrating? -> Disintegrated
-                elif self.mr.calcLastStateChange(mid) > condor_timeout:
-                    self.mr.updateMachineStatus(mid, self.mr.statusDisintegrated)
-
-            # "Working" machines has minimal one claimed slot, otherwise they are "unclaimed".
-            # -> "pending disintegration"
-            if machine_[self.mr.regStatus] == self.mr.statusWorking:
-                if machine_[self.reg_site_server_node_name] in condor_machines:
-                    # update condor slot status & calculate machine load
-                    self.mr.machines[mid][self.reg_site_condor_status] = condor_machines[
-                        machine_[self.reg_site_server_node_name]]
-                    if self.isMachineBusy(mid) == False and self.mr.calcLastStateChange(mid) > condor_wait_working:
-                        self.mr.updateMachineStatus(mid, self.mr.statusPendingDisintegration)
-                    # If slot activity/machine state indicate draining -> Pending Disintegration
-                    if self.calcDrainStatus(mid)[1] is True:
-                        self.mr.updateMachineStatus(mid, self.mr.statusPendingDisintegration)
-                else:
-                    # Machine disappeared
-                    self.mr.updateMachineStatus(mid, self.mr.statusDisintegrating)
-
-            # check if machines pending disintegration can be (disintegrating) or were shut down
-            # (disintegrated)
-            elif machine_[self.mr.regStatus] == self.mr.statusPendingDisintegration:
-                # is machine (still) listed in condor machines (search for "condor name")?
-                if self.reg_site_server_node_name in machine_:
+        with self.mr.batch():
+            for mid, machine_ in self.mr.iterMachines(self.siteName):
+
+                # Is an "Integrating" machine completely started up? (appears in condor) -> "Working"
+                if machine_[self.mr.regStatus] == self.mr.statusIntegrating:
+                    if machine_[self.reg_site_server_node_name] in condor_machines:
+                        self.mr.updateMachineStatus(mid, self.mr.statusWorking)
+                        # number of cores = number of slots
+                        self.mr.machines[mid][self.reg_site_condor_status] = condor_machines[
+                            machine_[self.reg_site_server_node_name]]
+                        self.mr.machines[mid][self.mr.regMachineCores] = len(
+                            self.mr.machines[mid][self.reg_site_condor_status])
+                    # Machine stuck integrating? -> Disintegrated
+                    elif mid in integrating_timed_out:
+                        self.mr.updateMachineStatus(mid, self.mr.statusDisintegrated)
+
+                # "Working" machines has minimal one claimed slot, otherwise they are "unclaimed".
+                # -> "pending disintegration"
+                if machine_[self.mr.regStatus] == self.mr.statusWorking:
                     if machine_[self.reg_site_server_node_name] in condor_machines:
                         # update condor slot status & calculate machine load
                         self.mr.machines[mid][self.reg_site_condor_status] = condor_machines[
                             machine_[self.reg_site_server_node_name]]
-                        self.isMachineBusy(mid)
-
-                        # at least one slot is claimed -> re-enable
-                        # TODO: Switch to an integer "cores_claimed" and compare > 0
-                        if self.mr.machines[mid][self.mr.regMachineBusy] == True:
-                            # Only re-enable non-draining nodes
-                            if self.calcDrainStatus(mid)[1] is False:
-                                self.mr.updateMachineStatus(mid, self.mr.statusWorking)
-                        elif self.mr.calcLastStateChange(mid) > condor_wait_PD:
+                        if self.isMachineBusy(mid) == False and mid in working_timed_out:
+                            self.mr.updateMachineStatus(mid, self.mr.statusPendingDisintegration)
+                        # If slot activity/machine state indicate draining -> Pending Disintegration
+                        if self.calcDrainStatus(mid)[1] is True:
+                            self.mr.updateMachineStatus(mid, self.mr.statusPendingDisintegration)
+                    else:
+                        # Machine disappeared
+                        self.mr.updateMachineStatus(mid, self.mr.statusDisintegrating)
+
+                # check if machines pending disintegration can be (disintegrating) or were shut down
+                # (disintegrated)
+                elif machine_[self.mr.regStatus] == self.mr.statusPendingDisintegration:
+                    # is machine (still) listed in condor machines (search for "condor name")?
+                    if self.reg_site_server_node_name in machine_:
+                        if machine_[self.reg_site_server_node_name] in condor_machines:
+                            # update condor slot status & calculate machine load
+                            self.mr.machines[mid][self.reg_site_condor_status] = condor_machines[
+                                machine_[self.reg_site_server_node_name]]
+                            self.isMachineBusy(mid)
+
+                            # at least one slot is claimed -> re-enable
+                            # TODO: Switch to an integer "cores_claimed" and compare > 0
+                            if self.mr.machines[mid][self.mr.regMachineBusy] == True:
+                                # Only re-enable non-draining nodes
+                                if self.calcDrainStatus(mid)[1] is False:
+                                    self.mr.updateMachineStatus(mid, self.mr.statusWorking)
+                            elif mid in pending_disintegration_timed_out:
+                                self.mr.updateMachineStatus(mid, self.mr.statusDisintegrating)
+                        else:
                             self.mr.updateMachineStatus(mid, self.mr.statusDisintegrating)
                     else:
                         self.mr.updateMachineStatus(mid, self.mr.statusDisintegrating)
-                else:
-                    self.mr.updateMachineStatus(mid, self.mr.statusDisintegrating)
 
-            # "Disintegrating": -> Shutdown should be started (by site adapter)
-            # # If it's not listed in condor, it's done shutting down -> "disintegrated"
-            if machine_[self.mr.regStatus] == self.mr.statusDisintegrating:
-                if (machine_[self.reg_site_server_node_name] not in condor_machines or
-                            self.mr.calcLastStateChange(mid) > condor_timeout):
-                    self.mr.updateMachineStatus(mid, self.mr.statusDisintegrated)
+                # "Disintegrating": -> Shutdown should be started (by site adapter)
+                # # If it's not listed in condor, it's done shutting down -> "disintegrated"
+                if machine_[self.mr.regStatus] == self.mr.statusDisintegrating:
+                    if (machine_[self.reg_site_server_node_name] not in condor_machines or
+                                mid in disintegrating_timed_out):
+                        self.mr.updateMachineStatus(mid, self.mr.statusDisintegrated)
 
         self.logger.debug("Content of machine registry:\n%s" % self.getSiteMachines())
         self.logger.debug("Content of condor machines:\n%s" % condor_machines.items())
@@ -299,29 +316,35 @@ class HTCondorIntegrationAdapter(IntegrationAdapterBase):
     def onEvent(self, evt):
         """Event handler
 
-        Handle machine status changes. Called every time a machine status changes.
+        Handle machine status changes. Called every time a machine of this site changes to status up.
 
         :param evt:
         :return:
         """
-        if isinstance(evt, MachineRegistry.StatusChangedEvent):
-            # machines in status up are set to integrating
-            if evt.newStatus == self.mr.statusUp:
-                if self.mr.machines[evt.id].get(self.mr.regSite) == self.siteName:
-                    self.mr.updateMachineStatus(evt.id, self.mr.statusIntegrating)
+        # machines in status up are set to integrating
+        self.mr.updateMachineStatus(evt.id, self.mr.statusIntegrating)
 
     @property
     def description(self):
         return "HTCondorIntegrationAdapter"
 
     @property
-    @Caching(validityPeriod=-1, redundancyPeriod=900)
+    def prefetchQueries(self):
+        return {"condor_status": self._queryCondorList}
+
+    @property
     def condorList(self):
         # type: () -> Defaultdict(List)
         """Return list of condor machines {machine name : [[state, activity], [state, activity], ..]}
 
         :return: condor_machines
         """
+        return self.getPrefetched("condor_status", self._queryCondorList)
+
+    @Caching(validityPeriod=-1, redundancyPeriod=900)
+    def _queryCondorList(self):
+        # type: () -> Defaultdict(List)
+        """Query condor machines (condor_status)."""
 
         # load the connection settings from config
         condor_server = self.getConfig(self.configCondorServer)
@@ -105,3 +105,18 @@ class TorqueIntegrationAdapterTest(ScaleTest.ScaleTestBase):
         # integration.manage()
         # self.assertTrue( "python torqconf.py del_node cloud-001" in FakeSsh.ranCommands )
         # self.assertEqual( self.mr.machines[mid][self.mr.reg_status], self.mr.StatusDisintegrated )
+
+    def test_integrationFailed(self):
+        integration = TorqueIntegrationAdapter.TorqueIntegrationAdapter()
+        mid = self.mr.newMachine()
+        self.mr.updateMachineStatus(mid, self.mr.statusIntegrating)
+        evt = MachineRegistry.StatusChangedEvent(mid, self.mr.statusUp, self.mr.statusIntegrating)
+
+        # timed out or failed integrations are retried, then the machine is given up
+        for _ in range(integration.integrationRetries):
+            integration.integrationFailed(evt)
+            self.assertEqual(self.mr.machines[mid][self.mr.regStatus], self.mr.statusUp)
+            self.mr.updateMachineStatus(mid, self.mr.statusIntegrating)
+        integration.integrationFailed(evt, ValueError("ssh failed"))
+        self.assertEqual(self.mr.machines[mid][self.mr.regStatus], self.mr.statusPendingDisintegration)
+        self.assertEqual(integration.integrationFailures, {})
@@ -50,6 +50,12 @@ class TorqueIntegrationAdapter(IntegrationAdapterBase):
     reg_torque_bootstrap_url = "torque_bootstrap_url"
     reg_torque_node_ip = "torque_node_ip"
 
+    # integrations (remote calls) running at once and their timeout in seconds
+    integrationConcurrency = 8
+    integrationTimeout = 600
+    # failed integrations are retried, then the machine is disintegrated
+    integrationRetries = 2
+
     def __init__(self):
         super(TorqueIntegrationAdapter, self).__init__()
 
@@ -61,13 +67,24 @@ class TorqueIntegrationAdapter(IntegrationAdapterBase):
         self.torqKey = None
 
         self.torqInternalIp = None
+        # machine id -> failed integrations
+        self.integrationFailures = dict()
 
         self.torqNodeBootstrapRoot = None
         self.torqNodeBootstrapUrl = None
 
     def init(self):
         super(TorqueIntegrationAdapter, self).init()
-        self.mr.registerListener(self)
+        self.mr.subscribe(self, MachineRegistry.StatusChangedEvent, newStatus=self.mr.statusUp)
+        self.mr.subscribe(self.disintegrate, MachineRegistry.StatusChangedEvent,
+                          newStatus=self.mr.statusPendingDisintegration)
+        self.mr.subscribe(self.integrate, MachineRegistry.StatusChangedEvent, newStatus=self.mr.statusIntegrating,
+                          asynchronous=True, maxConcurrent=self.integrationConcurrency,
+                          timeout=self.integrationTimeout, onTimeout=self.integrationFailed,
+                          onError=self.integrationFailed)
+        self.mr.subscribe(self.rediscoverNode, MachineRegistry.StatusChangedEvent, newStatus=self.mr.statusWorking,
+                          asynchronous=True, maxConcurrent=self.integrationConcurrency,
+                          timeout=self.integrationTimeout)
 
     def manage(self):
 
@@ -179,48 +196,82 @@ class TorqueIntegrationAdapter(IntegrationAdapterBase):
             return ssh.handleSshCall(cmd)
 
     def onEvent(self, evt):
-        if isinstance(evt, MachineRegistry.StatusChangedEvent):
-            if evt.newStatus == self.mr.statusUp:
-                logging.debug("Integrating machine with ip %s" %
-                              self.mr.machines[evt.id].get(self.mr.regHostname))
-
-                # ha, new machine to integrate
-                self.mr.updateMachineStatus(evt.id, self.mr.statusIntegrating)
-
-                self.integrateNode(evt.id)
-                self.integrateWithTorq(evt.id)
-
-                # TODO: only if everything worked
-                self.mr.updateMachineStatus(evt.id, self.mr.statusWorking)
-
-            # cat /etc/hosts | grep 172.19.1.100 | awk '{print $2}'
-            if evt.newStatus == self.mr.statusWorking:
-                # check if this node was added by us or if if is already running on the cluster, try to integrate
-                if self.mr.machines[evt.id].get(self.reg_torque_node_name, None) is None:
-                    # not listed internally, try to find the node name
-
-                    (res, nodeName) = self.runCommandOnPbs("python torqconf.py get_node_name %s" %
-                                                           self.mr.machines[evt.id].get(
-                                                               self.reg_torque_node_ip, "xxx.xxx.xxx.xxy"))
-                    nodeName = nodeName.strip()
-
-                    if (res == 0) and (len(nodeName) > 0):
-                        logging.info("rediscovered torque node: %s" % nodeName)
-                        self.mr.machines[evt.id][self.reg_torque_node_name] = nodeName
-                    else:
-                        logging.warning("cant rediscovered torque node: %s with internal ip %s" % (
-                            evt.id, self.mr.machines[evt.id].get(self.reg_torque_node_ip)))
-
-            if evt.newStatus == self.mr.statusPendingDisintegration:
-                # ha, machine to disintegrate
-                self.mr.updateMachineStatus(evt.id, self.mr.statusDisintegrating)
-
-                if self.mr.machines[evt.id].get(self.reg_torque_node_name, None) is None:
-                    # never registered with torqe, kill right away
-                    self.mr.updateMachineStatus(evt.id, self.mr.statusDisintegrated)
-                else:
-                    # set node offline. only remove as soon as no more jobs running
-                    self.setNodeOffline(evt.id)
+        # type: (MachineRegistry.StatusChangedEvent) -> None
+        logging.debug("Integrating machine with ip %s" %
+                      self.mr.machines[evt.id].get(self.mr.regHostname))
+
+        # ha, new machine to integrate, done by "integrate" in the background
+        self.mr.updateMachineStatus(evt.id, self.mr.statusIntegrating)
+
+    def integrate(self, evt):
+        # type: (MachineRegistry.StatusChangedEvent) -> callable
+        """Integrate a machine into torque (on a worker thread), the machine is set to working afterwards."""
+        self.integrateNode(evt.id)
+        self.integrateWithTorq(evt.id)
+
+        # TODO: only if everything worked
+        return lambda: self.__integrated(evt.id)
+
+    def __integrated(self, mid):
+        self.integrationFailures.pop(mid, None)
+        self.__setStatus(mid, self.mr.statusIntegrating, self.mr.statusWorking)
+
+    def integrationFailed(self, evt, error=None):
+        # type: (MachineRegistry.StatusChangedEvent, Exception) -> None
+        """Integration timed out or failed: retry (back to up), after integrationRetries disintegrate the machine."""
+        failures = self.integrationFailures.get(evt.id, 0) + 1
+        if failures > self.integrationRetries:
+            logging.error("Integrating machine %s failed %d times, disintegrating it." % (evt.id, failures))
+            self.integrationFailures.pop(evt.id, None)
+            self.__setStatus(evt.id, self.mr.statusIntegrating, self.mr.statusPendingDisintegration)
+        else:
+            logging.warning("Integrating machine %s failed, retrying." % evt.id)
+            self.integrationFailures[evt.id] = failures
+            self.__setStatus(evt.id, self.mr.statusIntegrating, self.mr.statusUp)
+
+    def rediscoverNode(self, evt):
+        # type: (MachineRegistry.StatusChangedEvent) -> callable
+        """Find the torque node name of a machine not integrated by us (on a worker thread).
+
+        :return: callable storing the node name
+        """
+        # cat /etc/hosts | grep 172.19.1.100 | awk '{print $2}'
+        # check if this node was added by us or if if is already running on the cluster, try to integrate
+        machine = self.mr.machines.get(evt.id)
+        if machine is None or machine.get(self.reg_torque_node_name, None) is not None:
+            return
+        # not listed internally, try to find the node name
+        nodeIp = machine.get(self.reg_torque_node_ip)
+        (res, nodeName) = self.runCommandOnPbs("python torqconf.py get_node_name %s" %
+                                               (nodeIp or "xxx.xxx.xxx.xxy"))
+        nodeName = nodeName.strip()
+
+        if (res == 0) and (len(nodeName) > 0):
+            logging.info("rediscovered torque node: %s" % nodeName)
+            return lambda: self.__setNodeName(evt.id, nodeName)
+        else:
+            logging.warning("cant rediscovered torque node: %s with internal ip %s" % (evt.id, nodeIp))
+
+    def __setNodeName(self, mid, nodeName):
+        if mid in self.mr.machines:
+            self.mr.machines[mid][self.reg_torque_node_name] = nodeName
+
+    def __setStatus(self, mid, oldStatus, newStatus):
+        """Status change after an asynchronous handler, unless the machine changed in the meantime."""
+        if self.mr.machines.get(mid, {}).get(self.mr.regStatus) == oldStatus:
+            self.mr.updateMachineStatus(mid, newStatus)
+
+    def disintegrate(self, evt):
+        # type: (MachineRegistry.StatusChangedEvent) -> None
+        # ha, machine to disintegrate
+        self.mr.updateMachineStatus(evt.id, self.mr.statusDisintegrating)
+
+        if self.mr.machines[evt.id].get(self.reg_torque_node_name, None) is None:
+            # never registered with torqe, kill right away
+            self.mr.updateMachineStatus(evt.id, self.mr.statusDisintegrated)
+        else:
+            # set node offline. only remove as soon as no more jobs running
+            self.setNodeOffline(evt.id)
 
     @property
     def description(self):
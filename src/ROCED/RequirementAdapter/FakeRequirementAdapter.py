@@ -73,7 +73,7 @@ class FakeRequirementAdapter(RequirementAdapterBase):
                     self._curRequirement -= 1
 
         # find "free" machines & assign jobs
-        for mid in self.mr.getMachines(status=self.mr.statusWorking):
+        for mid, _ in self.mr.iterMachines(status=self.mr.statusWorking):
             if self._curRequirement > 0 and self._jobcount > 0 and mid not in self.machinesRunningJobs:
                 self.machinesRunningJobs[mid] = time()
                 self.mr.machines[mid][self.mr.regMachineLoad] = 1
@@ -66,6 +66,9 @@ class GridEngineRequirementAdapter(RequirementAdapterBase):
 
     @property
     def requirement(self):
+        return self.getPushedRequirement(lambda: self.remoteCall(self._queryRequirement))
+
+    def _queryRequirement(self):
         """get the number of jobs currently queued/running in grid engine"""
         """
             for this method the ge bin files have to be locally available and a ssh tunnel to the
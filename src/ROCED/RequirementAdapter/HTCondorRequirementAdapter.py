@@ -84,8 +84,15 @@ class HTCondorRequirementAdapter(RequirementAdapterBase):
         return "HTCondorRequirementAdapter"
 
     @property
-    @Caching(validityPeriod=-1, redundancyPeriod=900)
+    def prefetchQueries(self):
+        return {"condor_q": self._queryRequirement}
+
+    @property
     def requirement(self):
+        return self.getPushedRequirement(lambda: self.getPrefetched("condor_q", self._queryRequirement))
+
+    @Caching(validityPeriod=-1, redundancyPeriod=900)
+    def _queryRequirement(self):
         ssh = ScaleTools.Ssh(host=self.getConfig(self.configCondorServer),
                              username=self.getConfig(self.configCondorUser),
                              key=self.getConfig(self.configCondorKey))
@@ -26,8 +26,9 @@ The broker then decides how many machines have to be started.
 """
 
 import abc
+import logging
 
-from Core.Adapter import AdapterBase, AdapterBoxBase
+from Core.Adapter import AdapterBase, AdapterBoxBase, PrefetchPending
 
 
 class RequirementAdapterBase(AdapterBase):
@@ -38,14 +39,16 @@ class RequirementAdapterBase(AdapterBase):
     def __init__(self, machineType="default"):
         super(RequirementAdapterBase, self).__init__()
         self._curRequirement = 0
+        # requirement set by setRequirement, not read yet (see getPushedRequirement)
+        self._requirementPushed = False
+        # called after a requirement was pushed, the core starts a cycle early then (see ScaleCore.wakeUp)
+        self.onRequirementPushed = None
         self._machineType = machineType
         self.setConfig(self.ConfigReqName, "DefaultReq")
 
     def init(self):
         super(RequirementAdapterBase, self).init()
-        self.exportMethod(lambda requirement_: self.__setattr__(name="requirement",
-                                                                value=requirement_),
-                          type(self).__name__ + "_setRequirement")
+        self.exportMethod(self.setRequirement, type(self).__name__ + "_setRequirement")
 
     @property
     def name(self):
@@ -72,6 +75,26 @@ class RequirementAdapterBase(AdapterBase):
             requirement_ = None
         self._curRequirement = requirement_
 
+    def setRequirement(self, requirement_):
+        """Push a requirement (RPC API), used until the adapter updates it itself.
+
+        A submit hook thus needs a single call to update the requirement and trigger the next cycle.
+        Subclasses may override the requirement property without setter, so the base setter is used."""
+        RequirementAdapterBase.requirement.__set__(self, requirement_)
+        self._requirementPushed = True
+        if self.onRequirementPushed is not None:
+            self.onRequirementPushed()
+        return True
+
+    def getPushedRequirement(self, query):
+        """Requirement pushed by setRequirement, if not read yet. Otherwise the query is run.
+
+        For adapters querying their requirement, so a pushed requirement is used once, until the next query."""
+        if self._requirementPushed:
+            self._requirementPushed = False
+            return self._curRequirement
+        return query()
+
     def getNeededMachineType(self):
         return self._machineType
 
@@ -94,7 +117,12 @@ class RequirementBox(AdapterBoxBase):
             if adapter.getNeededMachineType() not in needDict:
                 needDict[adapter.getNeededMachineType()] = 0
 
-            curReq = adapter.requirement
+            try:
+                curReq = adapter.requirement
+            except PrefetchPending as err:
+                # unknown in this cycle, the broker leaves the machine type as it is
+                logging.warning(err)
+                curReq = None
             if curReq is not None:
                 needDict[adapter.getNeededMachineType()] += int(curReq)
             else:
@@ -24,6 +24,7 @@ import logging
 
 from Core import ScaleTest
 from RequirementAdapter import Requirement
+from RequirementAdapter.HTCondorRequirementAdapter import HTCondorRequirementAdapter
 
 
 class RequirementAdapterTest(Requirement.RequirementAdapterBase):
@@ -66,3 +67,24 @@ class RequirementBoxTest(ScaleTest.ScaleTestBase):
         self.assertEqual(len(box.getMachineTypeRequirement()), 3)
         self.assertEqual(box.getMachineTypeRequirement()["type2"], 5)
         logging.info(str(box.getMachineTypeRequirement()))
+
+    def test_setRequirement(self):
+        adapter = HTCondorRequirementAdapter()
+        adapter.prefetched = {"condor_q": 3}
+        self.assertEqual(adapter.requirement, 3)
+
+        # a pushed requirement is used instead of the query, until the next query
+        self.assertTrue(adapter.setRequirement(7))
+        self.assertEqual(adapter.requirement, 7)
+        self.assertEqual(adapter.requirement, 3)
+        self.assertTrue(adapter.setRequirement(-1))
+        self.assertEqual(adapter.requirement, None)
+
+    def test_prefetchPending(self):
+        box = Requirement.RequirementBox()
+        adapter = HTCondorRequirementAdapter()
+        adapter.setConfig(adapter.configMachines, {"vm-default": {}})
+        box.addAdapter(adapter)
+        # condor_q is still running without an earlier result: unknown, instead of querying again
+        adapter.prefetchPending.add("condor_q")
+        self.assertEqual(box.getMachineTypeRequirement(), {"vm-default": None})
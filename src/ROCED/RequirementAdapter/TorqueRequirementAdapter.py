@@ -52,6 +52,9 @@ class TorqueRequirementAdapter(RequirementAdapterBase):
 
     @property
     def requirement(self):
+        return self.getPushedRequirement(lambda: self.remoteCall(self._queryRequirement))
+
+    def _queryRequirement(self):
         cmd = "qstat | egrep \"Q %s|R %s\" | wc -l" % (self.torqQName, self.torqQName)
 
         if self.torqKey is None:
@@ -137,6 +137,10 @@ class Ec2SiteAdapter(SiteAdapterBase):
 
         self.mr.registerListener(self)
 
+    @property
+    def prefetchQueries(self):
+        return {"ec2_machines": self.getEC2Machines}
+
     def getEC2Machines(self):
         """
         return all machines running on EC2
@@ -286,7 +290,7 @@ class Ec2SiteAdapter(SiteAdapterBase):
                 if r.groups()[0] not in images:
                     snapshot.delete()
 
-        if len(self.getSiteMachines()) == 0:
+        if self.countSiteMachines() == 0:
             ec2 = boto3.client(self.ec2)
             ec2.stop_instances(InstanceIds=self.getConfig(self.configServiceIDs).split())
 
@@ -324,7 +328,7 @@ class Ec2SiteAdapter(SiteAdapterBase):
         """
 
         # get machines from EC2
-        ec2_machines_status, ec2_machines_list = self.getEC2Machines()
+        ec2_machines_status, ec2_machines_list = self.getPrefetched("ec2_machines", self.getEC2Machines)
 
         machines_to_stop = list()
         machines_to_terminate = list()
@@ -333,8 +337,7 @@ class Ec2SiteAdapter(SiteAdapterBase):
         if ec2_machines_status is None:  # or (len(oao_machines) == 0):
             return
 
-        for mid in self.mr.getMachines(self.siteName):
-            machine = self.mr.machines[mid]
+        for mid, machine in self.mr.iterMachines(self.siteName):
 
             # check if machine is already deleted on site and remove it from machine registry
             # if not machine[self.reg_site_server_id] in ec2_machines_status:
@@ -416,13 +419,12 @@ class Ec2SiteAdapter(SiteAdapterBase):
                          % (self.siteName, self.runningMachinesCount[self._machineType]))
         json_log = JsonLog()
         json_log.addItem(self.siteName, "machines_requested",
-                         int(len(self.getSiteMachines(status=self.mr.statusBooting)) +
-                             len(self.getSiteMachines(status=self.mr.statusUp)) +
-                             len(self.getSiteMachines(status=self.mr.statusIntegrating))))
+                         self.countSiteMachines(status=[self.mr.statusBooting, self.mr.statusUp,
+                                                        self.mr.statusIntegrating]))
         json_log.addItem(self.siteName, "condor_nodes",
-                         len(self.getSiteMachines(status=self.mr.statusWorking)))
+                         self.countSiteMachines(status=self.mr.statusWorking))
         json_log.addItem(self.siteName, "condor_nodes_draining",
-                         len(self.getSiteMachines(status=self.mr.statusPendingDisintegration)))
+                         self.countSiteMachines(status=self.mr.statusPendingDisintegration))
 
     def onEvent(self, mid):
         """
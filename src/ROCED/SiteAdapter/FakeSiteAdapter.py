@@ -31,7 +31,7 @@ class FakeSiteAdapter(SiteAdapterBase):
         """A "hypothetical" site adapter, simulating regular behaviour.
 
          Simulated behaviour from a site:
-         - Boot machines via "spawnMachines" - this usually calls a site's API
+         - Boot machines via "spawnMachines"/"requestMachine" - this usually calls a site's API
          - Handle status changes via manage (e.g. an ordered machine started to boot)
          - Terminate running machines
          - Remove shutdown machines"""
@@ -44,45 +44,35 @@ class FakeSiteAdapter(SiteAdapterBase):
         self.bootTimeSigma = 2
 
     def init(self):
-        self.mr.registerListener(self)
+        self.mr.subscribe(self, MachineRegistry.StatusChangedEvent, site=self.siteName,
+                          newStatus=self.mr.statusDisintegrated)
+        self.timeoutBooting = "%s_booting" % self.siteName
+        self.mr.registerTimeout(self.timeoutBooting, self.mr.statusBooting,
+                                lambda mid: random.gauss(self.bootTimeMu, self.bootTimeSigma), site=self.siteName)
 
     def onEvent(self, evt):
-        if (isinstance(evt, MachineRegistry.StatusChangedEvent) and
-                    self.mr.machines[evt.id].get(self.mr.regSite) == self.siteName):
-            # check correct site etc...
-            if evt.newStatus == self.mr.statusDisintegrated:
-                # ha, machine to kill
-                self.mr.updateMachineStatus(evt.id, self.mr.statusDown)
+        # type: (MachineRegistry.StatusChangedEvent) -> None
+        # ha, machine to kill
+        self.mr.updateMachineStatus(evt.id, self.mr.statusDown)
 
     def manage(self):
-        for machineType in self.runningMachines:
-            [self.mr.updateMachineStatus(mid, self.mr.statusUp) for mid in self.runningMachines[machineType]
-             if self.mr.machines[mid][self.mr.regStatus] == self.mr.statusBooting and
-             self.mr.calcLastStateChange(mid) > random.gauss(self.bootTimeMu,
-                                                             self.bootTimeSigma)]
-        for mid in self.getSiteMachines(status=self.mr.statusDown):
+        [self.mr.updateMachineStatus(mid, self.mr.statusUp) for mid in self.mr.getExpired(self.timeoutBooting)]
+        for mid, _ in self.iterSiteMachines(status=self.mr.statusDown):
             self.mr.removeMachine(mid)
 
     def spawnMachines(self, machineType, count):
-        for i in range(count):
-            mid = self.mr.newMachine()
+        return len(self.requestMachines(machineType, count))
 
-            self.runningMachines[mid] = {}
-
-            self.mr.machines[mid][self.mr.regSite] = self.siteName
-            self.mr.machines[mid][self.mr.regMachineType] = machineType
-            self.mr.updateMachineStatus(mid, self.mr.statusBooting)
-
-        return count
+    def requestMachine(self, machineType, mid):
+        # the site's API would be called here
+        return {}
 
     def terminateMachines(self, machineType, count):
-        workingMachines = self.getSiteMachines(status=self.mr.statusWorking, machineType=machineType)
-
         toRemove = []
 
         # Pick machines with machine load 0!
-        for mid in workingMachines:
-            if workingMachines[mid].get(self.mr.regMachineLoad, 0) == 0:
+        for mid, machine in self.iterSiteMachines(status=self.mr.statusWorking, machineType=machineType):
+            if machine.get(self.mr.regMachineLoad, 0) == 0:
                 toRemove.append(mid)
 
         number = len(toRemove)
@@ -86,11 +86,18 @@ class FreiburgSiteAdapter(SiteAdapterBase):
         self.__default_machine = "vm-default"
 
     def init(self):
-        self.mr.registerListener(self)
         self.logger = logging.getLogger(self.getConfig(self.configSiteLogger))
         super(FreiburgSiteAdapter, self).init()
+        self.mr.subscribe(self, MachineRegistry.StatusChangedEvent, site=self.siteName,
+                          newStatus=self.mr.statusDisintegrated)
         self.__readVMNamePrefix()
         self.reg_site_server_node_name = "reg_site_server_node_name"
+        self.mr.registerKeyIndex(self.regMachineJobId)
+        self.timeoutDownCancel = "%s_down_cancel" % self.siteName
+        self.timeoutDownPurge = "%s_down_purge" % self.siteName
+        self.mr.registerTimeout(self.timeoutDownCancel, self.mr.statusDown, 5 * 60, site=self.siteName)
+        # job history purge time
+        self.mr.registerTimeout(self.timeoutDownPurge, self.mr.statusDown, 24 * 60 * 60, site=self.siteName)
 
 
 
@@ -115,7 +122,7 @@ class FreiburgSiteAdapter(SiteAdapterBase):
         # Machines that are found running get this type by default
         self.__default_machine = list(self.getConfig(self.ConfigMachines).keys())[0]
 
-        for mid, machine_ in self.getSiteMachines(status=self.mr.statusBooting).items():
+        for mid, machine_ in self.iterSiteMachines(status=self.mr.statusBooting):
             try:
                 idleJobs.remove(machine_[self.regMachineJobId])
             except ValueError:
@@ -150,29 +157,23 @@ class FreiburgSiteAdapter(SiteAdapterBase):
         super(FreiburgSiteAdapter, self).spawnMachines(machineType, count)
 
         maxMachinesPerCycle = self.getConfig(self.configMaxMachinesPerCycle)
-        machineSettings = self.getConfig(self.ConfigMachines)[machineType]
 
         if count > maxMachinesPerCycle:
             self.logger.info("%d machines requested, limited to %d for this cycle." % (count, maxMachinesPerCycle))
             count = maxMachinesPerCycle
-        for i in range(count):
-            # send batch jobs to boot machines
-            result = self.__execCmdInFreiburg("msub -j oe -m p -l walltime=%s,mem=%s,nodes=1:ppn=%d %s" % (machineSettings["walltime"], machineSettings["memory"], machineSettings["cores"], self.__vmStartScript))
+        self.requestMachines(machineType, count)
 
-            # std_out = batch job id
-            if result[0] == 0 and result[1].strip().isdigit():
-                mid = self.mr.newMachine()
-                self.mr.machines[mid][self.mr.regSite] = self.siteName
-                self.mr.machines[mid][self.mr.regMachineType] = machineType
-                self.mr.machines[mid][self.regMachineJobId] = result[1].strip()
-                self.mr.machines[mid][self.reg_site_server_node_name] = self.__getVMName(
-                    result[1].strip())
-                self.mr.machines[mid][self.mr.regSiteType] = self.siteType
-                self.mr.updateMachineStatus(mid, self.mr.statusBooting)
-            else:
-                self.logger.warning("A problem occurred while requesting VMs. Stopping for now."
-                                    "RC: %d; stdout: %s; stderr: %s" % (result[0], result[1], result[2]))
-                break
+    def requestMachine(self, machineType, mid):
+        """Send a batch job to boot a machine, its job ID identifies the machine."""
+        machineSettings = self.getConfig(self.ConfigMachines)[machineType]
+        result = self.__execCmdInFreiburg("msub -j oe -m p -l walltime=%s,mem=%s,nodes=1:ppn=%d %s" % (machineSettings["walltime"], machineSettings["memory"], machineSettings["cores"], self.__vmStartScript))
+
+        # std_out = batch job id
+        if result[0] != 0 or not result[1].strip().isdigit():
+            raise ValueError("A problem occurred while requesting a VM. RC: %d; stdout: %s; stderr: %s"
+                             % (result[0], result[1], result[2]))
+        return {self.regMachineJobId: result[1].strip(),
+                self.reg_site_server_node_name: self.__getVMName(result[1].strip())}
 
     def terminateMachines(self, machineType, count):
         """Terminate machines in Freiburg.
@@ -214,15 +215,13 @@ class FreiburgSiteAdapter(SiteAdapterBase):
 
         if len(idsRemoved + idsInvalidated) > 0:
             # update status
-            [self.logger.debug("Machine %s was terminated an is now DOWN " % mid) for mid, machine
-             in self.getSiteMachines().items()
-             if machine[self.regMachineJobId] in idsRemoved + idsInvalidated]
-            [self.mr.updateMachineStatus(mid, self.mr.statusDown) for mid, machine
-             in self.getSiteMachines().items()
-             if machine[self.regMachineJobId] in idsRemoved + idsInvalidated]
+            for batchJobId in set(idsRemoved + idsInvalidated):
+                mid = self.mr.lookup(self.regMachineJobId, batchJobId)
+                if mid is not None:
+                    self.logger.debug("Machine %s was terminated an is now DOWN " % mid)
+                    self.mr.updateMachineStatus(mid, self.mr.statusDown)
 
-    @property
-    def runningMachinesCount(self):
+    def countRunningMachines(self, aggregate=None):
         """Return dictionary with number of machines running at Freiburg. Depending on config file
         this may account for draining slots (claimed|retiring = working vs. claimed|idle = offline).
 
@@ -235,21 +234,18 @@ class FreiburgSiteAdapter(SiteAdapterBase):
         """
         # fall back to base method if required
         if self.getConfig(self.configIgnoreDrainingMachines) is True:
-            return super(FreiburgSiteAdapter, self).runningMachinesCount
+            return super(FreiburgSiteAdapter, self).countRunningMachines(aggregate)
         else:
-            runningMachines = self.runningMachines
+            if aggregate is None:
+                aggregate = self.mr.aggregate()
+            runningMachines = super(FreiburgSiteAdapter, self).countRunningMachines(aggregate)
+            # calculate number of drained slots (idle and not accepting new jobs -> not usable)
+            drainedSlots = aggregate.drainedCoresPerType(site=self.siteName, status=self.runningMachinesStatus)
             runningMachinesCount = dict()
             for machineType in runningMachines:
-                # calculate number of drained slots (idle and not accepting new jobs -> not usable)
-                nDrainedSlots = 0
-
-                for mid in runningMachines[machineType]:
-                    try:
-                        nDrainedSlots += self.mr.machines[mid][self.mr.regMachineDrain]*self.mr.machines[mid][self.mr.regMachineCores]
-                    except:
-                        self.logger.debug("can not count drained slots for machine %s" % mid)
+                nDrainedSlots = drainedSlots.get(machineType, 0)
                 nCores = self.getConfig(self.ConfigMachines)[machineType]["cores"]
-                nMachines = len(runningMachines[machineType])
+                nMachines = runningMachines[machineType]
                 # Calculate the number of available slots
                 # Little trick: floor division with negative values: -9//4 = -3
                 nDrainedSlots = -nDrainedSlots
@@ -262,34 +258,29 @@ class FreiburgSiteAdapter(SiteAdapterBase):
             return runningMachinesCount
 
     def onEvent(self, evt):
-        # type: (MachineRegistry.MachineEvent) -> None
-        """Event handler: Handles machine status changes.
+        # type: (MachineRegistry.StatusChangedEvent) -> None
+        """Event handler: Handles machines of this site changing to status disintegrated.
 
         Freiburg has some special logic here, since machines shutdown themselves after a 5 minute
         delay. This means we only have to cancel jobs, if we change to "Disintegrated" outside the
         regular execution.
         """
-        try:
-            if self.mr.machines[evt.id].get(self.mr.regSite, None) != self.siteName:
-                return
-        except KeyError:
+        if evt.id not in self.mr.machines:
             return
 
-        if isinstance(evt, MachineRegistry.StatusChangedEvent):
-            self.logger.debug("Status Change Event: %s (%s->%s)" % (evt.id, evt.oldStatus, evt.newStatus))
-            if evt.newStatus == self.mr.statusDisintegrated:
-                # Disintegrated information comes from integration adapter. Skipping state only happens with time out.
-                try:
-                    if (self.mr.machines[evt.id].get(self.regMachineJobId) in self.__runningJobs and
-                                evt.oldStatus != self.mr.statusDisintegrating):
-                        self.__cancelFreiburgMachines([self.mr.machines[evt.id].get(self.regMachineJobId)])
-                except Exception as err:
-                    self.logger.warning("Canceling machine failed with exception %s" % err)
-                self.logger.debug("Machine %s goes direct from state disintegrated to state down" % evt.id)
-                self.logger.debug("Event is %s" % repr(evt))
-                if hasattr(evt, '__dict__'):
-                    self.logger.debug("Event dict is %s" % repr(evt.__dict__))
-                self.mr.updateMachineStatus(evt.id, self.mr.statusDown)
+        self.logger.debug("Status Change Event: %s (%s->%s)" % (evt.id, evt.oldStatus, evt.newStatus))
+        # Disintegrated information comes from integration adapter. Skipping state only happens with time out.
+        try:
+            if (self.mr.machines[evt.id].get(self.regMachineJobId) in self.__runningJobs and
+                        evt.oldStatus != self.mr.statusDisintegrating):
+                self.__cancelFreiburgMachines([self.mr.machines[evt.id].get(self.regMachineJobId)])
+        except Exception as err:
+            self.logger.warning("Canceling machine failed with exception %s" % err)
+        self.logger.debug("Machine %s goes direct from state disintegrated to state down" % evt.id)
+        self.logger.debug("Event is %s" % repr(evt))
+        if hasattr(evt, '__dict__'):
+            self.logger.debug("Event dict is %s" % repr(evt.__dict__))
+        self.mr.updateMachineStatus(evt.id, self.mr.statusDown)
 
     def manage(self):
         # type: () -> None
@@ -317,93 +308,97 @@ class FreiburgSiteAdapter(SiteAdapterBase):
         frJobsRunning=frJobs[2]
         frJobsCompleted=frJobs[3]
 
-        mr = self.getSiteMachines()
-        for mid in mr:
-            batchJobId = mr[mid][self.regMachineJobId]
-            # Status handled by Integration Adapter
-            if mr[mid][self.mr.regStatus] in [self.mr.statusIntegrating, self.mr.statusWorking,
-                                              self.mr.statusPendingDisintegration,
-                                              self.mr.statusDisintegrating]:
-                try:
-                    frJobsRunning.pop(batchJobId)
-                    self.logger.debug('Removing batch-job %s from list of running Jobs' % mr[mid][self.regMachineJobId] )
-                    continue
-                except (KeyError, AttributeError, IndexError):
-                    # AttributeError: frJobsRunning is Empty
-                    # KeyError: batchJobId not in frJobsRunning
-                    self.logger.debug('Matching between machine registry entry %s and batch-job ID (%s) failed during removal of machines with ignorable states.' % (mid, mr[mid][self.regMachineJobId]))
-                    pass
-            # Machines which failed to boot/died/got canceled (return code != 0) -> down
-            # A machine MAY fail to boot with return code 0 or we just missed some states -> regular shutdown
-            if mr[mid][self.mr.regStatus] != self.mr.statusDown:
-                if batchJobId in frJobsCompleted:
-                    if mr[mid][self.mr.regStatus] == self.mr.statusBooting:
-                        self.logger.info("VM (%s) failed to boot!" % batchJobId)
-                    else:
-                        if frJobsCompleted[batchJobId] != "0":
-                            self.logger.info("VM (%s) died!" % batchJobId)
+        # down machines: cancel batch jobs still running after 5 minutes, forget machines after 1 day
+        downCancel = set(self.mr.getExpired(self.timeoutDownCancel))
+        downPurge = set(self.mr.getExpired(self.timeoutDownPurge))
+
+        with self.mr.batch():
+            mr = self.getSiteMachines()
+            for mid in mr:
+                batchJobId = mr[mid][self.regMachineJobId]
+                # Status handled by Integration Adapter
+                if mr[mid][self.mr.regStatus] in [self.mr.statusIntegrating, self.mr.statusWorking,
+                                                  self.mr.statusPendingDisintegration,
+                                                  self.mr.statusDisintegrating]:
+                    try:
+                        frJobsRunning.pop(batchJobId)
+                        self.logger.debug('Removing batch-job %s from list of running Jobs' % mr[mid][self.regMachineJobId] )
+                        continue
+                    except (KeyError, AttributeError, IndexError):
+                        # AttributeError: frJobsRunning is Empty
+                        # KeyError: batchJobId not in frJobsRunning
+                        self.logger.debug('Matching between machine registry entry %s and batch-job ID (%s) failed during removal of machines with ignorable states.' % (mid, mr[mid][self.regMachineJobId]))
+                        pass
+                # Machines which failed to boot/died/got canceled (return code != 0) -> down
+                # A machine MAY fail to boot with return code 0 or we just missed some states -> regular shutdown
+                if mr[mid][self.mr.regStatus] != self.mr.statusDown:
+                    if batchJobId in frJobsCompleted:
+                        if mr[mid][self.mr.regStatus] == self.mr.statusBooting:
+                            self.logger.info("VM (%s) failed to boot!" % batchJobId)
                         else:
-                            self.logger.debug("VM (%s) died with status 0!" % batchJobId)
-                    self.mr.updateMachineStatus(mid, self.mr.statusDown)
-            elif batchJobId in frJobsCompleted or self.mr.calcLastStateChange(mid) > 24 * 60 * 60:
-                # Remove machines, which are:
-                # 1. finished in ROCED & Freiburg // 2. Finished for more than 1 day [= job history purge time]
-                self.mr.removeMachine(mid)
-                continue
-            elif batchJobId in frJobsRunning:
-                # ROCED machine down, but job still running
-                try:
-                    frJobsRunning.pop(batchJobId)
-                    self.logger.debug('Removing batch-job (%s) from list of running Jobs' % batchJobId)
-                except (KeyError, AttributeError, IndexError):
-                    self.logger.debug('Matching between machine registry entry %s and batch-job ID (%s) failed during removal of down machines with still alive MOAB job.' % (mid, mr[mid][self.regMachineJobId]))
-                    pass
- 
-                if self.mr.calcLastStateChange(mid) > 5*60:
-                    self.__cancelFreiburgMachines(batchJobId)
-                continue
-
-            if mr[mid][self.mr.regStatus] == self.mr.statusBooting:
-                # batch job running: machine -> up
-                if batchJobId in frJobsRunning:
-                    del self.vanishedVMs[mid]
-                    self.mr.updateMachineStatus(mid, self.mr.statusUp)
-                    frJobsRunning.pop(batchJobId)
-                # Machine disappeared. If the MOAB job is completed.
-                elif batchJobId not in frJobsIdle and batchJobId not in frJobsCompleted:
-                    self.logger.info('Corresponding MOAB-job (%s) for machine %s was not found (%s retry) ' % (mr[mid][self.regMachineJobId], mid, self.vanishedVMs[mid]))
-                    self.vanishedVMs[mid] += 1
-                    if self.vanishedVMs[mid] >= 5:
-                        self.logger.debug("Corresponding Moab-job %s for machine %s was not found for 3 cycles" % (mr[mid][self.regMachineJobId], mid))
+                            if frJobsCompleted[batchJobId] != "0":
+                                self.logger.info("VM (%s) died!" % batchJobId)
+                            else:
+                                self.logger.debug("VM (%s) died with status 0!" % batchJobId)
                         self.mr.updateMachineStatus(mid, self.mr.statusDown)
+                elif batchJobId in frJobsCompleted or mid in downPurge:
+                    # Remove machines, which are:
+                    # 1. finished in ROCED & Freiburg // 2. Finished for more than 1 day [= job history purge time]
+                    self.mr.removeMachine(mid)
+                    continue
+                elif batchJobId in frJobsRunning:
+                    # ROCED machine down, but job still running
+                    try:
+                        frJobsRunning.pop(batchJobId)
+                        self.logger.debug('Removing batch-job (%s) from list of running Jobs' % batchJobId)
+                    except (KeyError, AttributeError, IndexError):
+                        self.logger.debug('Matching between machine registry entry %s and batch-job ID (%s) failed during removal of down machines with still alive MOAB job.' % (mid, mr[mid][self.regMachineJobId]))
+                        pass
+ 
+                    if mid in downCancel:
+                        self.__cancelFreiburgMachines(batchJobId)
+                    continue
+
+                if mr[mid][self.mr.regStatus] == self.mr.statusBooting:
+                    # batch job running: machine -> up
+                    if batchJobId in frJobsRunning:
+                        del self.vanishedVMs[mid]
+                        self.mr.updateMachineStatus(mid, self.mr.statusUp)
+                        frJobsRunning.pop(batchJobId)
+                    # Machine disappeared. If the MOAB job is completed.
+                    elif batchJobId not in frJobsIdle and batchJobId not in frJobsCompleted:
+                        self.logger.info('Corresponding MOAB-job (%s) for machine %s was not found (%s retry) ' % (mr[mid][self.regMachineJobId], mid, self.vanishedVMs[mid]))
+                        self.vanishedVMs[mid] += 1
+                        if self.vanishedVMs[mid] >= 5:
+                            self.logger.debug("Corresponding Moab-job %s for machine %s was not found for 3 cycles" % (mr[mid][self.regMachineJobId], mid))
+                            self.mr.updateMachineStatus(mid, self.mr.statusDown)
+                            del self.vanishedVMs[mid]
+                    else:
                         del self.vanishedVMs[mid]
-                else:
-                    del self.vanishedVMs[mid]
 
 
-        # All remaining unaccounted batch jobs
-        for batchJobId in frJobsRunning:
-            mid = self.mr.newMachine()
-            # TODO: try to identify machine type, using cores & wall-time
-            self.mr.machines[mid][self.mr.regSite] = self.siteName
-            self.mr.machines[mid][self.mr.regSiteType] = self.siteType
-            self.mr.machines[mid][self.mr.regMachineType] = self.__default_machine
-            self.mr.machines[mid][self.regMachineJobId] = batchJobId
-            self.mr.machines[mid][self.reg_site_server_node_name] = self.__getVMName(batchJobId)
-            self.mr.updateMachineStatus(mid, self.mr.statusUp)
+            # All remaining unaccounted batch jobs
+            for batchJobId in frJobsRunning:
+                mid = self.mr.newMachine()
+                # TODO: try to identify machine type, using cores & wall-time
+                self.mr.machines[mid][self.mr.regSite] = self.siteName
+                self.mr.machines[mid][self.mr.regSiteType] = self.siteType
+                self.mr.machines[mid][self.mr.regMachineType] = self.__default_machine
+                self.mr.machines[mid][self.regMachineJobId] = batchJobId
+                self.mr.machines[mid][self.reg_site_server_node_name] = self.__getVMName(batchJobId)
+                self.mr.updateMachineStatus(mid, self.mr.statusUp)
 
         self.logger.info("Machines using resources (Freiburg): %d" % self.cloudOccupyingMachinesCount)
 
         with JsonLog() as jsonLog:
             jsonLog.addItem(self.siteName, "nodes",
-                            len(self.getSiteMachines(status=self.mr.statusWorking)))
+                            self.countSiteMachines(status=self.mr.statusWorking))
             jsonLog.addItem(self.siteName, "nodes_draining",
-                            len([mid for mid in self.getSiteMachines(status=self.mr.statusPendingDisintegration)
-                                 if self.mr.machines[mid][self.mr.regMachineBusy] is True]))
+                            sum(1 for mid, machine in self.iterSiteMachines(status=self.mr.statusPendingDisintegration)
+                                if machine[self.mr.regMachineBusy] is True))
             jsonLog.addItem(self.siteName, "machines_requested",
-                            len(self.getSiteMachines(status=self.mr.statusBooting)) +
-                            len(self.getSiteMachines(status=self.mr.statusUp)) +
-                            len(self.getSiteMachines(status=self.mr.statusIntegrating)))
+                            self.countSiteMachines(status=[self.mr.statusBooting, self.mr.statusUp,
+                                                           self.mr.statusIntegrating]))
 
     def __execCmdInFreiburg(self, cmd):
         """Execute command on Freiburg login node via SSH.
@@ -486,8 +481,15 @@ class FreiburgSiteAdapter(SiteAdapterBase):
         return res
 
     @property
-    @Caching(validityPeriod=-1, redundancyPeriod=300)
+    def prefetchQueries(self):
+        return {"showq": self.__queryJobs}
+
+    @property
     def __getJobs(self):
+        return self.getPrefetched("showq", self.__queryJobs)
+
+    @Caching(validityPeriod=-1, redundancyPeriod=300)
+    def __queryJobs(self):
         # replaces old __runningJobs, __idleJobs and __completedJobs
         # Getting List of running, completed and idle Machines from the MOAB XML output:
         cmd = "showq --xml %s && showq -c --xml %s" % ( self.__userString, self.__userString )
@@ -64,18 +64,17 @@ class NovaSiteAdapter(SiteAdapterBase):
 
     def init(self):
         # todo: see whats running as we start up
-        self.mr.registerListener(self)
+        self.mr.subscribe(self, MachineRegistry.StatusChangedEvent, site=self.siteName,
+                          newStatus=self.mr.statusDisintegrated)
+        self.mr.registerKeyIndex(self.reg_site_euca_instance_id)
 
     def onEvent(self, evt):
-        if isinstance(evt, MachineRegistry.StatusChangedEvent):
-            if self.mr.machines[evt.id].get(self.mr.regSite) == self.siteName:
-                # check correct site etc...
-                if evt.newStatus == self.mr.statusDisintegrated:
-                    # ha, machine to kill
-                    self.eucaTerminateMachines(
-                        [self.mr.machines[evt.id].get(self.reg_site_euca_instance_id)])
-                    # TODO maybe use shutdown in between ?
-                    self.mr.updateMachineStatus(evt.id, self.mr.statusDown)
+        # type: (MachineRegistry.StatusChangedEvent) -> None
+        # ha, machine to kill
+        self.eucaTerminateMachines(
+            [self.mr.machines[evt.id].get(self.reg_site_euca_instance_id)])
+        # TODO maybe use shutdown in between ?
+        self.mr.updateMachineStatus(evt.id, self.mr.statusDown)
 
     def getConfigAsDict(self, onlyPublic=False):
         new = super(NovaSiteAdapter, self).getConfigAsDict(True)
@@ -83,14 +82,15 @@ class NovaSiteAdapter(SiteAdapterBase):
 
         return new
 
-    def getMachineByEucaId(self, machineList, euca_id):
-        m = [machineList[mid] for (mid, machine) in machineList.items()
-             if machine.get(self.reg_site_euca_instance_id) == euca_id]
-        if len(m) == 0:
+    def getMachineByEucaId(self, euca_id):
+        # type: (str) -> Optional[tuple]
+        """Return (machine ID, machine) of the machine with the given euca id or None."""
+        mid = self.mr.lookup(self.reg_site_euca_instance_id, euca_id)
+        if mid is None:
             # raise LookupError("Machine with euca id " + str(euca_id) + " not found in scale machine repository")
             return None
         else:
-            return m[0]
+            return mid, self.mr.machines[mid]
 
     def checkForDeadMachine(self, mid):
         logging.info("Machine %s is running but no ssh connect yet." % mid)
@@ -116,11 +116,9 @@ class NovaSiteAdapter(SiteAdapterBase):
             logging.error("cannot connect to eucalyptus, no manage cycle")
             return 0
 
-        myMachines = self.getSiteMachines()
-
         for r in reservations:
             for i in r.instances:
-                mach = self.getMachineByEucaId(myMachines, i.id)
+                mach = self.getMachineByEucaId(i.id)
                 if mach is not None:
 
                     if i.state == "terminated" and not mach[1].get(
@@ -211,8 +209,8 @@ class NovaSiteAdapter(SiteAdapterBase):
             return 0
 
     def terminateMachines(self, machineType, count):
-        booting = list(self.getSiteMachines(machineType=machineType, status=self.mr.statusBooting))
-        working = list(self.getSiteMachines(machineType=machineType, status=self.mr.statusWorking))
+        booting = [mid for mid, _ in self.iterSiteMachines(machineType=machineType, status=self.mr.statusBooting)]
+        working = [mid for mid, _ in self.iterSiteMachines(machineType=machineType, status=self.mr.statusWorking)]
 
         toRemove = booting + working
         toRemove = toRemove[0:count]
@@ -188,6 +188,7 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
         urllib3_logger.setLevel(logging.CRITICAL)
 
         self.mr.registerListener(self)
+        self.mr.registerKeyIndex(self.reg_site_server_id)
 
         # set name of Site Adapter for ROCED output
         self.logger = logging.getLogger(self.getConfig(self.configSiteLogger))
@@ -380,14 +381,9 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
 
         return
 
-    @property
-    def runningMachines(self):
-        """
-        Remapping of runningMachines to cloudOccupyingMachines
-        Both are defined in SiteAdapterBase in Site.py
-        :return:
-        """
-        return self.cloudOccupyingMachines
+    # Machines pending disintegration are still running and can accept new jobs, so all machines
+    # occupying cloud resources are counted as running machines.
+    runningMachinesStatus = SiteAdapterBase.cloudOccupyingMachinesStatus
 
     def spawnMachines(self, machineType, requested):
         """
@@ -516,8 +512,7 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
             return
 
         # loop over all machines in machine registry
-        for mid in self.mr.getMachines(self.siteName):
-            machine = self.mr.machines[mid]
+        for mid, machine in self.mr.iterMachines(self.siteName):
 
             # remove the corresponding machine from the 1and1 machine list
             try:
@@ -608,8 +603,7 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
         # add all machines remaining in machine list from 1&1
         for oao_machine in oao_machines:
             # check if machine is already in machine registry
-            if oao_machine in [machine[self.reg_site_server_id] for machine in \
-                               self.mr.getMachines(self.siteName).values()]:
+            if self.mr.lookup(self.reg_site_server_id, oao_machine) is not None:
                 continue
 
             # create new machine in machine registry
@@ -636,13 +630,12 @@ class OneAndOneSiteAdapter(SiteAdapterBase):
             list(self.getConfig(self.configMachines).keys())[0]]))  # ["vm-default"]))
         json_log = JsonLog()
         json_log.addItem(self.siteName, "machines_requested",
-                         int(len(self.getSiteMachines(status=self.mr.statusBooting)) +
-                             len(self.getSiteMachines(status=self.mr.statusUp)) +
-                             len(self.getSiteMachines(status=self.mr.statusIntegrating))))
+                         self.countSiteMachines(status=[self.mr.statusBooting, self.mr.statusUp,
+                                                        self.mr.statusIntegrating]))
         json_log.addItem(self.siteName, "condor_nodes",
-                         len(self.getSiteMachines(status=self.mr.statusWorking)))
+                         self.countSiteMachines(status=self.mr.statusWorking))
         json_log.addItem(self.siteName, "condor_nodes_draining",
-                         len(self.getSiteMachines(status=self.mr.statusPendingDisintegration)))
+                         self.countSiteMachines(status=self.mr.statusPendingDisintegration))
 
     def onEvent(self, mid):
         """
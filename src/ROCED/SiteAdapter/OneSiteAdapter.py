@@ -20,7 +20,6 @@
 # ===============================================================================
 from __future__ import unicode_literals, absolute_import
 
-import datetime
 import hashlib
 import logging
 import socket
@@ -45,6 +44,10 @@ class OneSiteAdapter(SiteAdapterBase):
     reg_site_one_vmid = "one_vmid"
     reg_gridengine_node_name = "gridengine_node_name"
 
+    # VPN setups running at once and their timeout in seconds
+    vpnSetupConcurrency = 4
+    vpnSetupTimeout = 300
+
     def __init__(self):
         super(OneSiteAdapter, self).__init__()
 
@@ -59,11 +62,16 @@ class OneSiteAdapter(SiteAdapterBase):
         self.addCompulsoryConfigKeys(self.ConfigServerProxy, Config.ConfigTypeString)
 
         self.hostname_prefix = "cloud-"
-
-        self.reg_site_one_first_dead_check = "site_one_first_dead_check"
+        # machine ID -> background VPN setup
+        self.__vpnSetups = {}
+        # VPN setups run as background tasks of the core, their results are applied there
+        self.isolatable = False
 
     def init(self):
-        self.mr.registerListener(self)
+        self.mr.subscribe(self, MachineRegistry.StatusChangedEvent, site=self.siteName,
+                          newStatus=self.mr.statusDisintegrated)
+        # deadline of booting machines without ssh connect, set by checkForDeadMachine
+        self.timeoutDeadCheck = "%s_dead_check" % self.siteName
 
     def getProxy(self):
         """helper method which returns xmlrpc proxy instance """
@@ -205,15 +213,13 @@ class OneSiteAdapter(SiteAdapterBase):
 
     def checkForDeadMachine(self, mid):
         logging.info("Machine %s is running but no ssh connect yet." % mid)
-        firstCheck = self.mr.machines[mid].get(self.reg_site_one_first_dead_check, None)
 
-        if firstCheck is None:
-            self.mr.machines[mid][self.reg_site_one_first_dead_check] = datetime.datetime.now()
-        else:
-            if (datetime.datetime.now() - firstCheck).total_seconds() > self.getConfig(
-                    self.ConfigMachineBootTimeout):
-                logging.warning("Machine %s did not boot in time. Shutting down." % mid)
-                self.mr.updateMachineStatus(mid, self.mr.statusDisintegrated)
+        # the boot timeout counts from the first failed check
+        if not self.mr.hasDeadline(self.timeoutDeadCheck, mid):
+            self.mr.setDeadline(self.timeoutDeadCheck, mid, self.getConfig(self.ConfigMachineBootTimeout))
+        elif mid in self.mr.getExpired(self.timeoutDeadCheck):
+            logging.warning("Machine %s did not boot in time. Shutting down." % mid)
+            self.mr.updateMachineStatus(mid, self.mr.statusDisintegrated)
 
     def manage(self):
         """manage method is called every manage cycle.
@@ -237,6 +243,8 @@ class OneSiteAdapter(SiteAdapterBase):
         # print myMachines
         # {'8e661aac-fc4e-450f-9cbb-e57ec6e4adb2': {'status': 'working', 'site_type': 'one', 'hostname': '141.52.208.174', 'ssh_key': 'one_host_key', 'one_vmid': 910, 'status_last_update': datetime.datetime(2011, 1, 13, 15, 48, 39, 328084), 'machine_type': 'euca-default', 'site': 'one_site_scc'}}
 
+        [self.__vpnSetups.pop(mid) for mid in list(self.__vpnSetups) if mid not in myMachines]
+
         for mid in myMachines:
             if myMachines[mid]["status"] == "booting":
                 vm_info = self.VMInfo(myMachines[mid]["one_vmid"])
@@ -247,36 +255,12 @@ class OneSiteAdapter(SiteAdapterBase):
 
                     if vm_info[1]["STATE"] == "3" and vm_info[1]["LCM_STATE"] == "3":
                         if self.checkIfMachineIsUp(mid):
-                            vpn = ScaleTools.Vpn()
-
-                            if myMachines[mid]["vpn_cert_is_valid"] is None:
-                                if vpn.makeCertificate(myMachines[mid]["vpn_cert"]) == 0:
-                                    myMachines[mid]["vpn_cert_is_valid"] = True
-
-                            if myMachines[mid]["vpn_cert_is_valid"] is True and \
-                                            myMachines[mid]["vpn_ip"] is None:
-                                if (vpn.copyCertificate(myMachines[mid]["vpn_cert"],
-                                                        myMachines[mid]) == 0):
-                                    if (vpn.connectVPN(myMachines[mid]["vpn_cert"],
-                                                       myMachines[mid]) == 0):
-                                        (res, ip) = vpn.getIP(myMachines[mid])
-                                        logging.debug(res)
-                                        logging.debug(ip)
-                                        if res == 0 and ip != "":
-                                            myMachines[mid]["vpn_ip"] = ip
-                                        else:
-                                            logging.debug("getting VPN IP failed!!")
-
-                            if (myMachines[mid]["vpn_cert_is_valid"] is True and myMachines[mid][
-                                "vpn_ip"] is not None):
-                                # if( vpn.revokeCertificate(myMachines[k]["vpn_cert"]) == 0):
-                                #    myMachines[k]["vpn_cert_is_valid"] = False
-                                self.mr.updateMachineStatus(mid, self.mr.statusUp)
-
-                            logging.debug(myMachines[mid]["vpn_ip"])
-                            logging.debug(myMachines[mid]["vpn_cert_is_valid"])
-                            logging.debug(myMachines[mid]["vpn_cert"])
-
+                            # certificate and VPN setup are slow remote calls, run them in the background
+                            task = self.__vpnSetups.get(mid)
+                            if task is None or task.done:
+                                self.__vpnSetups[mid] = self.mr.submitTask(
+                                    self.setupVpn, (mid,), name="%s.setupVpn" % self.siteName,
+                                    maxConcurrent=self.vpnSetupConcurrency, timeout=self.vpnSetupTimeout)
                         else:
                             self.checkForDeadMachine(mid)
 
@@ -290,39 +274,80 @@ class OneSiteAdapter(SiteAdapterBase):
             SHUTDOWN = 12, CANCEL = 13, FAILURE = 14, DELETE = 15, UNKNOWN = 16
     """
 
+    def setupVpn(self, mid):
+        """Create a VPN certificate, copy it and connect the machine (on a worker thread).
+
+        :return: callable storing the VPN state and setting the machine to status up, if the VPN is ready
+        """
+        machine = self.mr.machines.get(mid)
+        if machine is None:
+            return
+        # work on a copy, the registry is only changed by the returned callable on the core thread
+        machine = dict(machine)
+        vpn = ScaleTools.Vpn()
+
+        if machine["vpn_cert_is_valid"] is None:
+            if vpn.makeCertificate(machine["vpn_cert"]) == 0:
+                machine["vpn_cert_is_valid"] = True
+
+        if machine["vpn_cert_is_valid"] is True and \
+                        machine["vpn_ip"] is None:
+            if (vpn.copyCertificate(machine["vpn_cert"],
+                                    machine) == 0):
+                if (vpn.connectVPN(machine["vpn_cert"],
+                                   machine) == 0):
+                    (res, ip) = vpn.getIP(machine)
+                    logging.debug(res)
+                    logging.debug(ip)
+                    if res == 0 and ip != "":
+                        machine["vpn_ip"] = ip
+                    else:
+                        logging.debug("getting VPN IP failed!!")
+
+        logging.debug(machine["vpn_ip"])
+        logging.debug(machine["vpn_cert_is_valid"])
+        logging.debug(machine["vpn_cert"])
+
+        # if( vpn.revokeCertificate(myMachines[k]["vpn_cert"]) == 0):
+        #    myMachines[k]["vpn_cert_is_valid"] = False
+        return lambda: self.__vpnSetupDone(mid, machine["vpn_cert_is_valid"], machine["vpn_ip"])
+
+    def __vpnSetupDone(self, mid, certIsValid, vpnIp):
+        self.__vpnSetups.pop(mid, None)
+        if mid not in self.mr.machines:
+            return
+        self.mr.update(mid, {self.mr.regVpnCertIsValid: certIsValid, self.mr.regVpnIp: vpnIp})
+        if certIsValid is True and vpnIp is not None and \
+                self.mr.machines[mid].get(self.mr.regStatus) == self.mr.statusBooting:
+            self.mr.updateMachineStatus(mid, self.mr.statusUp)
+
     def spawnMachines(self, machineType, count):
         """spawns machines by calling VMAllocate and registering new VMs in machine registry"""
+        self.requestMachines(machineType, count)
+        return count
 
-        for k in range(0, count):
-            mid = self.mr.newMachine()
-            node_name = self.hostname_prefix + mid
-
-            machineConfigs = self.getConfig(self.ConfigMachines)
-            info = self.VMAllocate(machineConfigs[machineType], node_name)
+    def requestMachine(self, machineType, mid):
+        """allocates a single VM, named after its machine ID"""
+        node_name = self.hostname_prefix + mid
 
-            if info[0] is True:
-                # mid = self.mr.newMachine()
-                self.mr.machines[mid][self.mr.regSite] = self.siteName
-                self.mr.machines[mid][self.mr.regSiteType] = self.siteType
-                self.mr.machines[mid][self.mr.regMachineType] = machineType
-                self.mr.machines[mid][self.reg_site_one_vmid] = info[1]  # ONE VM ID
-                self.mr.machines[mid][self.reg_gridengine_node_name] = node_name
-                # hostname = ip - if you use scale tools you better not mix up the definitions otherwise ssh can't connect for instance
-                self.mr.machines[mid][self.mr.regHostname] = self.VMInfo(info[1])[1]["IP_PUBLIC"]
-                self.mr.machines[mid][self.mr.regSshKey] = "one_host_key"
-                self.mr.updateMachineStatus(mid, self.mr.statusBooting)
-                self.mr.machines[mid][self.mr.regVpnCert] = node_name
-                self.mr.machines[mid][self.mr.regVpnCertIsValid] = None
-                self.mr.machines[mid][self.mr.regVpnIp] = None
-            else:
-                self.mr.removeMachine(mid)
+        machineConfigs = self.getConfig(self.ConfigMachines)
+        info = self.VMAllocate(machineConfigs[machineType], node_name)
+        if info[0] is not True:
+            raise ValueError("VMAllocate failed for %s." % node_name)
 
-        return count
+        # hostname = ip - if you use scale tools you better not mix up the definitions otherwise ssh can't connect for instance
+        return {self.reg_site_one_vmid: info[1],  # ONE VM ID
+                self.reg_gridengine_node_name: node_name,
+                self.mr.regHostname: self.VMInfo(info[1])[1]["IP_PUBLIC"],
+                self.mr.regSshKey: "one_host_key",
+                self.mr.regVpnCert: node_name,
+                self.mr.regVpnCertIsValid: None,
+                self.mr.regVpnIp: None}
 
     def terminateMachines(self, machineType, count):
         """kill <count> machines of type <machineType>"""
         toRemove = [mid for (mid, machine)
-                    in self.mr.getMachines(site=self.siteName, machineType=machineType)
+                    in self.iterSiteMachines(machineType=machineType)
                     if machine[self.mr.regStatus] in [self.mr.statusWorking, self.mr.statusBooting]]
 
         toRemove = toRemove[0:count]
@@ -333,17 +358,12 @@ class OneSiteAdapter(SiteAdapterBase):
         return len(toRemove)
 
     def onEvent(self, evt):
-        """triggered when event appears, independent of manage cycle"""
-
-        if isinstance(evt, MachineRegistry.StatusChangedEvent):
-            if self.mr.machines[evt.id].get(self.mr.regSite) == self.siteName:
-                # check correct site etc...
-                if evt.newStatus == self.mr.statusDisintegrated:
-                    # print int(self.mr.machines[evt.id].get(self.reg_site_one_vmid))
-                    vm_action = self.VMAction("cancel", int(
-                        self.mr.machines[evt.id].get(self.reg_site_one_vmid)))
-                    if vm_action[0] is True:
-                        self.mr.updateMachineStatus(evt.id, self.mr.statusDown)
+        """triggered when a machine of this site is disintegrated, independent of manage cycle"""
+        # print int(self.mr.machines[evt.id].get(self.reg_site_one_vmid))
+        vm_action = self.VMAction("cancel", int(
+            self.mr.machines[evt.id].get(self.reg_site_one_vmid)))
+        if vm_action[0] is True:
+            self.mr.updateMachineStatus(evt.id, self.mr.statusDown)
 
     def isMachineTypeSupported(self, machineType):
         return True
@@ -174,7 +174,8 @@ class OpenStackSiteAdapter(SiteAdapterBase):
         urllib3_logger = logging.getLogger("requests.packages.urllib3.connectionpool")
         urllib3_logger.setLevel(logging.CRITICAL)
 
-        self.mr.registerListener(self)
+        for status in (self.mr.statusDisintegrating, self.mr.statusDisintegrated):
+            self.mr.subscribe(self, MachineRegistry.StatusChangedEvent, site=self.siteName, newStatus=status)
 
         self._machineType = list(self.getConfig(self.configMachines).keys())[0]
 
@@ -196,18 +197,9 @@ class OpenStackSiteAdapter(SiteAdapterBase):
                 maxMachines = maxMachines + (host.__dict__["vcpus"] / flavor_cores)
             return maxMachines
 
-    @property
-    def runningMachines(self):
-        """
-        Returns a dictionary containing all running machines
-
-        The number of running machines needs to be recalculated when using status integrating and
-        pending disintegration. Machines pending disintegration are still running and can accept
-        new jobs. Machines integrating are counted as running machines by default.
-
-        :return: machineList
-        """
-        return self.cloudOccupyingMachines
+    # Machines pending disintegration are still running and can accept new jobs, so all machines
+    # occupying cloud resources are counted as running machines.
+    runningMachinesStatus = SiteAdapterBase.cloudOccupyingMachinesStatus
 
     def spawnMachines(self, machineType, requested):
         """Function to spawn requested amount of machines
@@ -232,17 +224,6 @@ class OpenStackSiteAdapter(SiteAdapterBase):
             return 0
 
         try:
-            nova = self.__getNovaApi()
-
-            # important to give a specifc network due to bug in nova api:
-            netw = self.getConfig(self.configNetwork)
-            fls = self.getConfig(self.configFlavor)  # nova.flavors.find(name=self.getConfig(self.configFlavor))
-            img = self.getConfig(self.configImage)  # nova.images.find(name=self.getConfig(self.configImage))
-            key = self.getConfig(self.configKeypair)  # nova.keypairs.list()
-            name_prefix = str(self.siteName + "-")
-            print self.getConfig(self.configUserData)
-            user_data = open(self.getConfig(self.configUserData), "r")
-            print user_data
             daytime = datetime.datetime.strptime(self.getConfig(self.configDay), "%H:%M")
             nighttime = datetime.datetime.strptime(self.getConfig(self.configNight), "%H:%M")
 
@@ -276,33 +257,7 @@ class OpenStackSiteAdapter(SiteAdapterBase):
             ###
             # spawn machines
             ###
-            for count in range(requested):
-                # init new machine in machine registry
-                mid = name_prefix + str(uuid.uuid4())
-                self.mr.newMachine(mid)
-                # spawn machine at site
-                if not key is None:
-                    vm = nova.servers.create(mid, img, fls, nics=[{"net-id": netw}], userdata=user_data,
-                                             key_name=key)
-                else:
-                    vm = nova.servers.create(mid, img, fls, nics=[{"net-id": netw}], userdata=user_data)
-
-                # set some machine information in machine registry
-                self.mr.machines[mid][self.mr.regSite] = self.siteName
-                self.mr.machines[mid][self.mr.regSiteType] = self.siteType
-                self.mr.machines[mid][self.mr.regMachineType] = machineType
-                self.mr.machines[mid][self.reg_site_server_id] = vm.id
-                self.mr.machines[mid][self.reg_site_server_status] = vm.status
-                self.mr.machines[mid][self.reg_site_server_condor_name] = mid
-                self.mr.machines[mid][self.reg_site_server_name] = mid
-                # if admin account is set, also set the hypervisor
-                if self.getConfig(self.configUseTime):
-                    # time.sleep(1)
-                    self.mr.machines[mid][self.reg_site_server_hypervisor] = self.__getHypervisor(
-                        vm.id)
-
-                # TODO: set machine information, like openstack id
-                self.mr.updateMachineStatus(mid, self.mr.statusBooting)
+            self.requestMachines(machineType, requested)
 
             # all machines booted
             return requested
@@ -311,6 +266,35 @@ class OpenStackSiteAdapter(SiteAdapterBase):
         except Exception as e:
             self.logger.warning("Spawning machines failed. Exception: %s" % e)
 
+    def newMachineId(self):
+        return str(self.siteName + "-") + str(uuid.uuid4())
+
+    def requestMachine(self, machineType, mid):
+        """Spawn a single machine at OpenStack, named after its machine ID."""
+        nova = self.__getNovaApi()
+
+        # important to give a specifc network due to bug in nova api:
+        netw = self.getConfig(self.configNetwork)
+        fls = self.getConfig(self.configFlavor)  # nova.flavors.find(name=self.getConfig(self.configFlavor))
+        img = self.getConfig(self.configImage)  # nova.images.find(name=self.getConfig(self.configImage))
+        key = self.getConfig(self.configKeypair)  # nova.keypairs.list()
+        with open(self.getConfig(self.configUserData), "r") as user_data:
+            if not key is None:
+                vm = nova.servers.create(mid, img, fls, nics=[{"net-id": netw}], userdata=user_data,
+                                         key_name=key)
+            else:
+                vm = nova.servers.create(mid, img, fls, nics=[{"net-id": netw}], userdata=user_data)
+
+        # machine information for the machine registry
+        fields = {self.reg_site_server_id: vm.id,
+                  self.reg_site_server_status: vm.status,
+                  self.reg_site_server_condor_name: mid,
+                  self.reg_site_server_name: mid}
+        # if admin account is set, also set the hypervisor
+        if self.getConfig(self.configUseTime):
+            fields[self.reg_site_server_hypervisor] = self.__getHypervisor(vm.id)
+        return fields
+
     def __openstackTerminateMachines(self, mid):
         """Terminate machines in OpenStack
 
@@ -367,7 +351,7 @@ class OpenStackSiteAdapter(SiteAdapterBase):
 
             hypervisor_machines = {}
 
-            for mid in self.mr.getMachines(self.siteName):
+            for mid in self.getSiteMachines():
                 # if hypervisor is not set or None, set the hypervisor correctly
                 if (self.reg_site_server_hypervisor not in self.mr.machines[mid] or
                             self.mr.machines[mid][self.reg_site_server_hypervisor] is None):
@@ -427,7 +411,7 @@ class OpenStackSiteAdapter(SiteAdapterBase):
 
         :return:
         """
-        nova_machines = self.__getNovaMachines()
+        nova_machines = self.getPrefetched("nova_machines", self.__getNovaMachines)
 
         # Look for each machine in machine registry and perform necessary status change(s).
         #
@@ -437,78 +421,80 @@ class OpenStackSiteAdapter(SiteAdapterBase):
         # -> Add these machines to the machines registry.
         # This can happen, if (somehow) machines boot up at OpenStack without being requested...
 
-        for mid in self.mr.getMachines(self.siteName):
-            # machine not listed in OpenStack -> remove from machine registry
-            if len(nova_machines) == 0 or mid not in nova_machines:
-                self.mr.removeMachine(mid)
-                continue
-
-            # check if condor name is set
-            if not self.reg_site_server_condor_name in self.mr.machines[mid]:
-                self.mr.machines[self.reg_site_server_condor_name] = mid
-
-            # if machine is in error state, move it to disintegrating
-            if nova_machines[mid][self.reg_site_server_status] in [
-                self.reg_site_server_status_error, self.reg_site_server_status_shutoff]:
-                self.mr.machines[mid][self.reg_site_server_status] = \
-                    self.reg_site_server_status_error
-                self.mr.updateMachineStatus(mid, self.mr.statusDisintegrating)
-
-            # status handled by Integration Adapter
-            if self.mr.machines[mid][self.mr.regStatus] in [self.mr.statusIntegrating,
-                                                            self.mr.statusWorking,
-                                                            self.mr.statusPendingDisintegration]:
-                del nova_machines[mid]
-            # if status = down, machine was terminated at OpenStack -> remove from machine registry
-            elif self.mr.machines[mid][self.mr.regStatus] == self.mr.statusDown:
-                self.mr.removeMachine(mid)
-                continue
-            # check if machine could be started correctly
-            elif self.mr.machines[mid][self.mr.regStatus] == self.mr.statusBooting:
-                # they started correctly when OpenStack state changes to active
-                if nova_machines[mid][
-                    self.reg_site_server_status] == self.reg_site_server_status_active:
-                    self.mr.updateMachineStatus(mid, self.mr.statusUp)
-                    self.mr.machines[mid][self.reg_site_server_status] = nova_machines[mid][
-                        self.reg_site_server_status]
-                if mid in nova_machines:
-                    del nova_machines[mid]
-            # check if machines is disintegrating
-            elif self.mr.machines[mid][self.mr.regStatus] == self.mr.statusDisintegrating:
-                # check if machine is in status active (OpenStack status), if so, send stop command
-                if nova_machines[mid][
-                    self.reg_site_server_status] == self.reg_site_server_status_active:
-                    self.__openstackStopMachine(mid)
-                # if machine is in status shutoff (OpenStack), update to disintegrated
-                if nova_machines[mid][
-                    self.reg_site_server_status] == self.reg_site_server_status_shutoff:
-                    self.mr.updateMachineStatus(mid, self.mr.statusDisintegrated)
-                if mid in nova_machines:
+        with self.mr.batch():
+            for mid, _ in self.iterSiteMachines():
+                # machine not listed in OpenStack -> remove from machine registry
+                if len(nova_machines) == 0 or mid not in nova_machines:
+                    self.mr.removeMachine(mid)
+                    continue
+
+                # check if condor name is set
+                if not self.reg_site_server_condor_name in self.mr.machines[mid]:
+                    self.mr.machines[self.reg_site_server_condor_name] = mid
+
+                # if machine is in error state, move it to disintegrating
+                if nova_machines[mid][self.reg_site_server_status] in [
+                    self.reg_site_server_status_error, self.reg_site_server_status_shutoff]:
+                    self.mr.machines[mid][self.reg_site_server_status] = \
+                        self.reg_site_server_status_error
+                    self.mr.updateMachineStatus(mid, self.mr.statusDisintegrating)
+
+                # status handled by Integration Adapter
+                if self.mr.machines[mid][self.mr.regStatus] in [self.mr.statusIntegrating,
+                                                                self.mr.statusWorking,
+                                                                self.mr.statusPendingDisintegration]:
                     del nova_machines[mid]
+                # if status = down, machine was terminated at OpenStack -> remove from machine registry
+                elif self.mr.machines[mid][self.mr.regStatus] == self.mr.statusDown:
+                    self.mr.removeMachine(mid)
+                    continue
+                # check if machine could be started correctly
+                elif self.mr.machines[mid][self.mr.regStatus] == self.mr.statusBooting:
+                    # they started correctly when OpenStack state changes to active
+                    if nova_machines[mid][
+                        self.reg_site_server_status] == self.reg_site_server_status_active:
+                        self.mr.updateMachineStatus(mid, self.mr.statusUp)
+                        self.mr.machines[mid][self.reg_site_server_status] = nova_machines[mid][
+                            self.reg_site_server_status]
+                    if mid in nova_machines:
+                        del nova_machines[mid]
+                # check if machines is disintegrating
+                elif self.mr.machines[mid][self.mr.regStatus] == self.mr.statusDisintegrating:
+                    # check if machine is in status active (OpenStack status), if so, send stop command
+                    if nova_machines[mid][
+                        self.reg_site_server_status] == self.reg_site_server_status_active:
+                        self.__openstackStopMachine(mid)
+                    # if machine is in status shutoff (OpenStack), update to disintegrated
+                    if nova_machines[mid][
+                        self.reg_site_server_status] == self.reg_site_server_status_shutoff:
+                        self.mr.updateMachineStatus(mid, self.mr.statusDisintegrated)
+                    if mid in nova_machines:
+                        del nova_machines[mid]
+
+            # add running nova machines and information to machine registry
+            for mid in nova_machines:
+                # machines still requested are added once their request completed
+                if mid not in self.mr.view(self.siteName) and not self.mr.isRequested(mid):
+                    new = self.mr.newMachine(mid)
+                    self.mr.machines[new][self.mr.regSite] = self.siteName
+                    self.mr.machines[new][self.mr.regSiteType] = self.siteType
+                    # TODO: handle different machine types
+                    self.mr.machines[new][self.mr.regMachineType] = self._machineType  # self.getConfig(
+                    # self.configMachines)  # "vm-default"
+                    self.mr.machines[new][self.reg_site_server_id] = nova_machines[mid][
+                        self.reg_site_server_id]
+                    self.mr.machines[new][self.reg_site_server_status] = nova_machines[mid][
+                        self.reg_site_server_status]
+                    self.mr.machines[new][self.reg_site_server_name] = mid
+                    self.mr.machines[new][self.reg_site_server_condor_name] = mid
+                    # self.mr.machines[new][self.mr.regMachineCores] = self.getConfig(self.configMachineType)["vm-default"][
+                    #    "cores"]
 
-        # add running nova machines and information to machine registry
-        for mid in nova_machines:
-            if mid not in self.mr.getMachines(self.siteName):
-                new = self.mr.newMachine(mid)
-                self.mr.machines[new][self.mr.regSite] = self.siteName
-                self.mr.machines[new][self.mr.regSiteType] = self.siteType
-                # TODO: handle different machine types
-                self.mr.machines[new][self.mr.regMachineType] = self._machineType  # self.getConfig(
-                # self.configMachines)  # "vm-default"
-                self.mr.machines[new][self.reg_site_server_id] = nova_machines[mid][
-                    self.reg_site_server_id]
-                self.mr.machines[new][self.reg_site_server_status] = nova_machines[mid][
-                    self.reg_site_server_status]
-                self.mr.machines[new][self.reg_site_server_name] = mid
-                self.mr.machines[new][self.reg_site_server_condor_name] = mid
-                # self.mr.machines[new][self.mr.regMachineCores] = self.getConfig(self.configMachineType)["vm-default"][
-                #    "cores"]
-
-                if nova_machines[mid][
-                    self.reg_site_server_status] == self.reg_site_server_status_error:
-                    self.mr.updateMachineStatus(mid, self.mr.statusDisintegrating)
-                else:
-                    self.mr.updateMachineStatus(mid, self.mr.statusWorking)
+                    if nova_machines[mid][
+                        self.reg_site_server_status] == self.reg_site_server_status_error:
+                        self.mr.updateMachineStatus(mid, self.mr.statusDisintegrating)
+                    else:
+                        self.mr.updateMachineStatus(mid, self.mr.statusWorking)
 
         if self.getConfig(self.configUseTime):
             self.__openstackTimeDepStopMachine()
@@ -521,12 +507,11 @@ class OpenStackSiteAdapter(SiteAdapterBase):
                          (self.siteName, self.runningMachinesCount[self.getConfig(self.configMachines).keys()[0]]))
         json_log = JsonLog()
         json_log.addItem(self.siteName, "machines_requested",
-                         int(len(self.getSiteMachines(status=self.mr.statusBooting)) +
-                             len(self.getSiteMachines(status=self.mr.statusUp)) +
-                             len(self.getSiteMachines(status=self.mr.statusIntegrating))))
-        json_log.addItem(self.siteName, "condor_nodes", len(self.getSiteMachines(status=self.mr.statusWorking)))
+                         self.countSiteMachines(status=[self.mr.statusBooting, self.mr.statusUp,
+                                                        self.mr.statusIntegrating]))
+        json_log.addItem(self.siteName, "condor_nodes", self.countSiteMachines(status=self.mr.statusWorking))
         json_log.addItem(self.siteName, "condor_nodes_draining",
-                         len(self.getSiteMachines(status=self.mr.statusPendingDisintegration)))
+                         self.countSiteMachines(status=self.mr.statusPendingDisintegration))
 
     def onEvent(self, mid):
         """Event handler
@@ -592,6 +577,10 @@ class OpenStackSiteAdapter(SiteAdapterBase):
         # client = __import__("novaclient", globals(), locals(), [], 0)
         return Client(2, user, password, tenant, keystone, timeout=time_out)
 
+    @property
+    def prefetchQueries(self):
+        return {"nova_machines": self.__getNovaMachines}
+
     def __getNovaMachines(self):
         """Get list of machines from OpenStack
 
@@ -22,11 +22,15 @@
 from __future__ import unicode_literals, absolute_import
 
 import abc
-import copy
 import logging
+import time
+import traceback
+import uuid
+from collections import namedtuple
 
 from Core import MachineRegistry, Config
 from Core.Adapter import AdapterBase, AdapterBoxBase
+from Util.Concurrency import Task, WorkerPool
 
 
 class SiteInformation(object):
@@ -38,6 +42,53 @@ class SiteInformation(object):
         self.cost = 0
         self.isAvailable = True
         self.machinesPerCycle = 0
+        # recent cycles in which the site launched fewer machines than requested
+        self.spawnFailures = 0
+
+
+class SiteApplyResult(namedtuple("SiteApplyResult", ("requested", "launched", "pending", "error"))):
+    """Outcome of applying a decision to a site.
+
+    requested: machines ordered {machine_type: count}, negative for terminations
+    launched: new machines in the registry {machine_type: count}
+    pending: new machine requests still running (async_spawn) {machine_type: count}
+    error: traceback if applying failed, else None
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def countSite(mr, siteName):
+        # type: (MachineRegistry, str) -> tuple
+        """Counts of a site to pass to fromCounts: (machines, running requests), each {machine_type: count}."""
+        return mr.countMachinesPerType(site=siteName), mr.countRequests(site=siteName)
+
+    @classmethod
+    def fromCounts(cls, requested, before, after, error=None):
+        # type: (dict, tuple, tuple, str) -> SiteApplyResult
+        """Result from the site's counts (see countSite) before and after applying."""
+        return cls(requested, cls.__increase(before[0], after[0]), cls.__increase(before[1], after[1]), error)
+
+    @classmethod
+    def failure(cls, error):
+        # type: (str) -> SiteApplyResult
+        """Result of a site whose decision could not be applied (e.g. timed out)."""
+        return cls(dict(), dict(), dict(), error)
+
+    @staticmethod
+    def __increase(before, after):
+        return {machineType: after[machineType] - before.get(machineType, 0) for machineType in after
+                if after[machineType] > before.get(machineType, 0)}
+
+    @property
+    def failed(self):
+        # type: () -> bool
+        """Applying failed, or fewer machines were launched or are pending than requested.
+
+        Pending requests failing later are counted by the site (see SiteAdapterBase.failedRequests).
+        """
+        return self.error is not None or any(
+            self.launched.get(machineType, 0) + self.pending.get(machineType, 0) < count
+            for machineType, count in self.requested.items() if count > 0)
 
 
 class SiteAdapterBase(AdapterBase):
@@ -53,9 +104,19 @@ class SiteAdapterBase(AdapterBase):
     ConfigMachinesPerCycle = "machines_per_cycle"
     ConfigMachineBootTimeout = "machine_boot_timeout"
     ConfigBaselineMachines = "baseline_machines"
+    ConfigAsyncSpawn = "async_spawn"
 
     mr = MachineRegistry.MachineRegistry()
 
+    # machine states counted as "running" (towards the requirement) and as "occupying cloud resources"
+    runningMachinesStatus = (MachineRegistry.MachineRegistry.statusBooting,
+                             MachineRegistry.MachineRegistry.statusUp,
+                             MachineRegistry.MachineRegistry.statusIntegrating,
+                             MachineRegistry.MachineRegistry.statusWorking,
+                             MachineRegistry.MachineRegistry.statusPendingDisintegration)
+    cloudOccupyingMachinesStatus = runningMachinesStatus + (MachineRegistry.MachineRegistry.statusDisintegrating,
+                                                            MachineRegistry.MachineRegistry.statusDisintegrated)
+
     # Override the following for your custom cloud implementation
     @abc.abstractmethod
     def __init__(self):
@@ -70,6 +131,7 @@ class SiteAdapterBase(AdapterBase):
 
         self.setConfig(self.ConfigBaselineMachines, 0)
         self.setConfig(self.ConfigMachineBootTimeout, 300)
+        self.setConfig(self.ConfigAsyncSpawn, False)
 
         self.addCompulsoryConfigKeys(self.ConfigSiteName, Config.ConfigTypeString)
 
@@ -78,8 +140,18 @@ class SiteAdapterBase(AdapterBase):
         self.addOptionalConfigKeys(self.ConfigMachineBootTimeout, Config.ConfigTypeInt, default=30)
         self.addOptionalConfigKeys(self.ConfigMaxMachines, Config.ConfigTypeInt, default=10)
         self.addOptionalConfigKeys(self.ConfigMachinesPerCycle, Config.ConfigTypeInt, default=10)
+        self.addOptionalConfigKeys(self.ConfigAsyncSpawn, Config.ConfigTypeBoolean,
+                                   description="Request machines in the background (sites using requestMachines)",
+                                   default=False)
 
         self.logger = logging.getLogger("Site")
+        # background machine requests (async_spawn): requests running at once and their timeout [s]
+        self.spawnConcurrency = 4
+        self.spawnTimeout = 600
+        # machine ID -> request (Task) not completed yet
+        self.spawnOperations = dict()
+        # requests failed or timed out since the site box last looked (see SiteBox.recordApplyResults)
+        self.failedRequests = 0
 
     @abc.abstractmethod
     def manage(self):
@@ -110,6 +182,90 @@ class SiteAdapterBase(AdapterBase):
         """
         self.logger.debug("Spawning %d machines of type %s" % (count, machineType))
 
+    def requestMachine(self, machineType, mid):
+        # type: (str, str) -> dict
+        """Request a single machine from the site, used by requestMachines.
+
+        With async_spawn, this runs on a worker thread: only talk to the site, don't change the registry.
+        Raise an exception if the request failed.
+
+        :param mid: registry ID of the new machine (e.g. to derive its host name)
+        :return: registry fields to set for the machine, e.g. the site's VM ID
+        """
+        raise NotImplementedError
+
+    def newMachineId(self):
+        # type: () -> str
+        """ID of a new machine requested by requestMachines, None: generated by the registry."""
+        return None
+
+    def requestMachines(self, machineType, count):
+        # type: (str, int) -> list
+        """Spawn machines with one requestMachine call each. Return the request handles (Tasks).
+
+        Running requests are tracked by the registry (see MachineRegistry.addRequest), so they count as
+        running machines. A machine is added to the registry (booting) only once its request succeeded.
+        With async_spawn, requests run in the background (spawnConcurrency at once) and complete at the
+        start of a later cycle. Otherwise they complete before this returns, stopping at the first failure.
+        """
+        asynchronous = self.getConfig(self.ConfigAsyncSpawn) is True
+        operations = []
+        for _ in range(count):
+            mid = self.newMachineId() or str(uuid.uuid4())
+            self.mr.addRequest(mid, self.siteName, machineType)
+            if asynchronous:
+                operation = self.mr.submitTask(self.__requestMachine, (machineType, mid),
+                                               name="%s.requestMachine" % self.siteName,
+                                               maxConcurrent=self.spawnConcurrency, timeout=self.spawnTimeout)
+                self.spawnOperations[mid] = operation
+                operations.append(operation)
+                continue
+            operation = Task(self.__requestMachine, (machineType, mid), None, None)
+            operation.started = time.time()
+            operation.result = self.__requestMachine(machineType, mid)
+            operation.finished = time.time()
+            operations.append(operation)
+            if not operation.result():
+                self.logger.warning("Stopping requests at %s for now." % self.siteName)
+                break
+        return operations
+
+    def __requestMachine(self, machineType, mid):
+        try:
+            fields = self.requestMachine(machineType, mid) or dict()
+        except Exception:
+            self.logger.exception("Requesting machine %s at %s failed." % (mid, self.siteName))
+            fields = None
+        return lambda: self.__completeRequest(mid, fields, machineType)
+
+    def __completeRequest(self, mid, fields, machineType):
+        # type: (str, dict, str) -> bool
+        self.spawnOperations.pop(mid, None)
+        if not self.mr.removeRequest(mid):
+            # timed out before (see checkSpawnOperations)
+            return False
+        if fields is None:
+            self.failedRequests += 1
+            return False
+        if mid not in self.mr.machines:
+            self.mr.newMachine(mid)
+        fields = dict(fields)
+        fields.update({self.mr.regSite: self.siteName, self.mr.regSiteType: self.siteType,
+                       self.mr.regMachineType: machineType, self.mr.regStatus: self.mr.statusBooting})
+        self.mr.update(mid, fields)
+        return True
+
+    def checkSpawnOperations(self):
+        """Drop background requests which timed out. Called by the site box before manage."""
+        for mid, operation in list(self.spawnOperations.items()):
+            if not operation.timedOut:
+                continue
+            del self.spawnOperations[mid]
+            if self.mr.removeRequest(mid):
+                self.logger.warning("Request of machine %s timed out after %ss. The site may still start it."
+                                    % (mid, self.spawnTimeout))
+                self.failedRequests += 1
+
     def terminateMachines(self, machineType, count):
         """Terminate machine(s) on the corresponding site.
 
@@ -149,10 +305,28 @@ class SiteAdapterBase(AdapterBase):
         """
         return self.mr.getMachines(self.siteName, status, machineType)
 
-    def applyMachineDecision(self, decision):
+    def iterSiteMachines(self, status=None, machineType=None):
+        # type: (str, str) -> Iterator
+        """Iterate over (machine_id, machine) pairs running on this site, without copying the registry."""
+        return self.mr.iterMachines(self.siteName, status, machineType)
+
+    def countSiteMachines(self, status=None, machineType=None):
+        # type: (Union[str, Iterable[str]], str) -> int
+        """Number of machines on this site.
 
-        decision = copy.deepcopy(decision)
-        running_machines_count = self.runningMachinesCount
+        :param status: (optional) single status or a collection of states
+        """
+        return self.mr.countMachines(self.siteName, status, machineType)
+
+    def planMachineDecision(self, decision, aggregate=None):
+        # type: (dict, MachineAggregate) -> dict
+        """Machines to order to reach the (absolute) decision {machine_type: count}, within the site's limit.
+
+        :param aggregate: registry aggregate of this cycle, to count running machines without querying again
+        :return: {machine_type: count}, negative for terminations
+        """
+        decision = dict(decision)
+        running_machines_count = self.countRunningMachines(aggregate)
         max_machines = self.getConfig(self.ConfigMaxMachines)
 
         for (machine_type, n_machines) in decision.items():
@@ -162,25 +336,32 @@ class SiteAdapterBase(AdapterBase):
                 n_running_machines = running_machines_count[machine_type]
                 decision[machine_type] -= n_running_machines
 
-            # spawn
-            if decision[machine_type] > 0:
-                # TODO: Implement max_machines per site, not per machine type!!!
-                # respect site limit for max machines for spawning but don't remove machines when
-                # above limit this limit is currently implemented per machine type, not per site!
-                if max_machines and (decision[machine_type] + n_running_machines) > max_machines:
-                    self.logger.info("Request exceeds maximum number of allowed machines on this site (%d>%d)!"
-                                     % (decision[machine_type] + n_running_machines, max_machines))
-                    self.logger.info("Will spawn %s machines." % max(0, max_machines - n_running_machines))
-                    decision[machine_type] = max_machines - n_running_machines
-                    # is the new decision valid?
-                    if decision[machine_type] > 0:
-                        self.spawnMachines(machine_type, decision[machine_type])
-                else:
-                    self.spawnMachines(machine_type, decision[machine_type])
-
-            # terminate
-            elif decision[machine_type] < 0:
-                self.terminateMachines(machine_type, abs(decision[machine_type]))
+            # TODO: Implement max_machines per site, not per machine type!!!
+            # respect site limit for max machines for spawning but don't remove machines when
+            # above limit this limit is currently implemented per machine type, not per site!
+            if decision[machine_type] > 0 and max_machines and \
+                    (decision[machine_type] + n_running_machines) > max_machines:
+                self.logger.info("Request exceeds maximum number of allowed machines on this site (%d>%d)!"
+                                 % (decision[machine_type] + n_running_machines, max_machines))
+                self.logger.info("Will spawn %s machines." % max(0, max_machines - n_running_machines))
+                decision[machine_type] = max(0, max_machines - n_running_machines)
+
+        return {machine_type: count for (machine_type, count) in decision.items() if count != 0}
+
+    def applyMachineDecision(self, decision, aggregate=None):
+        # type: (dict, MachineAggregate) -> dict
+        """Spawn/terminate machines to reach the (absolute) decision {machine_type: count}.
+
+        :param aggregate: registry aggregate of this cycle, to count running machines without querying again
+        :return: machines ordered {machine_type: count}, negative for terminations
+        """
+        orders = self.planMachineDecision(decision, aggregate)
+        for (machine_type, count) in orders.items():
+            if count > 0:
+                self.spawnMachines(machine_type, count)
+            else:
+                self.terminateMachines(machine_type, abs(count))
+        return orders
 
     def getSiteMachinesAsDict(self, statusFilter=None):
         # type: (list) -> dict
@@ -188,20 +369,14 @@ class SiteAdapterBase(AdapterBase):
 
         :return dictionary {machine_type: [machine ID, machine ID, ...], ...} :
         """
-        if statusFilter is None:
-            statusFilter = []
-
-        myMachines = self.getSiteMachines()
         machineList = dict()
 
         for i in self.getConfig(self.ConfigMachines):
             machineList[i] = []
 
-        for mid, machine in myMachines.items():
-            if statusFilter:  # empty list returns false in this statement
-                if machine.get(self.mr.regStatus) in statusFilter:
-                    machineList[machine[self.mr.regMachineType]].append(mid)
-            else:
+        # one (indexed) query per status instead of filtering all site machines
+        for status in statusFilter or (None,):  # empty list returns false in this statement
+            for mid, machine in self.iterSiteMachines(status=status):
                 machineList[machine[self.mr.regMachineType]].append(mid)
 
         return machineList
@@ -212,12 +387,7 @@ class SiteAdapterBase(AdapterBase):
 
         :return dictionary {machine_type: [machine ID, machine ID, ...], ...} :
         """
-        statusFilter = [self.mr.statusBooting,
-                        self.mr.statusUp,
-                        self.mr.statusIntegrating,
-                        self.mr.statusWorking,
-                        self.mr.statusPendingDisintegration]
-        return self.getSiteMachinesAsDict(statusFilter)
+        return self.getSiteMachinesAsDict(self.runningMachinesStatus)
 
     @property
     def runningMachinesCount(self):
@@ -225,10 +395,22 @@ class SiteAdapterBase(AdapterBase):
 
         :return {machine_type: integer, ...}:
         """
-        running_machines = self.runningMachines
-        running_machines_count = dict()
-        for (machine_type, midList) in running_machines.items():
-            running_machines_count[machine_type] = len(midList)
+        return self.countRunningMachines()
+
+    def countRunningMachines(self, aggregate=None):
+        # type: (MachineAggregate) -> dict
+        """Same as runningMachinesCount, counted from a registry aggregate if given.
+
+        Machines still requested from the site (see requestMachines) count as running.
+
+        :return {machine_type: integer, ...}:
+        """
+        source = aggregate or self.mr
+        running_machines_count = {machine_type: 0 for machine_type in self.getConfig(self.ConfigMachines)}
+        running_machines_count.update(source.countMachinesPerType(site=self.siteName,
+                                                                  status=self.runningMachinesStatus))
+        for machine_type, count in source.countRequests(site=self.siteName).items():
+            running_machines_count[machine_type] = running_machines_count.get(machine_type, 0) + count
         return running_machines_count
 
     @property
@@ -240,22 +422,12 @@ class SiteAdapterBase(AdapterBase):
 
         :return dictionary {machine_type: [machine ID, machine ID, ...], ...} :
         """
-        statusFilter = [self.mr.statusBooting,
-                        self.mr.statusUp,
-                        self.mr.statusIntegrating,
-                        self.mr.statusWorking,
-                        self.mr.statusPendingDisintegration,
-                        self.mr.statusDisintegrating,
-                        self.mr.statusDisintegrated]
-        return self.getSiteMachinesAsDict(statusFilter)
+        return self.getSiteMachinesAsDict(self.cloudOccupyingMachinesStatus)
 
     @property
     def cloudOccupyingMachinesCount(self):
         """Total number of machines occupying computing resources on a site."""
-        sum_ = 0
-        for (machineType, midList) in self.cloudOccupyingMachines.items():
-            sum_ += len(midList)
-        return sum_
+        return self.mr.countMachines(site=self.siteName, status=self.cloudOccupyingMachinesStatus)
 
     def isMachineTypeSupported(self, machineType):
         return machineType in self.getConfig(self.ConfigMachines)
@@ -293,6 +465,21 @@ class SiteAdapterBase(AdapterBase):
 
 
 class SiteBox(AdapterBoxBase):
+    def __init__(self):
+        super(SiteBox, self).__init__()
+        # apply decisions on all sites at once
+        self.concurrentApply = False
+        self.__applyWorkers = None
+        # site -> apply task still to be committed
+        self.__applyTasks = {}
+        # site name -> recent cycles with failed spawns (see applyMachineDecision)
+        self.spawnFailures = dict()
+
+    def manage(self):
+        for site in self._adapterList:
+            site.checkSpawnOperations()
+        super(SiteBox, self).manage()
+
     @property
     def runningMachines(self):
         # type: () -> dict
@@ -309,7 +496,12 @@ class SiteBox(AdapterBoxBase):
 
         :return {siteName: {machine_type: integer, ...}}:
         """
-        return {site.siteName: site.runningMachinesCount for site in self._adapterList}
+        return self.getRunningMachinesCount()
+
+    def getRunningMachinesCount(self, aggregate=None):
+        # type: (MachineAggregate) -> dict
+        """Same as runningMachinesCount, counted from a registry aggregate if given."""
+        return {site.siteName: site.countRunningMachines(aggregate) for site in self._adapterList}
 
     @property
     def siteConfigAsDict(self):
@@ -323,7 +515,11 @@ class SiteBox(AdapterBoxBase):
     @property
     def siteInformation(self):
         # type: () -> dict
-        return {site.siteName: site.siteInformation for site in self._adapterList}
+        siteInformation = dict()
+        for site in self._adapterList:
+            siteInformation[site.siteName] = site.siteInformation
+            siteInformation[site.siteName].spawnFailures = self.spawnFailures.get(site.siteName, 0)
+        return siteInformation
 
     def getSite(self, siteName):
         res = [site for site in self._adapterList if site.siteName == siteName]
@@ -332,8 +528,94 @@ class SiteBox(AdapterBoxBase):
         else:
             return None
 
-    def applyMachineDecision(self, decision):
-        [x.applyMachineDecision(decision.get(x.siteName, dict())) for x in self._adapterList]
+    def applyMachineDecision(self, decision, aggregate=None):
+        # type: (dict, MachineAggregate) -> dict
+        """Apply the decision {siteName: {machine_type: count}} to all sites. Return {siteName: SiteApplyResult}.
+
+        Sites launching fewer machines than requested count a spawn failure, which the broker sees in
+        SiteInformation.spawnFailures. It grows with each failed cycle and shrinks with each cycle the
+        site succeeds or is not asked to spawn, so failing sites are retried after a while.
+        """
+        mr = MachineRegistry.MachineRegistry()
+        if self.concurrentApply is True and len(self._adapterList) > 1:
+            results = self.__applyConcurrently(mr, decision, aggregate)
+        else:
+            results = {site.siteName: self.__apply(mr, site, decision.get(site.siteName, dict()), aggregate)
+                       for site in self._adapterList}
+        self.recordApplyResults(results)
+        return results
+
+    def __applyConcurrently(self, mr, decision, aggregate):
+        """Apply the decisions of all sites at once, one thread each, waiting at most adapterTimeout seconds.
+
+        Sites not done by then count as failed. Their changes are committed in a later cycle, they get no
+        new decision until then (as in AdapterBoxBase.manageConcurrently).
+        """
+        if self.__applyWorkers is None:
+            self.__applyWorkers = WorkerPool(len(self._adapterList))
+        for site in self._adapterList:
+            if site in self.__applyTasks:
+                logging.warning("%s is still applying a previous decision." % site.siteName)
+                continue
+            self.__applyTasks[site] = self.__applyWorkers.submit(
+                self.applySiteDecision, (mr, site, decision.get(site.siteName, dict()), aggregate),
+                group=site.siteName)
+        self.__applyWorkers.wait(self.adapterTimeout)
+        self.__applyWorkers.completed()
+
+        results = dict()
+        # commit in site order, so listeners see the same order as in sequential mode
+        for site in self._adapterList:
+            task = self.__applyTasks[site]
+            if not task.done:
+                results[site.siteName] = SiteApplyResult.failure("Not done within %ss." % self.adapterTimeout)
+                continue
+            del self.__applyTasks[site]
+            if task.error is not None:
+                results[site.siteName] = SiteApplyResult.failure(str(task.error))
+                continue
+            results[site.siteName], events = task.result
+            mr.commitBatch(events)
+        return results
+
+    def recordApplyResults(self, results):
+        # type: (dict) -> None
+        """Update the spawn failure counts from the results {siteName: SiteApplyResult} of a cycle."""
+        failedRequests = dict()
+        for site in self._adapterList:
+            failedRequests[site.siteName], site.failedRequests = site.failedRequests, 0
+        for siteName, result in results.items():
+            failures = self.spawnFailures.get(siteName, 0)
+            if result.failed or failedRequests.get(siteName, 0) > 0:
+                if result.error is not None and not result.requested:
+                    logging.warning("%s: decision not applied: %s" % (siteName, result.error.strip().splitlines()[-1]))
+                elif result.failed:
+                    logging.warning("%s: launched %s of %s machines." % (siteName, result.launched, result.requested))
+                if failedRequests.get(siteName, 0) > 0:
+                    logging.warning("%s: %d machine request(s) failed." % (siteName, failedRequests[siteName]))
+                self.spawnFailures[siteName] = failures + 1
+            elif failures > 0:
+                self.spawnFailures[siteName] = failures - 1
+
+    @classmethod
+    def applySiteDecision(cls, mr, site, decision, aggregate):
+        # type: (MachineRegistry, SiteAdapterBase, dict, MachineAggregate) -> tuple
+        """Apply a site's decision in a deferred batch, e.g. on a worker thread. Return (result, events)."""
+        events = []
+        with mr.deferredBatch(events):
+            result = cls.__apply(mr, site, decision, aggregate)
+        return result, events
+
+    @staticmethod
+    def __apply(mr, site, decision, aggregate):
+        before = SiteApplyResult.countSite(mr, site.siteName)
+        requested, error = dict(), None
+        try:
+            requested = site.applyMachineDecision(decision, aggregate) or dict()
+        except Exception:
+            error = traceback.format_exc()
+            logging.error("Applying decision on %s failed:\n%s" % (site.siteName, error))
+        return SiteApplyResult.fromCounts(requested, before, SiteApplyResult.countSite(mr, site.siteName), error)
 
     def modServiceMachineDecision(self, decision):
         # type: (dict) -> dict
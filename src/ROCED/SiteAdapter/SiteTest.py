@@ -21,6 +21,7 @@
 from __future__ import unicode_literals, absolute_import
 
 from Core import ScaleTest
+from SiteAdapter.OneSiteAdapter import OneSiteAdapter
 
 
 # import EucaUtil
@@ -363,3 +364,24 @@ class EucaSiteAdapterTest:  # (ScaleTest.ScaleTestBase):
 
 class ONESiteAdapterTest(ScaleTest.ScaleTestBase):
     pass
+
+
+class OneSiteAdapterTest(ScaleTest.ScaleTestBase):
+    def test_checkForDeadMachine(self):
+        site = OneSiteAdapter()
+        site.setConfig(site.ConfigMachineBootTimeout, 0)
+        mr = site.mr
+        mr.clear()
+        site.init()
+        # no OpenNebula to cancel the VM at
+        mr.clearListeners()
+        mid = mr.newMachine()
+        mr.update(mid, {mr.regSite: site.siteName, mr.regStatus: mr.statusBooting})
+
+        # the timeout starts at the first failed check, not when booting started
+        site.checkForDeadMachine(mid)
+        self.assertEqual(mr.machines[mid][mr.regStatus], mr.statusBooting)
+        site.checkForDeadMachine(mid)
+        self.assertEqual(mr.machines[mid][mr.regStatus], mr.statusDisintegrated)
+        self.assertFalse(mr.hasDeadline(site.timeoutDeadCheck, mid))
+        mr.clear()
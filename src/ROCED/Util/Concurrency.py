@@ -0,0 +1,383 @@
+# ===============================================================================
+#
+# Copyright (c) 2010, 2011 by Thomas Hauth and Stephan Riedel
+#
+# This file is part of ROCED.
+#
+# ROCED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ROCED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ROCED.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ===============================================================================
+from __future__ import unicode_literals, absolute_import
+
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Task(object):
+    """Function call run by a WorkerPool.
+
+    Once done, either "result", "error" (the exception raised) or "timedOut" is set.
+    """
+    __slots__ = ("function", "args", "group", "timeout", "context", "started", "finished", "result", "error",
+                 "timedOut", "running")
+
+    def __init__(self, function, args, group, timeout, context=None):
+        self.function = function
+        self.args = args
+        self.group = group
+        self.timeout = timeout
+        # data of the submitter, e.g. how to handle a failure
+        self.context = context
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.timedOut = False
+        # picked up by a worker thread
+        self.running = False
+
+    @property
+    def done(self):
+        # type: () -> bool
+        return self.finished is not None or self.timedOut
+
+    @property
+    def duration(self):
+        # type: () -> float
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+class WorkerPool(object):
+    """Bounded pool of worker threads for slow, I/O-bound calls (SSH, remote commands).
+
+    Tasks belong to a group (e.g. an event handler), which may limit the number of its tasks
+    running at once. Further tasks of that group wait until one finishes. Finished tasks are
+    collected by the owner thread via "completed", so results can be applied there.
+
+    A thread stuck in a timed-out task (e.g. a hanging SSH call) can't be stopped. It is replaced by
+    a new thread, up to maxReplacements threads at once. Further stuck threads reduce the pool size
+    until their calls return.
+    """
+
+    def __init__(self, size=4, maxReplacements=None):
+        # type: (int, int) -> None
+        self.size = size
+        self.maxReplacements = size if maxReplacements is None else maxReplacements
+        # threads still running a timed-out task
+        self.__stuck = 0
+        self.__queue = queue.Queue()
+        self.__lock = threading.Lock()
+        self.__idle = threading.Condition(self.__lock)
+        self.__threads = []
+        self.__limits = {}
+        # group -> started tasks not done yet
+        self.__running = defaultdict(list)
+        # group -> tasks waiting for a free slot of their group
+        self.__waiting = defaultdict(deque)
+        self.__completed = deque()
+
+    def submit(self, function, args=(), group=None, limit=None, timeout=None, context=None):
+        # type: (callable, tuple, str, int, float, object) -> Task
+        """Run function(*args) on a worker thread.
+
+        :param group: tasks sharing a concurrency limit
+        :param limit: maximum number of tasks of the group running at once (None: pool size)
+        :param timeout: seconds after which a started task is reported as timed out and its result discarded
+        :param context: stored in the task for the submitter
+        """
+        task = Task(function, args, group, timeout, context)
+        with self.__lock:
+            if limit is not None:
+                self.__limits[group] = limit
+            limit = self.__limits.get(group)
+            if limit is not None and len(self.__running[group]) >= limit:
+                self.__waiting[group].append(task)
+            else:
+                self.__start(task)
+        return task
+
+    def completed(self):
+        # type: () -> list
+        """Return tasks finished or timed out since the last call."""
+        now = time.time()
+        with self.__lock:
+            for tasks in list(self.__running.values()):
+                for task in [task for task in tasks if task.timeout is not None and
+                             task.finished is None and now - task.started > task.timeout]:
+                    task.timedOut = True
+                    if task.running:
+                        self.__stuck += 1
+                    self.__release(task)
+            while len(self.__threads) < self.__capacity and not self.__queue.empty():
+                self.__addThread()
+            done = list(self.__completed)
+            self.__completed.clear()
+        return done
+
+    def pending(self, group=None):
+        # type: (str) -> int
+        """Number of tasks (of a group) running or waiting."""
+        with self.__lock:
+            groups = self.__running.keys() if group is None else (group,)
+            return sum(len(self.__running.get(group_, ())) + len(self.__waiting.get(group_, ()))
+                       for group_ in list(groups))
+
+    def wait(self, timeout=None):
+        # type: (float) -> bool
+        """Block until all tasks are done. Return False if the timeout expired first."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.__idle:
+            while any(self.__running.values()):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.__idle.wait(remaining)
+        return True
+
+    def waitFor(self, task, timeout=None):
+        # type: (Task, float) -> bool
+        """Block until a task is done. Return False if the timeout expired first."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.__idle:
+            while not task.done:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.__idle.wait(remaining)
+        return True
+
+    @property
+    def __capacity(self):
+        # number of threads, including replacements of stuck ones (lock held)
+        return self.size + min(self.__stuck, self.maxReplacements)
+
+    def __start(self, task):
+        # call with lock held
+        task.started = time.time()
+        self.__running[task.group].append(task)
+        if len(self.__threads) < self.__capacity:
+            self.__addThread()
+        self.__queue.put(task)
+
+    def __addThread(self):
+        # call with lock held
+        thread = threading.Thread(target=self.__work, name="WorkerPool-%d" % len(self.__threads))
+        thread.daemon = True
+        self.__threads.append(thread)
+        thread.start()
+
+    def __release(self, task):
+        # call with lock held, task is done
+        self.__running[task.group].remove(task)
+        self.__completed.append(task)
+        if self.__waiting[task.group]:
+            self.__start(self.__waiting[task.group].popleft())
+        self.__idle.notify_all()
+
+    def __work(self):
+        while True:
+            task = self.__queue.get()
+            with self.__lock:
+                if task.timedOut:
+                    continue
+                task.running = True
+            try:
+                result, error = task.function(*task.args), None
+            except Exception as err:
+                logging.exception("Task %s failed." % task.group)
+                result, error = None, err
+            with self.__lock:
+                if task.timedOut:
+                    logging.warning("Discarding result of task %s, it finished after its timeout." % task.group)
+                    self.__stuck -= 1
+                    # a replacement took over, leave
+                    if len(self.__threads) > self.__capacity:
+                        self.__threads.remove(threading.current_thread())
+                        return
+                    continue
+                task.result, task.error, task.finished = result, error, time.time()
+                self.__release(task)
+
+
+class FixedRateTicks(object):
+    """Ticks of a fixed-rate loop (start + n * interval) and their statistics, without running the loop.
+
+    Used by FixedRateScheduler and the asyncio core (see Core.AsyncCore): the loop waits until nextTick,
+    calls begin, runs its call and calls finish. A call running past the next tick is an overrun: the
+    ticks missed meanwhile are skipped, not queued, and the next call happens at the next regular tick.
+    The delay of each call against its tick (jitter) is measured. "trigger" requests an early call, the
+    ticks then continue from it.
+    """
+
+    def __init__(self, interval, name="Scheduler"):
+        # type: (float, str) -> None
+        self.interval = interval
+        self.name = name
+        self.overruns = 0
+        self.skippedTicks = 0
+        # jitter of the most recent calls [s]
+        self.jitter = deque(maxlen=100)
+        self.__nextTick = None
+        # time of an early call requested by trigger
+        self.__triggeredTick = None
+        self.__lock = threading.Lock()
+
+    @property
+    def nextTick(self):
+        # type: () -> float
+        with self.__lock:
+            if self.__triggeredTick is None:
+                return self.__nextTick
+            return min(self.__nextTick, self.__triggeredTick)
+
+    def start(self, firstTick):
+        # type: (float) -> None
+        with self.__lock:
+            self.__nextTick = firstTick
+            self.__triggeredTick = None
+
+    def trigger(self, delay=0.0):
+        # type: (float) -> None
+        """Call early, delay seconds from now (debouncing), unless a call is due before anyway.
+
+        Further triggers within the delay don't postpone the call, so a burst leads to a single call.
+        A trigger during a call leads to another call after it.
+        """
+        with self.__lock:
+            tick = time.time() + delay
+            if self.__triggeredTick is None or tick < self.__triggeredTick:
+                self.__triggeredTick = tick
+
+    def begin(self):
+        # type: () -> float
+        """A call starts (at or after nextTick). Return its tick, to pass to finish."""
+        tick = self.nextTick
+        with self.__lock:
+            self.__triggeredTick = None
+        self.jitter.append(time.time() - tick)
+        return tick
+
+    def finish(self, tick):
+        # type: (float) -> None
+        """The call of the tick finished: count an overrun and set the next tick."""
+        missed = max(0, int((time.time() - tick) // self.interval))
+        if missed > 0:
+            self.overruns += 1
+            self.skippedTicks += missed
+            logging.warning("%s: call took %.1fs, longer than the interval of %.1fs, skipping %d tick(s)."
+                            % (self.name, time.time() - tick, self.interval, missed))
+        with self.__lock:
+            self.__nextTick = tick + (missed + 1) * self.interval
+
+    def jitterStatistics(self):
+        # type: () -> dict
+        """Mean and maximum jitter [s] of the most recent calls."""
+        jitter = list(self.jitter)
+        if not jitter:
+            return {"mean": 0.0, "max": 0.0}
+        return {"mean": sum(jitter) / len(jitter), "max": max(jitter)}
+
+
+class FixedRateScheduler(object):
+    """Calls a function at fixed-rate ticks on its own thread, see FixedRateTicks."""
+
+    def __init__(self, interval, function, name="Scheduler"):
+        # type: (float, callable, str) -> None
+        self.function = function
+        self.name = name
+        self.ticks = FixedRateTicks(interval, name)
+        self.__stopped = threading.Event()
+        self.__wakeUp = threading.Event()
+        self.__thread = None
+
+    @property
+    def interval(self):
+        # type: () -> float
+        return self.ticks.interval
+
+    @interval.setter
+    def interval(self, interval):
+        # type: (float) -> None
+        self.ticks.interval = interval
+
+    @property
+    def overruns(self):
+        # type: () -> int
+        return self.ticks.overruns
+
+    @property
+    def skippedTicks(self):
+        # type: () -> int
+        return self.ticks.skippedTicks
+
+    @property
+    def running(self):
+        # type: () -> bool
+        return self.__thread is not None and self.__thread.is_alive() and not self.__stopped.is_set()
+
+    @property
+    def nextTick(self):
+        # type: () -> float
+        return self.ticks.nextTick
+
+    def start(self, firstTick=None):
+        # type: (float) -> None
+        """Start calling at firstTick (default: one interval from now)."""
+        if self.running:
+            return
+        self.ticks.start(time.time() + self.interval if firstTick is None else firstTick)
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run, name=self.name)
+        self.__thread.start()
+
+    def stop(self):
+        """Stop before the next tick. A running call is finished."""
+        self.__stopped.set()
+        self.__wakeUp.set()
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    def trigger(self, delay=0.0):
+        # type: (float) -> None
+        """Call early, see FixedRateTicks.trigger."""
+        self.ticks.trigger(delay)
+        self.__wakeUp.set()
+
+    def jitterStatistics(self):
+        # type: () -> dict
+        return self.ticks.jitterStatistics()
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            tick = self.nextTick
+            if tick > time.time():
+                self.__wakeUp.wait(tick - time.time())
+                # re-read the next tick, a trigger may have changed it
+                self.__wakeUp.clear()
+                continue
+            tick = self.ticks.begin()
+            try:
+                self.function()
+            except Exception:
+                logging.exception("%s: scheduled call failed." % self.name)
+            self.ticks.finish(tick)
@@ -27,9 +27,17 @@ import logging
 import os
 import shutil
 import sys
+import threading
 import time
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 PY3 = sys.version_info > (3,)
 
 
@@ -37,10 +45,25 @@ PY3 = sys.version_info > (3,)
 
 
 class MachineRegistryLogger(object):
-    """Save/load machine registry to/from JSON file."""
+    """Save/load machine registry to/from JSON file.
+
+    Every change of the registry is appended to a journal file, the snapshot written by "dump" only
+    saves replaying it. Loading replays the journal entries newer than the snapshot, so no change is
+    lost if ROCED stops mid-cycle. Each journal line is a JSON list:
+    [sequence number, operation, machine ID, arguments...]
+    """
     __logger = logging.getLogger("Core")
     __filename = "log/machine_registry.json"
     __backup_file = "log/old_machine_registry.json"
+    __journal_file = "log/machine_registry_journal.json"
+    # snapshot key holding the sequence number of the last journal entry contained
+    __sequence_key = "__journal_sequence__"
+    __journal = None
+    __journal_lock = threading.Lock()
+    # sequence number of the last journal entry
+    sequence = 0
+    # sequence number of the latest snapshot, the journal is kept from there on for the backup
+    __snapshotSequence = None
 
     @staticmethod
     def __toJson(python_object):
@@ -50,6 +73,12 @@ class MachineRegistryLogger(object):
                     "__value__": python_object.strftime("%Y-%m-%d %H:%M:%S:%f")}
         elif isinstance(python_object, bytes) is True:
             return python_object.decode()
+        elif isinstance(python_object, Mapping) is True:
+            # machine registry records
+            return dict(python_object)
+        elif isinstance(python_object, deque) is True:
+            # bounded state change history
+            return list(python_object)
         raise TypeError("%s is not JSON serializable" % repr(python_object))
 
     @staticmethod
@@ -63,24 +92,56 @@ class MachineRegistryLogger(object):
         return json_object
 
     @classmethod
-    def dump(cls, machineRegistry):
-        # type: (dict) -> None
-        """Dump machine registry to JSON file."""
+    def dump(cls, machineRegistry, sequence=None):
+        # type: (dict, int) -> None
+        """Dump machine registry to JSON file.
+
+        If the journal sequence number of the last change contained is given, journal entries older
+        than the previous snapshot (now the backup) are removed afterwards. So both snapshots can be
+        restored exactly.
+        """
         try:
             shutil.move(cls.__filename, cls.__backup_file)
         except IOError:
             cls.__logger.warning("JSON file could not be moved!")
 
+        state = machineRegistry
+        if sequence is not None:
+            state = dict(machineRegistry)
+            state[cls.__sequence_key] = sequence
         try:
+            cls.__makeFolder()
             with open(cls.__filename, "w") as file_:
-                json.dump(machineRegistry, file_, default=cls.__toJson)
+                json.dump(state, file_, default=cls.__toJson)
         except IOError:
             cls.__logger.error("JSON file could not be opened for dumping state!")
+            return
+        if sequence is not None:
+            previous, cls.__snapshotSequence = cls.__snapshotSequence, sequence
+            if previous is not None:
+                cls.__compact(previous)
 
     @classmethod
     def load(cls):
         # type: () -> dict
-        """Load machine registry from JSON file.
+        """Load machine registry from JSON file and replay the journal on top of it."""
+        state = cls.__loadSnapshot()
+        sequence = state.pop(cls.__sequence_key, 0)
+        cls.__snapshotSequence = sequence
+        try:
+            with open(cls.__journal_file, "r") as file_:
+                entries = cls.__readJournal(file_)
+                cls.sequence = cls.replay(state, entries, sequence)
+        except IOError:
+            cls.sequence = sequence
+        if cls.sequence > sequence:
+            cls.__logger.info("Replayed %d journaled change(s)." % (cls.sequence - sequence))
+        return state
+
+    @classmethod
+    def __loadSnapshot(cls):
+        # type: () -> dict
+        """Load machine registry snapshot from JSON file.
 
         Will fall back on backup file, if an error occurs.
         """
@@ -100,6 +161,272 @@ class MachineRegistryLogger(object):
         finally:
             return state
 
+    @classmethod
+    def append(cls, operation, mid, *args):
+        # type: (str, str, ...) -> None
+        """Journal a registry change: "new" (mid), "set" (mid, key, value), "del" (mid, key),
+        "status" (mid, fields, history key, history entry) or "remove" (mid)."""
+        with cls.__journal_lock:
+            try:
+                line = json.dumps([cls.sequence + 1, operation, mid] + list(args), default=cls.__toJson)
+            except (TypeError, ValueError) as err:
+                cls.__logger.error("Change of machine %s can't be journaled: %s" % (mid, err))
+                return
+            cls.sequence += 1
+            try:
+                if cls.__journal is None:
+                    cls.__makeFolder()
+                    cls.__journal = open(cls.__journal_file, "a")
+                cls.__journal.write("%s\n" % line)
+                cls.__journal.flush()
+            except IOError:
+                cls.__logger.error("Journal file %s could not be opened for writing!" % cls.__journal_file)
+
+    @classmethod
+    def close(cls):
+        """Close the journal file, it is reopened by the next change."""
+        with cls.__journal_lock:
+            if cls.__journal is not None:
+                cls.__journal.close()
+                cls.__journal = None
+
+    @classmethod
+    def __makeFolder(cls):
+        folder = os.path.dirname(cls.__journal_file)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    @classmethod
+    def replay(cls, state, entries, sequence=0):
+        # type: (dict, iter, int) -> int
+        """Apply journal entries newer than sequence to a registry state. Return the last sequence number."""
+        for entry in entries:
+            if entry[0] <= sequence:
+                continue
+            if entry[0] != sequence + 1:
+                cls.__logger.error("Journal entries %d to %d are missing, the restored state is incomplete."
+                                   % (sequence + 1, entry[0] - 1))
+            sequence, operation, mid, args = entry[0], entry[1], entry[2], entry[3:]
+            if operation == "new":
+                state[mid] = dict()
+            elif mid not in state:
+                continue
+            elif operation == "set":
+                state[mid][args[0]] = args[1]
+            elif operation == "del":
+                state[mid].pop(args[0], None)
+            elif operation == "status":
+                state[mid].update(args[0])
+                state[mid].setdefault(args[1], []).append(args[2])
+            elif operation == "remove":
+                del state[mid]
+        return sequence
+
+    @classmethod
+    def __readJournal(cls, file_):
+        for line in file_:
+            try:
+                yield json.loads(line, object_hook=cls.__fromJson)
+            except ValueError:
+                # incomplete last line
+                cls.__logger.warning("Skipping broken journal entry: %s" % line.strip())
+
+    @classmethod
+    def __compact(cls, sequence):
+        # type: (int) -> None
+        """Remove journal entries up to sequence (contained in the snapshot)."""
+        cls.close()
+        with cls.__journal_lock:
+            if not os.path.isfile(cls.__journal_file):
+                return
+            try:
+                with open(cls.__journal_file, "r") as file_:
+                    lines = [line for line in file_ if cls.__lineSequence(line) > sequence]
+                with open("%s.tmp" % cls.__journal_file, "w") as file_:
+                    file_.writelines(lines)
+                os.rename("%s.tmp" % cls.__journal_file, cls.__journal_file)
+            except (IOError, OSError):
+                cls.__logger.error("Journal file %s could not be compacted!" % cls.__journal_file)
+
+    @staticmethod
+    def __lineSequence(line):
+        # type: (str) -> int
+        """Sequence number of a journal line without decoding it, -1 for broken lines."""
+        try:
+            return int(line[1:line.index(",")]) if line.endswith("\n") else -1
+        except ValueError:
+            return -1
+
+
+class MachineHistoryLogger(object):
+    """Append-only file for machine state change history entries which don't fit into the registry anymore.
+
+    Each line contains a single JSON object: {"mid": machine_id, "old_status": .., "new_status": .., ...}
+    The file offsets of each machine's lines are indexed, so a query only reads the lines of its machine.
+    """
+    __logger = logging.getLogger("Core")
+    __filename = "log/machine_history.json"
+    __buffer = []
+    __lock = threading.Lock()
+    # file access and the line index {mid: [offset, ...]}, None: not built yet
+    __fileLock = threading.Lock()
+    __index = None
+
+    @classmethod
+    def append(cls, mid, entries):
+        # type: (str, list) -> None
+        """Queue history entries of a machine for writing."""
+        lines = []
+        for entry in entries:
+            line = dict(entry)
+            line["mid"] = mid
+            lines.append(line)
+        with cls.__lock:
+            cls.__buffer.extend(lines)
+
+    @classmethod
+    def write(cls):
+        """Append all queued entries to the history file."""
+        with cls.__lock:
+            if not cls.__buffer:
+                return
+            buffer_, cls.__buffer = cls.__buffer, []
+        with cls.__fileLock:
+            index = cls.__loadIndex()
+            try:
+                cls.__makeFolder()
+                with open(cls.__filename, "ab") as file_:
+                    for line in buffer_:
+                        index.setdefault(line["mid"], []).append(file_.tell())
+                        file_.write(("%s\n" % json.dumps(line)).encode("utf-8"))
+            except (IOError, OSError):
+                cls.__logger.error("History file %s could not be opened for writing!" % cls.__filename)
+
+    @classmethod
+    def __makeFolder(cls):
+        folder = os.path.dirname(cls.__filename)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    @classmethod
+    def __loadIndex(cls):
+        # file lock held: index lines written before, e.g. by a previous run, once
+        if cls.__index is None:
+            cls.__index = dict()
+            try:
+                with open(cls.__filename, "rb") as file_:
+                    offset = file_.tell()
+                    for line in iter(file_.readline, b""):
+                        try:
+                            cls.__index.setdefault(json.loads(line.decode("utf-8"))["mid"], []).append(offset)
+                        except (ValueError, KeyError, TypeError):
+                            pass
+                        offset = file_.tell()
+            except IOError:
+                pass
+        return cls.__index
+
+    @classmethod
+    def pending(cls):
+        # type: () -> int
+        """Number of queued entries."""
+        return len(cls.__buffer)
+
+    @classmethod
+    def reset(cls):
+        """Drop queued entries and the index and renew the locks, e.g. in a forked worker process
+        (see Core.Isolation)."""
+        cls.__lock = threading.Lock()
+        cls.__fileLock = threading.Lock()
+        cls.__buffer = []
+        cls.__index = None
+
+    @classmethod
+    def query(cls, mid):
+        # type: (str) -> list
+        """Return all history entries of a single machine, which were moved to the history file."""
+        cls.write()
+        result = []
+        with cls.__fileLock:
+            offsets = cls.__loadIndex().get(mid)
+            if not offsets:
+                return result
+            try:
+                with open(cls.__filename, "rb") as file_:
+                    for offset in offsets:
+                        file_.seek(offset)
+                        try:
+                            entry = json.loads(file_.readline().decode("utf-8"))
+                        except ValueError:
+                            continue
+                        if entry.pop("mid", None) == mid:
+                            result.append(entry)
+            except IOError:
+                pass
+        return result
+
+
+class CycleTimingLog(object):
+    """Durations of the management cycle phases and adapters, written to the monitoring log every cycle.
+
+    A rolling window of the last cycles is kept per name, the log holds the duration of the current
+    cycle and percentiles over that window:
+    {"timing": {name: {"last": s, "p50": s, "p90": s, "p99": s, "max": s}}}
+    Durations measured after writeLog (e.g. writing the log itself) are reported with the next cycle.
+    """
+    window = 100
+    __durations = {}
+    __cycle = {}
+    __lock = threading.Lock()
+
+    @classmethod
+    @contextmanager
+    def measure(cls, name):
+        """Time a block, durations of the same name add up within a cycle."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            cls.add(name, time.time() - start)
+
+    @classmethod
+    def add(cls, name, duration):
+        # type: (str, float) -> None
+        with cls.__lock:
+            cls.__cycle[name] = cls.__cycle.get(name, 0.0) + duration
+
+    @classmethod
+    def percentiles(cls, name, percentiles=(50, 90, 99)):
+        # type: (str, tuple) -> dict
+        """Percentiles (nearest rank) of the durations in the window, e.g. {"p50": .., "max": ..}."""
+        with cls.__lock:
+            durations = sorted(cls.__durations.get(name, ()))
+        if not durations:
+            return {}
+        result = {"p%d" % p: durations[max(0, -(-len(durations) * p // 100) - 1)] for p in percentiles}
+        result["max"] = durations[-1]
+        return result
+
+    @classmethod
+    def writeLog(cls):
+        """Close the current cycle and add its durations to the JSON log."""
+        with cls.__lock:
+            cycle, cls.__cycle = cls.__cycle, {}
+            for name, duration in cycle.items():
+                if name not in cls.__durations:
+                    cls.__durations[name] = deque(maxlen=cls.window)
+                cls.__durations[name].append(duration)
+        for name, duration in cycle.items():
+            timing = {key: round(value, 4) for key, value in cls.percentiles(name).items()}
+            timing["last"] = round(duration, 4)
+            JsonLog.addItem("timing", name, timing)
+
+    @classmethod
+    def clear(cls):
+        with cls.__lock:
+            cls.__durations = {}
+            cls.__cycle = {}
+
 
 class JsonLog(object):
     # TODO: Make this class a singleton, returning a different instance for each output file.
@@ -137,6 +464,20 @@ class JsonLog(object):
             cls.__jsonLog[site] = {}
         cls.__jsonLog[site][key] = value
 
+    @classmethod
+    def takeItems(cls):
+        # type: () -> dict
+        """Remove and return the items of the current log (e.g. to pass them on from a worker process)."""
+        items, cls.__jsonLog = cls.__jsonLog, {}
+        return items
+
+    @classmethod
+    def addItems(cls, items):
+        # type: (dict) -> None
+        for site, values in items.items():
+            for key, value in values.items():
+                cls.addItem(site, key, value)
+
     @classmethod
     def writeLog(cls):
         """Write current log into JSON file."""
@@ -287,6 +628,7 @@ class CsvStats(object):
     #   "time_diff":"datetime.timediff()"},{},{},...]
     __fileName = ""
     __fieldnames = ["site", "mid", "old_status", "new_status", "timestamp", "time_diff"]
+    __lock = threading.Lock()
 
     @classmethod
     def __init__(cls, dir_="log", prefix="stats", suffix=""):
@@ -320,17 +662,35 @@ class CsvStats(object):
 
     @classmethod
     def add_item(cls, site, mid, old_status, new_status, timestamp, time_diff):
-        cls.__csvStats.append(
-            {"site": site, "mid": mid, "old_status": old_status, "new_status": new_status,
-             "timestamp": timestamp, "time_diff": time_diff})
+        with cls.__lock:
+            cls.__csvStats.append(
+                {"site": site, "mid": mid, "old_status": old_status, "new_status": new_status,
+                 "timestamp": timestamp, "time_diff": time_diff})
 
     @classmethod
     def write_stats(cls):
-        with UnicodeWriter(cls.__fileName, fieldnames=cls.__fieldnames) as writer:
-            # with open(cls.__fileName, "a") as stats_file:
-            #     writer = UnicodeWriter(stats_file, fieldnames=cls.__fieldnames)
-            for stat in range(len(cls.__csvStats)):
-                writer.writerow(cls.__csvStats.pop())
+        # hold the lock while writing, so rows of concurrent writers end up in order
+        with cls.__lock:
+            if not cls.__csvStats:
+                return
+            with UnicodeWriter(cls.__fileName, fieldnames=cls.__fieldnames) as writer:
+                # with open(cls.__fileName, "a") as stats_file:
+                #     writer = UnicodeWriter(stats_file, fieldnames=cls.__fieldnames)
+                for stat in cls.__csvStats:
+                    writer.writerow(stat)
+            del cls.__csvStats[:]
+
+    @classmethod
+    def pending(cls):
+        # type: () -> int
+        """Number of rows not yet written."""
+        return len(cls.__csvStats)
+
+    @classmethod
+    def reset(cls):
+        """Drop unwritten rows and renew the lock, e.g. in a forked worker process (see Core.Isolation)."""
+        cls.__lock = threading.Lock()
+        cls.__csvStats = []
 
     @classmethod
     def printLog(cls):
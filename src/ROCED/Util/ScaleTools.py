@@ -31,7 +31,7 @@ from Core import ScaleTest
 class ChangeNotifier(object):
     def __init__(self, machineReg):
         self.mr = machineReg
-        self.mr.registerListener(self)
+        self.mr.subscribe(self, MachineRegistry.StatusChangedEvent)
         self.cached = []
 
     def onEvent(self, evt):
@@ -40,7 +40,7 @@ from Util.Daemon import DaemonBase
 ###
 # Unit tests:
 ###
-from Core import CoreTest, EventTest, AdapterTest
+from Core import CoreTest, EventTest, AdapterTest, MachineRegistryTest
 from SiteAdapter import SiteTest
 from RequirementAdapter import RequirementTest
 from IntegrationAdapter import IntegrationTest
@@ -51,6 +51,10 @@ try:
     from Util import HTCondor
 except ImportWarning:
     pass
+if sys.version_info >= (3, 5):
+    from Core import AsyncCoreTest
+else:
+    AsyncCoreTest = None
 
 
 class ScaleMain(object):
@@ -69,10 +73,13 @@ class ScaleMain(object):
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(SiteTest))
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(CoreTest))
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(EventTest))
+        ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(MachineRegistryTest))
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(IntegrationTest))
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(RequirementTest))
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(ScaleTools))
         ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(HTCondor))
+        if AsyncCoreTest is not None:
+            ts.addTests(unittest.defaultTestLoader.loadTestsFromModule(AsyncCoreTest))
 
         self.logger.info("Running %d tests." % ts.countTestCases())
         result = unittest.TestResult()